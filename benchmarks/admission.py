@@ -0,0 +1,163 @@
+"""Бенчмарк: всплеск записи при ограничении нагрузки и без него.
+
+Имитирует начало урока у всей школы: writers потоков без пауз шлют пачки
+ответов в /save_answers (синхронная запись в базу) от имени разных
+учеников, а readers потоков в это время открывают страницы уроков. Прогон
+повторяется дважды - без ограничений и с настройками по умолчанию из
+data/admission.py - и для каждого печатает задержку чтения, задержку
+пропущенных записей и сколько записей отклонено.
+
+Запуск: python -m benchmarks.admission [--writers N] [--readers N] [--seconds N] [--users N ...]
+"""
+import argparse
+import os
+import random
+import statistics
+import tempfile
+import threading
+import time
+import uuid
+
+import sqlalchemy as sa
+
+from benchmarks import dataset
+from benchmarks.routes import Scenario, available_lessons, percentile
+
+WRITERS = 32
+READERS = 4
+SECONDS = 10.0
+ANSWERS_PER_BATCH = 20
+
+
+def login(client, user_id):
+    with client.session_transaction() as session:
+        session['_user_id'] = str(user_id)
+        session['_fresh'] = True
+
+
+def answer_batch(catalog, available, user_ids, rng):
+    """Пачка ответов случайного ученика по одному из доступных ему уроков"""
+    user_id = rng.choice(user_ids)
+    lesson = catalog.get_lesson(rng.choice(available[user_id]))
+    answers = []
+    for _ in range(ANSWERS_PER_BATCH):
+        is_correct = rng.random() < 0.75
+        answers.append({
+            'key': uuid.uuid4().hex,
+            'lesson_id': lesson.id,
+            'gesture_id': rng.choice(lesson.gesture_ids),
+            'is_correct': is_correct,
+            'selected_answer': None if is_correct else catalog.get_gesture(rng.choice(lesson.gesture_ids)).word,
+        })
+    return user_id, answers
+
+
+def spike(app, catalog, available, writers, readers, seconds, seed):
+    """Запускает потоки на seconds секунд и возвращает (чтения, записи): [(время, статус)]"""
+    stop = threading.Event()
+    reads, writes = [], []
+
+    def writer(number):
+        client = app.test_client()
+        # Каждый запрос от случайного ученика: всплеск от многих учеников, а не от одного
+        rng = random.Random(f'{seed}:w{number}')
+        user_ids = sorted(available)
+        while not stop.is_set():
+            user_id, answers = answer_batch(catalog, available, user_ids, rng)
+            login(client, user_id)
+            started = time.perf_counter()
+            response = client.post('/save_answers', json={'answers': answers})
+            writes.append((time.perf_counter() - started, response.status_code))
+            response.close()
+
+    def reader(number):
+        client = app.test_client()
+        scenario = Scenario(catalog, available, random.Random(f'{seed}:r{number}'))
+        while not stop.is_set():
+            user_id, method, url, _ = scenario.request('lesson')
+            login(client, user_id)
+            started = time.perf_counter()
+            response = client.get(url)
+            reads.append((time.perf_counter() - started, response.status_code))
+            response.close()
+
+    threads = [threading.Thread(target=writer, args=(n,)) for n in range(writers)]
+    threads += [threading.Thread(target=reader, args=(n,)) for n in range(readers)]
+    for thread in threads:
+        thread.start()
+    time.sleep(seconds)
+    stop.set()
+    for thread in threads:
+        thread.join()
+    return reads, writes
+
+
+def report(name, reads, writes, seconds):
+    read_ms = [t * 1000 for t, _ in reads]
+    admitted_ms = [t * 1000 for t, status in writes if status == 200]
+    shed_ms = [t * 1000 for t, status in writes if status in (429, 503)]
+    statuses = {}
+    for _, status in writes:
+        statuses[status] = statuses.get(status, 0) + 1
+    print(f'{name}:')
+    print(f'  чтение:  {len(reads) / seconds:.0f} запр/с, p50 {percentile(read_ms, 0.5):.1f} мс, '
+          f'p99 {percentile(read_ms, 0.99):.1f} мс')
+    if admitted_ms:
+        print(f'  запись:  {len(admitted_ms) / seconds:.0f} пачек/с, p50 {percentile(admitted_ms, 0.5):.1f} мс, '
+              f'p99 {percentile(admitted_ms, 0.99):.1f} мс')
+    if shed_ms:
+        print(f'  отказ:   среднее {statistics.mean(shed_ms):.1f} мс')
+    print(f'  статусы записи: {dict(sorted(statuses.items()))}')
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--writers', type=int, default=WRITERS)
+    parser.add_argument('--readers', type=int, default=READERS)
+    parser.add_argument('--seconds', type=float, default=SECONDS)
+    dataset.add_arguments(parser)
+    parser.set_defaults(users=200)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp:
+        db_path = os.path.join(tmp, 'bench.db')
+        dataset.generate(db_path, **dataset.scale_from_args(args))
+        # main подключается к базе при импорте, поэтому окружение - до импорта
+        os.environ['DB_PATH'] = db_path
+        os.environ['ANSWER_WRITE_BEHIND'] = '0'
+        os.environ['LOG_LEVEL'] = 'WARNING'
+        os.environ.setdefault('SLOW_QUERY_MS', '60000')
+        import main as app_main
+        from data import db_session
+        from data.catalog import get_catalog
+
+        catalog = get_catalog()
+        db_sess = db_session.create_read_session()
+        try:
+            user_ids = [user_id for (user_id,) in db_sess.execute(sa.text('SELECT id FROM users'))]
+            available = available_lessons(db_sess, catalog, user_ids)
+        finally:
+            db_sess.close()
+
+        control = app_main.admission_control
+        limits = {name: gate.concurrency for name, gate in control.gates.items()}
+        rate = control.buckets.rate
+
+        # Без ограничений: все запросы ждут писателя сколько потребуется
+        for gate in control.gates.values():
+            gate.concurrency = 10 ** 6
+        control.buckets.rate = 0
+        reads, writes = spike(app_main.app, catalog, available, args.writers, args.readers, args.seconds, args.seed)
+        report('без ограничения', reads, writes, args.seconds)
+
+        for name, gate in control.gates.items():
+            gate.concurrency = limits[name]
+        control.buckets.rate = rate
+        reads, writes = spike(app_main.app, catalog, available, args.writers, args.readers, args.seconds, args.seed)
+        gate = control.gates['save_answers']
+        report(f'с ограничением (одновременно {gate.concurrency}, очередь {gate.queue_size}, '
+               f'ожидание {gate.deadline:.1f} с)', reads, writes, args.seconds)
+
+
+if __name__ == '__main__':
+    main()
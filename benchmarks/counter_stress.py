@@ -0,0 +1,164 @@
+"""Стресс-тест: счетчики ответов при параллельных воркерах.
+
+Несколько процессов одновременно присылают ответы одного пользователя
+(правильные и с ошибками) и завершают одни и те же уроки. После этого
+счетчики UserLesson, UserProgress и UserMistake должны совпасть с числом
+отправленных ответов до единицы, а пройденный урок - учитываться один раз.
+Заодно считаем SQL-запросы на одну пачку ответов.
+
+Запуск: python -m benchmarks.counter_stress [процессов] [пачек на процесс]
+"""
+import multiprocessing
+import os
+import sys
+import tempfile
+import time
+
+import sqlalchemy as sa
+
+WORKERS = 8
+BATCHES = 100
+BATCH_SIZE = 5
+USER_ID = 1
+
+
+def build_database(path):
+    from data import db_session
+    from data.gesture import Gesture
+    from data.lesson import Lesson
+    from data.lesson_gesture import LessonGesture
+    from data.module import Module
+    from data.users import User
+
+    db_session.global_init(path)
+    db_sess = db_session.create_session()
+    user = User(username='stress', email='stress@example.com')
+    user.set_password('stress')
+    module = Module(title='Модуль', order_index=1)
+    db_sess.add_all([user, module])
+    db_sess.flush()
+    for i, lesson_type in enumerate(['new_gestures', 'final_review']):
+        lesson = Lesson(module_id=module.id, title=f'Урок {i}', lesson_type=lesson_type, order_index=i + 1)
+        gesture = Gesture(word=f'Жест {i}', video_filename=f'{i}.mp4')
+        db_sess.add_all([lesson, gesture])
+        db_sess.flush()
+        db_sess.add(LessonGesture(lesson_id=lesson.id, gesture_id=gesture.id, order_index=1))
+    db_sess.commit()
+    db_sess.close()
+
+
+def worker(args):
+    path, number, batches = args
+    from data import db_session
+    from data.answers import apply_answers, parse_answer
+    from data.catalog import get_catalog
+    from data.progress import complete_lesson
+
+    db_session.global_init(path)
+    catalog = get_catalog()
+    lesson = catalog.modules[0].lesson_ids[0]
+    gesture = catalog.get_lesson(lesson).gesture_ids[0]
+
+    for batch in range(batches):
+        answers = [
+            parse_answer({
+                'key': f'w{number}-{batch}-{i}',
+                'lesson_id': lesson,
+                'gesture_id': gesture,
+                'is_correct': i % 2 == 0,
+                'selected_answer': 'Дом',
+            }, catalog)
+            for i in range(BATCH_SIZE)
+        ]
+        db_session.transaction(apply_answers, USER_ID, answers, catalog)
+        # Повтор той же пачки (как повтор запроса клиентом) не должен ничего менять
+        db_session.transaction(apply_answers, USER_ID, answers, catalog)
+        if batch % 10 == 0:
+            db_session.transaction(complete_lesson, USER_ID, catalog.get_lesson(lesson), catalog)
+    return batches * BATCH_SIZE
+
+
+def count_statements(path):
+    """Сколько SQL-запросов стоит одна пачка ответов"""
+    from data import db_session
+    from data.answers import apply_answers, parse_answer
+    from data.catalog import get_catalog
+
+    db_session.global_init(path)
+    catalog = get_catalog()
+    lesson = catalog.modules[0].lesson_ids[0]
+    gesture = catalog.get_lesson(lesson).gesture_ids[0]
+    answers = [
+        parse_answer({'key': f'count-{i}', 'lesson_id': lesson, 'gesture_id': gesture,
+                      'is_correct': i % 2 == 0, 'selected_answer': 'Дом'}, catalog)
+        for i in range(BATCH_SIZE)
+    ]
+
+    db_sess = db_session.create_session()
+    statements = []
+    engine = db_sess.get_bind()
+    listener = lambda *args: statements.append(args[2])
+    sa.event.listen(engine, 'before_cursor_execute', listener)
+    try:
+        apply_answers(db_sess, USER_ID, answers, catalog)
+        db_sess.rollback()
+    finally:
+        sa.event.remove(engine, 'before_cursor_execute', listener)
+        db_sess.close()
+    #BEGIN IMMEDIATE идет через exec_driver_sql и тоже попадает в список
+    return len([s for s in statements if not s.startswith('BEGIN')])
+
+
+def main():
+    workers = int(sys.argv[1]) if len(sys.argv) > 1 else WORKERS
+    batches = int(sys.argv[2]) if len(sys.argv) > 2 else BATCHES
+
+    with tempfile.TemporaryDirectory() as tmp:
+        path = os.path.join(tmp, 'stress.db')
+        build_database(path)
+        statements = count_statements(path)
+
+        started = time.perf_counter()
+        with multiprocessing.get_context('spawn').Pool(workers) as pool:
+            sent = sum(pool.map(worker, [(path, n, batches) for n in range(workers)]))
+        elapsed = time.perf_counter() - started
+
+        with sa.create_engine(f'sqlite:///{path}').connect() as conn:
+            lesson_total, lesson_correct, completed = conn.execute(sa.text(
+                'SELECT total_answers, correct_answers, completed_at IS NOT NULL FROM user_lessons'
+                ' WHERE user_id = :user ORDER BY lesson_id LIMIT 1'), {'user': USER_ID}).one()
+            module_total, module_correct, completed_lessons = conn.execute(sa.text(
+                'SELECT total_questions, correct_answers, completed_lessons FROM user_progress'
+                ' WHERE user_id = :user'), {'user': USER_ID}).one()
+            mistakes = conn.execute(sa.text(
+                'SELECT SUM(mistake_count), COUNT(*) FROM user_mistakes WHERE user_id = :user'),
+                {'user': USER_ID}).one()
+
+    correct = sent - sent // BATCH_SIZE * (BATCH_SIZE // 2)
+    expected = {
+        'ответов в уроке': (lesson_total, sent),
+        'правильных в уроке': (lesson_correct, correct),
+        'ответов в модуле': (module_total, sent),
+        'правильных в модуле': (module_correct, correct),
+        'ошибок': (mistakes[0], sent - correct),
+        'строк ошибок': (mistakes[1], 1),
+        'урок пройден': (completed, 1),
+        'пройдено уроков': (completed_lessons, 1),
+    }
+
+    print(f'процессов: {workers}, ответов: {sent}, время: {elapsed:.2f} с, '
+          f'{sent * 2 / elapsed:.0f} ответов/с вместе с повторами')
+    print(f'SQL-запросов на пачку из {BATCH_SIZE} ответов: {statements}')
+    failed = False
+    for name, (actual, wanted) in expected.items():
+        mark = 'ok' if actual == wanted else 'РАСХОЖДЕНИЕ'
+        failed = failed or actual != wanted
+        print(f'{name:>20}: {actual} (ожидалось {wanted}) {mark}')
+
+    if failed:
+        raise SystemExit('Счетчики разошлись с числом отправленных ответов')
+    print('Все счетчики точные')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,212 @@
+"""Генератор синтетической базы для бенчмарков.
+
+Строит базу с настоящей схемой (через миграции) и заполняет ее курсом
+заданного размера и историей учеников. История пишется теми же функциями,
+что и приложение (apply_answers и complete_lesson), поэтому счетчики,
+ошибки, очереди повторения и версии состояния согласованы между собой.
+При одном и том же seed получается одна и та же база.
+
+Запуск: python -m benchmarks.dataset путь.db [--users N] [--modules N] ...
+"""
+import argparse
+import os
+import random
+import sys
+import time
+
+import sqlalchemy as sa
+import sqlalchemy.orm as orm
+from werkzeug.security import generate_password_hash
+
+from data import __all_models  # noqa: F401 - регистрирует все модели
+from data.answers import apply_answers
+from data.catalog import bump_content_version, load_catalog
+from data.gesture import Gesture
+from data.lesson import Lesson
+from data.lesson_gesture import LessonGesture
+from data.migrations import migrate
+from data.module import Module
+from data.progress import complete_lesson
+from data.user_progress import UserProgress
+from data.users import User
+
+LESSON_TYPES = ('new_gestures', 'repeat_new', 'repeat_old', 'final_review')
+#пароль всех сгенерированных учеников
+PASSWORD = 'password'
+
+DEFAULTS = {
+    'users': 1000,
+    'modules': 10,
+    'lessons_per_module': 4,
+    'gestures': 500,
+    'lesson_size': 5,  #жестов в уроке
+    'progress': 0.3,  #средняя доля пройденного курса
+    'attempts': 2,  #ответов на каждый жест пройденного урока
+    'seed': 1,
+}
+
+
+def user_email(number):
+    return f'user{number}@bench.local'
+
+
+def build_course(db_sess, rng, modules, lessons_per_module, gestures, lesson_size):
+    """Модули, уроки и словарь. Новые жесты идут по словарю подряд, повторения берут уже пройденные"""
+    db_sess.add_all(
+        Gesture(id=i, word=f'Жест {i}', video_filename=f'gesture_{i}.mp4', description=f'Описание жеста {i}')
+        for i in range(1, gestures + 1)
+    )
+    next_new = 1
+    learned = []
+    lesson_id = 0
+    for m in range(1, modules + 1):
+        db_sess.add(Module(id=m, title=f'Модуль {m}', description=f'Описание модуля {m}', order_index=m))
+        for i in range(lessons_per_module):
+            lesson_id += 1
+            lesson_type = LESSON_TYPES[i % len(LESSON_TYPES)]
+            db_sess.add(Lesson(id=lesson_id, module_id=m, title=f'Урок {m}.{i + 1}',
+                               lesson_type=lesson_type, order_index=i + 1))
+            if lesson_type == 'new_gestures' or len(learned) < lesson_size:
+                gesture_ids = [(next_new + k - 1) % gestures + 1 for k in range(lesson_size)]
+                next_new = (next_new + lesson_size - 1) % gestures + 1
+                learned.extend(g for g in gesture_ids if g not in learned)
+            else:
+                gesture_ids = rng.sample(learned, lesson_size)
+            db_sess.add_all(
+                LessonGesture(lesson_id=lesson_id, gesture_id=gesture_id, order_index=order)
+                for order, gesture_id in enumerate(gesture_ids, start=1)
+            )
+    bump_content_version(db_sess)
+
+
+def lesson_answers(rng, catalog, lesson, attempts, accuracy):
+    answers = []
+    for gesture in catalog.lesson_gestures(lesson.id):
+        for _ in range(attempts):
+            is_correct = rng.random() < accuracy
+            wrong = None if is_correct else catalog.get_gesture(rng.choice(lesson.gesture_ids)).word
+            answers.append({
+                'key': None,
+                'lesson_id': lesson.id,
+                'module_id': lesson.module_id,
+                'gesture_id': gesture.id,
+                'is_correct': is_correct,
+                'selected_answer': wrong,
+            })
+    return answers
+
+
+def build_history(factory, rng, catalog, users, progress, attempts):
+    """Ученики с прогрессом: каждый проходит курс по порядку на свою глубину"""
+    course = [lesson for module in catalog.modules for lesson in catalog.module_lessons(module.id)]
+    hashed_password = generate_password_hash(PASSWORD)
+    answers_total = 0
+    for number in range(1, users + 1):
+        db_sess = factory()
+        user = User(username=f'Ученик {number}', email=user_email(number), hashed_password=hashed_password)
+        db_sess.add(user)
+        db_sess.flush()
+        db_sess.add_all(
+            UserProgress(user_id=user.id, module_id=module.id, correct_answers=0, total_questions=0,
+                         completion_percentage=0.0, is_completed=False)
+            for module in catalog.modules
+        )
+
+        # Глубина прохождения: у большинства немного, у немногих почти весь курс
+        depth = min(len(course), int(rng.expovariate(1 / max(progress, 1e-6)) * len(course)))
+        accuracy = rng.uniform(0.5, 0.95)
+        answers = []
+        for lesson in course[:depth]:
+            answers += lesson_answers(rng, catalog, lesson, attempts, accuracy)
+        # Урок, на котором ученик остановился, пройден наполовину
+        if depth < len(course):
+            started = lesson_answers(rng, catalog, course[depth], 1, accuracy)
+            answers += started[:(len(started) + 1) // 2]
+        # Вся история одной пачкой: так же, как ее применил бы журнал отложенной записи
+        if answers:
+            answers_total += apply_answers(db_sess, user.id, answers, catalog)
+        for lesson in course[:depth]:
+            complete_lesson(db_sess, user.id, lesson, catalog)
+
+        db_sess.commit()
+        db_sess.close()
+    return answers_total
+
+
+def generate(path, users=DEFAULTS['users'], modules=DEFAULTS['modules'],
+             lessons_per_module=DEFAULTS['lessons_per_module'], gestures=DEFAULTS['gestures'],
+             lesson_size=DEFAULTS['lesson_size'], progress=DEFAULTS['progress'],
+             attempts=DEFAULTS['attempts'], seed=DEFAULTS['seed']):
+    """Создает базу path (существующий файл перезаписывается). Возвращает число записанных ответов"""
+    lesson_size = min(lesson_size, gestures)
+    for suffix in ('', '-wal', '-shm'):
+        if os.path.exists(path + suffix):
+            os.remove(path + suffix)
+
+    engine = sa.create_engine(f'sqlite:///{path}')
+
+    @sa.event.listens_for(engine, 'connect')
+    def on_connect(dbapi_connection, connection_record):
+        #база одноразовая: скорость заполнения важнее надежности
+        dbapi_connection.execute('PRAGMA synchronous = OFF')
+
+    migrate(engine)
+    factory = orm.sessionmaker(bind=engine)
+    rng = random.Random(seed)
+
+    db_sess = factory()
+    build_course(db_sess, rng, modules, lessons_per_module, gestures, lesson_size)
+    db_sess.commit()
+    catalog = load_catalog(db_sess)
+    db_sess.close()
+
+    answers_total = build_history(factory, rng, catalog, users, progress, attempts)
+    engine.dispose()
+    return answers_total
+
+
+def table_counts(path):
+    """Размер базы по таблицам - для отчета и метаданных результатов"""
+    engine = sa.create_engine(f'sqlite:///{path}')
+    try:
+        with engine.connect() as conn:
+            names = sa.inspect(conn).get_table_names()
+            return {name: conn.exec_driver_sql(f'SELECT count(*) FROM "{name}"').scalar() for name in names}
+    finally:
+        engine.dispose()
+
+
+def add_arguments(parser):
+    """Параметры размера базы (общие с benchmarks.routes)"""
+    parser.add_argument('--users', type=int, default=DEFAULTS['users'])
+    parser.add_argument('--modules', type=int, default=DEFAULTS['modules'])
+    parser.add_argument('--lessons-per-module', type=int, default=DEFAULTS['lessons_per_module'])
+    parser.add_argument('--gestures', type=int, default=DEFAULTS['gestures'])
+    parser.add_argument('--lesson-size', type=int, default=DEFAULTS['lesson_size'])
+    parser.add_argument('--progress', type=float, default=DEFAULTS['progress'],
+                        help='средняя доля пройденного курса')
+    parser.add_argument('--attempts', type=int, default=DEFAULTS['attempts'],
+                        help='ответов на каждый жест пройденного урока')
+    parser.add_argument('--seed', type=int, default=DEFAULTS['seed'])
+
+
+def scale_from_args(args):
+    return {name: getattr(args, name) for name in DEFAULTS}
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Синтетическая база для бенчмарков')
+    parser.add_argument('path')
+    add_arguments(parser)
+    args = parser.parse_args(argv)
+
+    started = time.perf_counter()
+    answers_total = generate(args.path, **scale_from_args(args))
+    print(f'{args.path}: ответов {answers_total}, '
+          f'{os.path.getsize(args.path) / 2 ** 20:.1f} МБ, {time.perf_counter() - started:.1f} с')
+    for name, count in sorted(table_counts(args.path).items()):
+        print(f'{name:>20}: {count}')
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,118 @@
+"""Бенчмарк: потоковая выгрузка ошибок учеников.
+
+Выгружает user_mistakes для школ разного размера и замеряет время, скорость
+и пик памяти Python (tracemalloc) на всю выгрузку. Пик памяти не должен
+расти вместе с числом строк (tracemalloc сам замедляет выгрузку в несколько
+раз, скорость без него выше). Посреди выгрузки проверяется, что писатель
+в это время получает блокировку записи без ожидания.
+
+Запуск: python -m benchmarks.export [учеников ...] [--mistakes N] [--format csv|ndjson] [--gzip]
+"""
+import argparse
+import os
+import random
+import sqlite3
+import tempfile
+import time
+import tracemalloc
+
+import sqlalchemy as sa
+
+from data import db_session
+from data import export
+from data.catalog import Catalog
+
+USERS = (5000, 20000, 50000)
+MISTAKES_PER_USER = 20
+INSERT_CHUNK = 10000
+
+
+def fill_database(path, first_user, last_user, mistakes_per_user):
+    rng = random.Random(first_user)
+    conn = sqlite3.connect(path)
+    try:
+        conn.execute('PRAGMA synchronous = OFF')
+        conn.executemany(
+            'INSERT INTO users (id, username, email, class_name) VALUES (?, ?, ?, ?)',
+            [(user_id, f'Ученик {user_id}', f'student{user_id}@example.com', f'{rng.randrange(1, 12)}А')
+             for user_id in range(first_user, last_user + 1)]
+        )
+        rows = []
+        for user_id in range(first_user, last_user + 1):
+            for gesture_id in rng.sample(range(1, 1001), mistakes_per_user):
+                rows.append((user_id, gesture_id, rng.randrange(1, 41), rng.randrange(1, 11),
+                             f'Слово {rng.randrange(1000)}', rng.randrange(1, 6)))
+            if len(rows) >= INSERT_CHUNK:
+                conn.executemany(
+                    'INSERT INTO user_mistakes (user_id, gesture_id, lesson_id, module_id, incorrect_answer, '
+                    'mistake_count) VALUES (?, ?, ?, ?, ?, ?)', rows
+                )
+                rows = []
+        if rows:
+            conn.executemany(
+                'INSERT INTO user_mistakes (user_id, gesture_id, lesson_id, module_id, incorrect_answer, '
+                'mistake_count) VALUES (?, ?, ?, ?, ?, ?)', rows
+            )
+        conn.commit()
+    finally:
+        conn.close()
+
+
+def write_during_export():
+    """Время короткой транзакции записи, пока выгрузка держит читающую транзакцию"""
+    started = time.perf_counter()
+    db_sess = db_session.create_session()
+    try:
+        db_sess.execute(sa.text("UPDATE users SET about = 'export' WHERE id = 1"))
+        db_sess.commit()
+    finally:
+        db_sess.close()
+    return time.perf_counter() - started
+
+
+def run(users, mistakes_per_user, fmt, compress):
+    catalog = Catalog(1, [], [], [])
+
+    tracemalloc.start()
+    started = time.perf_counter()
+    size = 0
+    write_seconds = None
+    for chunk in export.stream('mistakes', fmt, catalog, compress=compress):
+        size += len(chunk)
+        # После первого куска выгрузка держит читающую транзакцию, пока не дочитает строки
+        if write_seconds is None:
+            write_seconds = write_during_export()
+    elapsed = time.perf_counter() - started
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    rows = users * mistakes_per_user
+    # Пустая выгрузка (ndjson без строк) не дает ни одного куска - записывать не во время чего
+    write = f'{write_seconds * 1000:.1f} мс' if write_seconds is not None else 'не замерялась'
+    print(f'{users:>7} учеников, {rows:>8} строк: {elapsed:.1f} с ({rows / elapsed:.0f} строк/с), '
+          f'{size / 2 ** 20:.1f} МБ, пик памяти {peak / 2 ** 20:.2f} МБ, '
+          f'запись во время выгрузки {write}')
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('users', type=int, nargs='*', default=list(USERS))
+    parser.add_argument('--mistakes', type=int, default=MISTAKES_PER_USER, help='Ошибок на ученика')
+    parser.add_argument('--format', choices=export.FORMATS, default='csv')
+    parser.add_argument('--gzip', action='store_true')
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp:
+        path = os.path.join(tmp, 'export.db')
+        # Схема через миграции; сессии приложения смотрят в эту базу
+        db_session.global_init(path)
+        # Школа растет: перед каждым замером добавляются новые ученики
+        filled = 0
+        for users in sorted(args.users):
+            fill_database(path, filled + 1, users, args.mistakes)
+            filled = users
+            run(users, args.mistakes, args.format, args.gzip)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,156 @@
+"""Бенчмарк: рейтинг на 100 000 учеников.
+
+Создает временную базу, где у каждого ученика есть очки в общей таблице
+рейтинга и в таблицах нескольких модулей, и замеряет на случайных учениках:
+  - учет ответа или пройденного урока (строка ученика и корзины очков);
+  - первую страницу рейтинга (начало индекса по очкам);
+  - место ученика (сумма корзин с большими очками).
+Время операций не должно расти вместе с числом учеников.
+
+Запуск: python -m benchmarks.leaderboard [учеников] [замеров]
+"""
+import os
+import random
+import statistics
+import sys
+import tempfile
+import time
+
+import sqlalchemy as sa
+import sqlalchemy.orm as orm
+
+from data import __all_models  # noqa: F401 - регистрирует все модели
+from data import leaderboard
+from data.db_session import SqlAlchemyBase
+
+USERS = 100000
+SAMPLES = 2000
+MODULES = 5
+LESSONS_PER_MODULE = 10
+INSERT_CHUNK = 1000
+
+
+def build_database(path, users):
+    engine = sa.create_engine(f'sqlite:///{path}')
+    SqlAlchemyBase.metadata.create_all(engine)
+
+    rng = random.Random(42)
+    raw = engine.raw_connection()
+    try:
+        cursor = raw.cursor()
+        cursor.execute('PRAGMA synchronous = OFF')
+        cursor.execute('PRAGMA journal_mode = OFF')
+        for start in range(1, users + 1, INSERT_CHUNK):
+            user_ids = range(start, min(start + INSERT_CHUNK, users + 1))
+            cursor.executemany(
+                'INSERT INTO users (id, username, email) VALUES (?, ?, ?)',
+                [(user_id, f'Ученик {user_id}', f'student{user_id}@example.com') for user_id in user_ids]
+            )
+            rows = []
+            for user_id in user_ids:
+                totals = [0, 0, 0]
+                for module_id in range(1, MODULES + 1):
+                    lessons = rng.randrange(LESSONS_PER_MODULE + 1)
+                    answers = lessons * 10 + rng.randrange(10)
+                    correct = rng.randrange(answers + 1)
+                    rows.append((leaderboard.module_board(module_id), user_id, lessons, correct, answers,
+                                 leaderboard.score(lessons, correct, answers)))
+                    totals = [totals[0] + lessons, totals[1] + correct, totals[2] + answers]
+                rows.append((leaderboard.ALL, user_id, *totals, leaderboard.score(*totals)))
+            cursor.executemany(
+                'INSERT INTO leaderboard_scores (board, user_id, lessons, correct, answers, score) '
+                'VALUES (?, ?, ?, ?, ?, ?)', rows
+            )
+        cursor.execute(
+            'INSERT INTO leaderboard_buckets (board, score, students) '
+            'SELECT board, score, COUNT(*) FROM leaderboard_scores GROUP BY board, score'
+        )
+        raw.commit()
+    finally:
+        raw.close()
+    return engine
+
+
+def percentile(values, share):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * share))]
+
+
+def report(name, timings):
+    timings = [t * 1000 for t in timings]
+    print(f'{name:>28}: p50 {percentile(timings, 0.5):.3f} мс, p99 {percentile(timings, 0.99):.3f} мс, '
+          f'среднее {statistics.mean(timings):.3f} мс')
+
+
+def main():
+    users = int(sys.argv[1]) if len(sys.argv) > 1 else USERS
+    samples = int(sys.argv[2]) if len(sys.argv) > 2 else SAMPLES
+
+    with tempfile.TemporaryDirectory() as tmp:
+        path = os.path.join(tmp, 'leaderboard.db')
+        started = time.perf_counter()
+        engine = build_database(path, users)
+        print(f'учеников: {users}, таблиц рейтинга: {MODULES + 1}, '
+              f'база: {os.path.getsize(path) / 2 ** 20:.0f} МБ, '
+              f'подготовка {time.perf_counter() - started:.1f} с')
+
+        factory = orm.sessionmaker(bind=engine)
+        rng = random.Random(7)
+        boards = [leaderboard.ALL] + [leaderboard.module_board(m) for m in range(1, MODULES + 1)]
+        record_timings = []
+        top_timings = []
+        standing_timings = []
+        for _ in range(samples):
+            user_id = rng.randrange(1, users + 1)
+            module_id = rng.randrange(1, MODULES + 1)
+            # Пачка ответов или пройденный урок
+            if rng.random() < 0.8:
+                delta = (0, rng.randrange(6), 5)
+            else:
+                delta = (1, 0, 0)
+
+            db_sess = factory()
+            started = time.perf_counter()
+            leaderboard.record(db_sess, user_id, {module_id: delta})
+            db_sess.commit()
+            record_timings.append(time.perf_counter() - started)
+            db_sess.close()
+
+            board = rng.choice(boards)
+            db_sess = factory()
+            started = time.perf_counter()
+            standings = leaderboard.top(db_sess, board)
+            top_timings.append(time.perf_counter() - started)
+            if len(standings) != leaderboard.TOP_SIZE:
+                raise SystemExit(f'Неполная первая страница рейтинга: {len(standings)}')
+
+            started = time.perf_counter()
+            standing = leaderboard.my_standing(db_sess, board, user_id)
+            standing_timings.append(time.perf_counter() - started)
+            db_sess.close()
+            if standing is None:
+                raise SystemExit(f'Ученика {user_id} нет в таблице {board}')
+
+        # Места по корзинам должны совпасть с прямым подсчетом по строкам
+        with engine.connect() as conn:
+            for board in boards:
+                user_id = rng.randrange(1, users + 1)
+                expected = conn.exec_driver_sql(
+                    'SELECT 1 + COUNT(*) FROM leaderboard_scores WHERE board = ? AND score > '
+                    '(SELECT score FROM leaderboard_scores WHERE board = ? AND user_id = ?)',
+                    (board, board, user_id)
+                ).scalar()
+                db_sess = factory()
+                actual = leaderboard.my_standing(db_sess, board, user_id).rank
+                db_sess.close()
+                if actual != expected:
+                    raise SystemExit(f'Место в {board}: {actual} вместо {expected}')
+        engine.dispose()
+
+    report('учет ответа или урока', record_timings)
+    report(f'первые {leaderboard.TOP_SIZE} учеников', top_timings)
+    report('место ученика', standing_timings)
+
+
+if __name__ == '__main__':
+    main()
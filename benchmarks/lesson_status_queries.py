@@ -0,0 +1,87 @@
+"""Бенчмарк: число SQL-запросов на расчет статусов уроков.
+
+Создает временную базу с растущим числом модулей (по 4 урока в каждом)
+и проверяет, что resolve_lesson_statuses делает одно и то же число
+запросов независимо от размера курса.
+
+Запуск: python -m benchmarks.lesson_status_queries
+"""
+import os
+import tempfile
+import time
+
+import sqlalchemy as sa
+import sqlalchemy.orm as orm
+
+from data import __all_models  # noqa: F401 - регистрирует все модели
+from data.catalog import load_catalog
+from data.db_session import SqlAlchemyBase
+from data.lesson import Lesson
+from data.lesson_status import resolve_lesson_statuses
+from data.module import Module
+from data.user_lesson import UserLesson
+
+LESSONS_PER_MODULE = 4
+MODULE_COUNTS = (1, 10, 100, 1000)
+USER_ID = 1
+
+
+def build_database(path, module_count):
+    engine = sa.create_engine(f'sqlite:///{path}')
+    SqlAlchemyBase.metadata.create_all(engine)
+    factory = orm.sessionmaker(bind=engine)
+
+    db_sess = factory()
+    lesson_types = ['new_gestures', 'repeat_new', 'repeat_old', 'final_review']
+    for m in range(module_count):
+        module = Module(title=f'Модуль {m}', order_index=m + 1)
+        db_sess.add(module)
+        db_sess.flush()
+        for i in range(LESSONS_PER_MODULE):
+            lesson = Lesson(module_id=module.id, title=f'Урок {i}', lesson_type=lesson_types[i], order_index=i + 1)
+            db_sess.add(lesson)
+            db_sess.flush()
+            # пользователь прошел первые два урока каждого модуля
+            if i < 2:
+                db_sess.add(UserLesson(user_id=USER_ID, lesson_id=lesson.id, completed_at=sa.func.now()))
+    db_sess.commit()
+    db_sess.close()
+    return engine, factory
+
+
+def measure(module_count):
+    with tempfile.TemporaryDirectory() as tmp:
+        engine, factory = build_database(os.path.join(tmp, 'bench.db'), module_count)
+
+        db_sess = factory()
+        catalog = load_catalog(db_sess)
+
+        statements = []
+        sa.event.listen(engine, 'before_cursor_execute', lambda *args: statements.append(args[2]))
+
+        started = time.perf_counter()
+        statuses = resolve_lesson_statuses(db_sess, USER_ID, catalog)
+        elapsed = time.perf_counter() - started
+
+        db_sess.close()
+        engine.dispose()
+
+    available = sum(1 for s in statuses.values() if s['available'])
+    return len(statements), elapsed, len(statuses), available
+
+
+def main():
+    print(f"{'модулей':>8} {'уроков':>8} {'запросов':>9} {'доступно':>9} {'время, мс':>10}")
+    counts = set()
+    for module_count in MODULE_COUNTS:
+        queries, elapsed, lessons, available = measure(module_count)
+        counts.add(queries)
+        print(f'{module_count:>8} {lessons:>8} {queries:>9} {available:>9} {elapsed * 1000:>10.2f}')
+
+    if len(counts) != 1:
+        raise SystemExit('Число запросов растет вместе с числом модулей')
+    print('Число запросов не зависит от размера курса')
+
+
+if __name__ == '__main__':
+    main()
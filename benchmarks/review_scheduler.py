@@ -0,0 +1,126 @@
+"""Бенчмарк: очередь интервального повторения на 100 000 учеников × 1000 жестов.
+
+Создает временную базу, где у каждого ученика в очереди все жесты словаря
+со случайными сроками, и замеряет на случайных учениках:
+  - учет пачки ответов (чтение отвеченных жестов, сдвиг сроков, запись одним upsert);
+  - выбор набора "Повторить сейчас" (начало индекса по сроку).
+Обе операции читают только нужные строки по индексу: их время почти не
+зависит ни от числа учеников, ни от размера очереди одного ученика.
+
+Запуск: python -m benchmarks.review_scheduler [учеников] [жестов] [замеров]
+"""
+import os
+import random
+import statistics
+import sys
+import tempfile
+import time
+
+import sqlalchemy as sa
+import sqlalchemy.orm as orm
+
+from data import __all_models  # noqa: F401 - регистрирует все модели
+from data.catalog import Catalog, CatalogGesture, CatalogLesson, CatalogModule
+from data.db_session import SqlAlchemyBase
+from data.review import MAX_INTERVAL, REVIEW_SIZE, review_set, schedule_answers
+
+USERS = 100000
+GESTURES = 1000
+SAMPLES = 2000
+ANSWERS_PER_BATCH = 5
+
+
+def build_database(path, users, gestures, now):
+    engine = sa.create_engine(f'sqlite:///{path}')
+    SqlAlchemyBase.metadata.create_all(engine)
+
+    # 10^8 строк генерирует сам SQLite, в порядке первичного ключа - так вставка
+    # идет дописыванием в конец B-дерева
+    raw = engine.raw_connection()
+    try:
+        cursor = raw.cursor()
+        cursor.execute('PRAGMA synchronous = OFF')
+        cursor.execute('PRAGMA journal_mode = OFF')
+        cursor.execute("""
+            WITH RECURSIVE
+                u(id) AS (SELECT 1 UNION ALL SELECT id + 1 FROM u WHERE id < :users),
+                g(id) AS (SELECT 1 UNION ALL SELECT id + 1 FROM g WHERE id < :gestures)
+            INSERT INTO review_items (user_id, gesture_id, due, interval, streak)
+            SELECT u.id, g.id, :now - :max + abs(random()) % (2 * :max), abs(random()) % :max, abs(random()) % 10
+            FROM u CROSS JOIN g
+        """, {'users': users, 'gestures': gestures, 'now': now, 'max': MAX_INTERVAL})
+        raw.commit()
+    finally:
+        raw.close()
+    return engine
+
+
+def percentile(values, share):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * share))]
+
+
+def report(name, timings):
+    timings = [t * 1000 for t in timings]
+    print(f'{name:>28}: p50 {percentile(timings, 0.5):.3f} мс, p99 {percentile(timings, 0.99):.3f} мс, '
+          f'среднее {statistics.mean(timings):.3f} мс')
+
+
+def main():
+    users = int(sys.argv[1]) if len(sys.argv) > 1 else USERS
+    gestures = int(sys.argv[2]) if len(sys.argv) > 2 else GESTURES
+    samples = int(sys.argv[3]) if len(sys.argv) > 3 else SAMPLES
+    now = int(time.time())
+
+    gesture_ids = tuple(range(1, gestures + 1))
+    # Один модуль с одним уроком, в котором весь словарь
+    catalog = Catalog(
+        1,
+        [CatalogModule(1, 'Модуль', None, 1, (1,))],
+        [CatalogLesson(1, 1, 'Урок', 'repeat_old', 1, 0, None, None, gesture_ids)],
+        [CatalogGesture(i, f'Жест {i}', f'{i}.mp4', None) for i in gesture_ids],
+    )
+
+    with tempfile.TemporaryDirectory() as tmp:
+        path = os.path.join(tmp, 'review.db')
+        started = time.perf_counter()
+        engine = build_database(path, users, gestures, now)
+        print(f'учеников: {users}, жестов у каждого: {gestures}, '
+              f'база: {os.path.getsize(path) / 2 ** 20:.0f} МБ '
+              f'({os.path.getsize(path) / users / 1024:.1f} КБ очереди на ученика), '
+              f'подготовка {time.perf_counter() - started:.1f} с')
+
+        factory = orm.sessionmaker(bind=engine)
+        rng = random.Random(7)
+        answer_timings = []
+        review_timings = []
+        for _ in range(samples):
+            user_id = rng.randrange(1, users + 1)
+            answers = [
+                {'gesture_id': rng.randrange(1, gestures + 1), 'is_correct': rng.random() < 0.7}
+                for _ in range(ANSWERS_PER_BATCH)
+            ]
+
+            db_sess = factory()
+            started = time.perf_counter()
+            schedule_answers(db_sess, user_id, answers, catalog, now=now)
+            db_sess.commit()
+            answer_timings.append(time.perf_counter() - started)
+            db_sess.close()
+
+            db_sess = factory()
+            started = time.perf_counter()
+            chosen = review_set(db_sess, user_id, catalog, now=now, limit=REVIEW_SIZE)
+            review_timings.append(time.perf_counter() - started)
+            db_sess.close()
+            if len(chosen) != REVIEW_SIZE:
+                raise SystemExit(f'Набор повторения неполный: {len(chosen)}')
+
+        engine.dispose()
+
+    report(f'пачка из {ANSWERS_PER_BATCH} ответов', answer_timings)
+    report(f'набор из {REVIEW_SIZE} для повторения', review_timings)
+
+
+if __name__ == '__main__':
+    main()
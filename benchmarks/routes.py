@@ -0,0 +1,300 @@
+"""Бенчмарк маршрутов main.py на синтетической базе.
+
+Гоняет /lessons, /progress, /lesson/<id>, /save_answer, /finish_lesson/<id>
+и /errors через тестовый клиент Flask от имени случайных учеников и для
+каждого маршрута считает p50/p95/p99 задержки, пропускную способность в
+одном потоке и число SQL-запросов на запрос. Результаты пишутся в JSON,
+чтобы сравнивать прогоны между собой (--compare прошлый.json).
+
+База: готовая (--db, копируется во временную папку - прогон ее меняет) или
+сгенерированная benchmarks.dataset с параметрами --users, --modules и т.д.
+
+Запуск: python -m benchmarks.routes [--db путь.db] [--requests N] [--output файл.json]
+"""
+import argparse
+import datetime
+import json
+import os
+import platform
+import random
+import sqlite3
+import statistics
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+import sqlalchemy as sa
+
+from benchmarks import dataset
+
+ROUTES = ('lessons', 'progress', 'lesson', 'save_answer', 'finish_lesson', 'errors')
+REQUESTS = 200
+WARMUP = 20
+#насколько p50/p95/p99 может вырасти относительно прошлого прогона без предупреждения
+REGRESSION_THRESHOLD = 0.10
+RESULTS_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'results')
+
+
+def copy_database(source, target):
+    """Копия базы вместе с WAL через backup API sqlite"""
+    src = sqlite3.connect(source)
+    dst = sqlite3.connect(target)
+    try:
+        src.backup(dst)
+    finally:
+        dst.close()
+        src.close()
+
+
+def percentile(values, share):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * share))]
+
+
+class StatementCounter:
+    """Считает SQL-запросы текущего потока (фоновый писатель журнала ответов не в счет)"""
+
+    def __init__(self, engines):
+        self.count = 0
+        self._thread = threading.get_ident()
+        for engine in engines:
+            sa.event.listen(engine, 'before_cursor_execute', self._on_execute)
+
+    def _on_execute(self, *args):
+        if threading.get_ident() == self._thread:
+            self.count += 1
+
+
+class Scenario:
+    """Запросы одного маршрута от имени случайных учеников"""
+
+    def __init__(self, catalog, available, rng):
+        self.catalog = catalog
+        self.available = available  #user_id -> id доступных уроков с жестами
+        self.user_ids = sorted(available)
+        self.rng = rng
+        self.answer_number = 0
+
+    def request(self, route):
+        """(user_id, метод, url, json) очередного запроса"""
+        user_id = self.rng.choice(self.user_ids)
+        if route == 'lessons':
+            return user_id, 'GET', '/lessons', None
+        if route == 'progress':
+            return user_id, 'GET', '/progress', None
+        if route == 'errors':
+            return user_id, 'GET', '/errors', None
+
+        lesson = self.catalog.get_lesson(self.rng.choice(self.available[user_id]))
+        if route == 'lesson':
+            number = self.rng.randrange(1, len(lesson.gesture_ids) + 1)
+            return user_id, 'GET', f'/lesson/{lesson.id}?question={number}', None
+        if route == 'finish_lesson':
+            return user_id, 'GET', f'/finish_lesson/{lesson.id}', None
+
+        gesture_id = self.rng.choice(lesson.gesture_ids)
+        is_correct = self.rng.random() < 0.75
+        wrong = self.catalog.get_gesture(self.rng.choice(lesson.gesture_ids)).word
+        return user_id, 'POST', '/save_answer', {
+            'lesson_id': lesson.id,
+            'gesture_id': gesture_id,
+            'is_correct': is_correct,
+            'selected_answer': None if is_correct else wrong,
+        }
+
+
+def available_lessons(db_sess, catalog, user_ids):
+    """Доступные каждому ученику уроки, в которых есть жесты"""
+    from data.lesson_status import resolve_lesson_statuses
+
+    available = {}
+    for user_id in user_ids:
+        statuses = resolve_lesson_statuses(db_sess, user_id, catalog)
+        lesson_ids = [
+            lesson_id for lesson_id, status in statuses.items()
+            if status['available'] and catalog.get_lesson(lesson_id).gesture_ids
+        ]
+        if lesson_ids:
+            available[user_id] = lesson_ids
+    return available
+
+
+def summarize(timings, statements, statuses):
+    timings_ms = [t * 1000 for t in timings]
+    return {
+        'requests': len(timings),
+        'p50_ms': round(percentile(timings_ms, 0.50), 3),
+        'p95_ms': round(percentile(timings_ms, 0.95), 3),
+        'p99_ms': round(percentile(timings_ms, 0.99), 3),
+        'mean_ms': round(statistics.mean(timings_ms), 3),
+        'max_ms': round(max(timings_ms), 3),
+        'throughput_rps': round(len(timings) / sum(timings), 1),
+        'sql_per_request': round(statistics.mean(statements), 2),
+        'sql_max': max(statements),
+        'statuses': {str(code): statuses.count(code) for code in sorted(set(statuses))},
+    }
+
+
+def run(db_path, routes, requests, warmup, seed, write_behind):
+    """Прогоняет маршруты и возвращает результаты по каждому"""
+    work_dir = os.path.dirname(db_path)
+    # main подключается к базе при импорте, поэтому окружение - до импорта
+    os.environ['DB_PATH'] = db_path
+    os.environ['ANSWER_WRITE_BEHIND'] = '1' if write_behind else '0'
+    os.environ['ANSWER_LOG_DIR'] = os.path.join(work_dir, 'answer_log')
+    import main
+    from data import db_session
+    from data.catalog import get_catalog
+
+    app = main.app
+    catalog = get_catalog()
+
+    db_sess = db_session.create_read_session()
+    try:
+        user_ids = [user_id for (user_id,) in db_sess.execute(sa.text('SELECT id FROM users'))]
+        available = available_lessons(db_sess, catalog, user_ids)
+        engines = [db_session.create_session().get_bind(), db_sess.get_bind()]
+    finally:
+        db_sess.close()
+    if not available:
+        raise SystemExit('В базе нет учеников с доступными уроками')
+
+    counter = StatementCounter(engines)
+    client = app.test_client()
+    results = {}
+    for route in routes:
+        scenario = Scenario(catalog, available, random.Random(f'{seed}:{route}'))
+        timings, statements, statuses = [], [], []
+        for number in range(warmup + requests):
+            user_id, method, url, payload = scenario.request(route)
+            with client.session_transaction() as session:
+                session['_user_id'] = str(user_id)
+                session['_fresh'] = True
+
+            before = counter.count
+            started = time.perf_counter()
+            response = client.open(url, method=method, json=payload)
+            elapsed = time.perf_counter() - started
+            response.close()
+            if number < warmup:
+                continue
+            timings.append(elapsed)
+            statements.append(counter.count - before)
+            statuses.append(response.status_code)
+        results[route] = summarize(timings, statements, statuses)
+
+    if write_behind:
+        main.answer_log.stop()
+    return results
+
+
+def git_revision():
+    try:
+        return subprocess.run(
+            ['git', 'rev-parse', '--short', 'HEAD'], capture_output=True, text=True, check=True,
+            cwd=os.path.dirname(os.path.abspath(__file__))
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def print_results(results):
+    print(f"{'маршрут':>14} {'p50':>8} {'p95':>8} {'p99':>8} {'req/s':>8} {'SQL':>6}  статусы")
+    for route, r in results.items():
+        print(f"{route:>14} {r['p50_ms']:>8.2f} {r['p95_ms']:>8.2f} {r['p99_ms']:>8.2f} "
+              f"{r['throughput_rps']:>8.1f} {r['sql_per_request']:>6.1f}  {r['statuses']}")
+
+
+def compare(previous, results):
+    """Печатает изменения относительно прошлого прогона. Возвращает число регрессий"""
+    regressions = 0
+    print(f"сравнение с {previous.get('created')} ({previous.get('git') or 'без git'}):")
+    for route, r in results.items():
+        old = previous.get('routes', {}).get(route)
+        if old is None:
+            continue
+        changes = []
+        for metric in ('p50_ms', 'p95_ms', 'p99_ms'):
+            change = (r[metric] - old[metric]) / old[metric] if old[metric] else 0.0
+            mark = ''
+            if change > REGRESSION_THRESHOLD:
+                mark = ' !'
+                regressions += 1
+            changes.append(f'{metric[:3]} {change:+.0%}{mark}')
+        sql_change = r['sql_per_request'] - old['sql_per_request']
+        if sql_change > 0:
+            regressions += 1
+        changes.append(f'SQL {sql_change:+.1f}' + (' !' if sql_change > 0 else ''))
+        print(f'{route:>14}: ' + ', '.join(changes))
+    return regressions
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Бенчмарк маршрутов на синтетической базе')
+    parser.add_argument('--db', help='готовая база (по умолчанию генерируется заново)')
+    parser.add_argument('--requests', type=int, default=REQUESTS, help='замеров на маршрут')
+    parser.add_argument('--warmup', type=int, default=WARMUP, help='запросов на прогрев, не в замерах')
+    parser.add_argument('--routes', default=','.join(ROUTES), help='маршруты через запятую')
+    parser.add_argument('--write-behind', action='store_true', help='ответы через журнал отложенной записи')
+    parser.add_argument('--output', help='файл результатов (по умолчанию benchmarks/results/routes-<время>.json)')
+    parser.add_argument('--compare', help='результаты прошлого прогона для сравнения')
+    dataset.add_arguments(parser)
+    args = parser.parse_args(argv)
+
+    routes = [route for route in args.routes.split(',') if route]
+    unknown = set(routes) - set(ROUTES)
+    if unknown:
+        parser.error(f'неизвестные маршруты: {", ".join(sorted(unknown))}')
+
+    with tempfile.TemporaryDirectory() as tmp:
+        db_path = os.path.join(tmp, 'bench.db')
+        started = time.perf_counter()
+        if args.db:
+            copy_database(args.db, db_path)
+            scale = None
+        else:
+            scale = dataset.scale_from_args(args)
+            dataset.generate(db_path, **scale)
+        counts = dataset.table_counts(db_path)
+        print(f"база: учеников {counts.get('users', 0)}, уроков {counts.get('lessons', 0)}, "
+              f"жестов {counts.get('gestures', 0)}, подготовка {time.perf_counter() - started:.1f} с")
+
+        results = run(db_path, routes, args.requests, args.warmup, args.seed, args.write_behind)
+
+    report = {
+        'created': datetime.datetime.now().isoformat(timespec='seconds'),
+        'git': git_revision(),
+        'python': platform.python_version(),
+        'sqlite': sqlite3.sqlite_version,
+        'settings': {
+            'db': args.db,
+            'scale': scale,
+            'requests': args.requests,
+            'warmup': args.warmup,
+            'write_behind': args.write_behind,
+            'seed': args.seed,
+        },
+        'tables': counts,
+        'routes': results,
+    }
+    print_results(results)
+
+    output = args.output
+    if output is None:
+        os.makedirs(RESULTS_DIR, exist_ok=True)
+        output = os.path.join(RESULTS_DIR, f"routes-{report['created'].replace(':', '')}.json")
+    with open(output, 'w', encoding='utf-8') as f:
+        json.dump(report, f, ensure_ascii=False, indent=2)
+    print(f'результаты: {output}')
+
+    if args.compare:
+        with open(args.compare, encoding='utf-8') as f:
+            regressions = compare(json.load(f), results)
+        return 1 if regressions else 0
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
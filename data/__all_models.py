@@ -4,4 +4,15 @@ from . import lesson
 from . import gesture
 from . import lesson_gesture
 from . import user_mistake
-from . import user_progress
\ No newline at end of file
+from . import user_progress
+from . import user_lesson
+from . import content_version
+from . import answer_receipt
+from . import review_item
+from . import user_state
+from . import gesture_rollup
+from . import lesson_rollup
+from . import module_histogram
+from . import leaderboard_score
+from . import leaderboard_bucket
+from . import distractor_weight
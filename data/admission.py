@@ -0,0 +1,190 @@
+"""Ограничение нагрузки на пишущие маршруты.
+
+Когда вся школа начинает урок одновременно, запросы записи выстраиваются
+в очередь к единственному писателю SQLite, и если пускать их все, ждать
+будут все потоки сервера - вместе с чтением страниц. Поэтому каждый
+пишущий маршрут проходит через ворота (Gate):
+  - одновременно выполняется не больше concurrency запросов маршрута;
+  - еще не больше queue_size ждут своей очереди, но не дольше deadline
+    секунд - потом получают 503;
+  - если и очередь полна, 503 отдается сразу, без ожидания.
+Так запросы записи занимают не больше concurrency + queue_size потоков на
+маршрут, и остальные потоки свободны для чтения.
+
+Кроме того, у каждого ученика своя корзина токенов (TokenBuckets) на все
+пишущие маршруты: rate запросов в секунду и запас burst. Кто присылает
+запросы чаще, получает 429. В обоих случаях в ответе заголовок Retry-After.
+Токен запроса, отклоненного воротами, возвращается в корзину: повтор после
+503 не должен приближать ученика к 429.
+
+Сколько запросов пропущено и отклонено (и почему), видно в /metrics.
+"""
+import math
+import threading
+import time
+from collections import OrderedDict
+from contextlib import contextmanager
+
+#запросов маршрута, выполняемых одновременно: писатель у SQLite один, остальные ждут блокировку
+DEFAULT_CONCURRENCY = 2
+#запросов маршрута, ждущих в очереди
+DEFAULT_QUEUE_SIZE = 32
+#сколько секунд запрос может ждать в очереди
+DEFAULT_DEADLINE = 2.0
+#запросов записи в секунду от одного ученика и запас на всплеск; rate 0 - без ограничения
+DEFAULT_USER_RATE = 2.0
+DEFAULT_USER_BURST = 20
+#корзин скольких учеников держим в памяти (давно не писавшие вытесняются)
+MAX_TRACKED_USERS = 100000
+
+QUEUE_FULL = 'queue_full'
+DEADLINE = 'deadline'
+RATE_LIMITED = 'rate_limited'
+
+
+class Rejected(Exception):
+    """Запрос не пропущен: status (429 или 503) и через сколько секунд повторить"""
+
+    def __init__(self, status, reason, retry_after):
+        super().__init__(reason)
+        self.status = status
+        self.reason = reason
+        self.retry_after = max(1, math.ceil(retry_after))
+
+
+class Gate:
+    """Ограничение одновременных запросов маршрута с очередью ожидания"""
+
+    def __init__(self, name, concurrency=DEFAULT_CONCURRENCY, queue_size=DEFAULT_QUEUE_SIZE,
+                 deadline=DEFAULT_DEADLINE):
+        self.name = name
+        self.concurrency = concurrency
+        self.queue_size = queue_size
+        self.deadline = deadline
+        self.active = 0
+        self.waiting = 0
+        self._condition = threading.Condition()
+
+    def acquire(self):
+        with self._condition:
+            if self.active < self.concurrency and not self.waiting:
+                self.active += 1
+                return
+            if self.waiting >= self.queue_size:
+                raise Rejected(503, QUEUE_FULL, self.deadline)
+
+            self.waiting += 1
+            try:
+                admitted = self._condition.wait_for(lambda: self.active < self.concurrency, self.deadline)
+                if not admitted:
+                    raise Rejected(503, DEADLINE, self.deadline)
+                self.active += 1
+            finally:
+                self.waiting -= 1
+
+    def release(self):
+        with self._condition:
+            self.active -= 1
+            self._condition.notify()
+
+
+class TokenBuckets:
+    """Корзины токенов по ключу (id ученика)"""
+
+    def __init__(self, rate=DEFAULT_USER_RATE, burst=DEFAULT_USER_BURST, max_keys=MAX_TRACKED_USERS):
+        self.rate = rate
+        self.burst = burst
+        self.max_keys = max_keys
+        self._buckets = OrderedDict()  #ключ -> (токенов, время пополнения)
+        self._lock = threading.Lock()
+
+    def take(self, key, now=None):
+        """Берет токен. Возвращает 0 или сколько секунд ждать следующего токена"""
+        if not self.rate:
+            return 0
+        now = time.monotonic() if now is None else now
+        with self._lock:
+            tokens, updated = self._buckets.pop(key, (self.burst, now))
+            tokens = min(self.burst, tokens + (now - updated) * self.rate)
+            wait = 0
+            if tokens >= 1:
+                tokens -= 1
+            else:
+                wait = (1 - tokens) / self.rate
+            self._buckets[key] = (tokens, now)
+            while len(self._buckets) > self.max_keys:
+                self._buckets.popitem(last=False)
+            return wait
+
+    def refund(self, key):
+        """Возвращает токен, взятый запросом, который так и не выполнился"""
+        if not self.rate:
+            return
+        with self._lock:
+            bucket = self._buckets.get(key)
+            if bucket is not None:
+                tokens, updated = bucket
+                self._buckets[key] = (min(self.burst, tokens + 1), updated)
+
+
+class AdmissionControl:
+    """Ворота пишущих маршрутов, корзины учеников и счетчики для /metrics"""
+
+    def __init__(self, buckets=None):
+        self.buckets = buckets or TokenBuckets()
+        self.gates = {}
+        self.admitted = {}  #маршрут -> пропущено
+        self.shed = {}  #(маршрут, причина) -> отклонено
+        self.wait_seconds = {}  #маршрут -> суммарное ожидание в очереди
+        self._lock = threading.Lock()
+
+    def add_gate(self, name, concurrency=DEFAULT_CONCURRENCY, queue_size=DEFAULT_QUEUE_SIZE,
+                 deadline=DEFAULT_DEADLINE):
+        self.gates[name] = Gate(name, concurrency, queue_size, deadline)
+        return self.gates[name]
+
+    def _count(self, counters, key, value=1):
+        with self._lock:
+            counters[key] = counters.get(key, 0) + value
+
+    @contextmanager
+    def admit(self, name, user_id):
+        """Выполняет тело, если запрос пропущен, иначе поднимает Rejected"""
+        gate = self.gates[name]
+        wait = self.buckets.take(user_id)
+        if wait:
+            self._count(self.shed, (name, RATE_LIMITED))
+            raise Rejected(429, RATE_LIMITED, wait)
+
+        started = time.perf_counter()
+        try:
+            gate.acquire()
+        except Rejected as e:
+            #отказ воротами - не вина ученика, токен ему возвращается
+            self.buckets.refund(user_id)
+            self._count(self.shed, (name, e.reason))
+            raise
+        self._count(self.admitted, name)
+        self._count(self.wait_seconds, name, time.perf_counter() - started)
+        try:
+            yield
+        finally:
+            gate.release()
+
+    def _snapshot(self, counters):
+        with self._lock:
+            return dict(counters)
+
+    def register_metrics(self, registry):
+        registry.register_gauge('admission_admitted_total', 'Пропущенные запросы записи по маршрутам',
+                                lambda: self._snapshot(self.admitted), 'counter')
+        registry.register_gauge('admission_shed_total', 'Отклоненные запросы записи (маршрут:причина)',
+                                lambda: {f'{name}:{reason}': n for (name, reason), n in self._snapshot(self.shed).items()},
+                                'counter')
+        registry.register_gauge('admission_wait_seconds_total', 'Время ожидания в очереди по маршрутам',
+                                lambda: {name: f'{s:.6f}' for name, s in self._snapshot(self.wait_seconds).items()},
+                                'counter')
+        registry.register_gauge('admission_active', 'Выполняющиеся запросы записи',
+                                lambda: {name: gate.active for name, gate in self.gates.items()})
+        registry.register_gauge('admission_waiting', 'Запросы записи в очереди',
+                                lambda: {name: gate.waiting for name, gate in self.gates.items()})
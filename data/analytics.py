@@ -0,0 +1,174 @@
+"""Аналитика для учителя по готовым итогам.
+
+Итоги хранятся в трех маленьких таблицах с областью scope - названием
+класса ученика или ALL_STUDENTS ('') для всех учеников сразу:
+  - gesture_rollups: ответы, правильные ответы и ошибки по жесту;
+  - lesson_rollups: ответы и прохождения по уроку;
+  - module_histograms: сколько учеников прошли k уроков модуля.
+Итоги меняются вместе с данными ученика в той же транзакции: ответы - в
+apply_answers, прохождение урока - в complete_lesson. Отчет читает только
+итоги, поэтому его стоимость зависит от размера курса, а не от числа учеников.
+
+Ответы по жестам считаются с момента появления итогов; ошибки, уроки и
+прохождения заполнены миграцией по накопленным данным.
+"""
+from collections import Counter
+
+import sqlalchemy as sa
+from sqlalchemy.dialects.sqlite import insert
+
+from .gesture_rollup import GestureRollup
+from .lesson_rollup import LessonRollup
+from .module_histogram import ModuleHistogram
+from .users import User
+
+ALL_STUDENTS = ''
+HARDEST_GESTURES = 20
+
+
+def user_scopes(db_sess, user_id):
+    """Области итогов ученика: все ученики и его класс"""
+    class_name = db_sess.query(User.class_name).filter(User.id == user_id).scalar()
+    return (ALL_STUDENTS, class_name) if class_name else (ALL_STUDENTS,)
+
+
+def _increment(stmt, column):
+    return column + stmt.excluded[column.key]
+
+
+def record_answers(db_sess, user_id, answers, catalog):
+    """Добавляет пачку ответов к итогам по жестам и урокам. Коммит за вызывающим кодом"""
+    gesture_answers, gesture_correct = Counter(), Counter()
+    lesson_answers, lesson_correct = Counter(), Counter()
+    for answer in answers:
+        lesson_answers[answer['lesson_id']] += 1
+        lesson_correct[answer['lesson_id']] += answer['is_correct']
+        if catalog.get_gesture(answer['gesture_id']):
+            gesture_answers[answer['gesture_id']] += 1
+            gesture_correct[answer['gesture_id']] += answer['is_correct']
+    scopes = user_scopes(db_sess, user_id)
+
+    if gesture_answers:
+        stmt = insert(GestureRollup).values([
+            {
+                'scope': scope,
+                'gesture_id': gesture_id,
+                'answers': total,
+                'correct': gesture_correct[gesture_id],
+                'mistakes': total - gesture_correct[gesture_id],
+            }
+            for scope in scopes
+            for gesture_id, total in gesture_answers.items()
+        ])
+        db_sess.execute(stmt.on_conflict_do_update(
+            index_elements=['scope', 'gesture_id'],
+            set_={column.key: _increment(stmt, column)
+                  for column in (GestureRollup.answers, GestureRollup.correct, GestureRollup.mistakes)}
+        ))
+
+    stmt = insert(LessonRollup).values([
+        {
+            'scope': scope,
+            'lesson_id': lesson_id,
+            'correct_answers': lesson_correct[lesson_id],
+            'total_answers': total,
+            'completions': 0,
+        }
+        for scope in scopes
+        for lesson_id, total in lesson_answers.items()
+    ])
+    db_sess.execute(stmt.on_conflict_do_update(
+        index_elements=['scope', 'lesson_id'],
+        set_={column.key: _increment(stmt, column)
+              for column in (LessonRollup.correct_answers, LessonRollup.total_answers)}
+    ))
+
+
+def record_completion(db_sess, user_id, lesson, completed_lessons):
+    """Учитывает первое прохождение урока: ученик переходит в корзину completed_lessons модуля"""
+    scopes = user_scopes(db_sess, user_id)
+
+    stmt = insert(LessonRollup).values([
+        {'scope': scope, 'lesson_id': lesson.id, 'correct_answers': 0, 'total_answers': 0, 'completions': 1}
+        for scope in scopes
+    ])
+    db_sess.execute(stmt.on_conflict_do_update(
+        index_elements=['scope', 'lesson_id'],
+        set_={'completions': _increment(stmt, LessonRollup.completions)}
+    ))
+
+    stmt = insert(ModuleHistogram).values([
+        {'scope': scope, 'module_id': lesson.module_id, 'completed_lessons': completed_lessons, 'students': 1}
+        for scope in scopes
+    ])
+    db_sess.execute(stmt.on_conflict_do_update(
+        index_elements=['scope', 'module_id', 'completed_lessons'],
+        set_={'students': _increment(stmt, ModuleHistogram.students)}
+    ))
+    if completed_lessons > 1:
+        db_sess.execute(
+            sa.update(ModuleHistogram)
+            .where(
+                ModuleHistogram.scope.in_(scopes),
+                ModuleHistogram.module_id == lesson.module_id,
+                ModuleHistogram.completed_lessons == completed_lessons - 1,
+            )
+            .values(students=sa.func.max(ModuleHistogram.students - 1, 0))
+        )
+
+
+def class_names(db_sess):
+    """Классы, по которым есть итоги"""
+    query = db_sess.query(LessonRollup.scope).filter(LessonRollup.scope != ALL_STUDENTS).distinct()
+    return sorted(scope for (scope,) in query)
+
+
+def _accuracy(correct, total):
+    return round(correct * 100.0 / total, 1) if total else None
+
+
+def class_report(db_sess, catalog, scope=ALL_STUDENTS, hardest=HARDEST_GESTURES):
+    """Отчет по классу для страницы учителя и JSON: три запроса к итогам"""
+    gestures = []
+    rows = db_sess.query(GestureRollup).filter(
+        GestureRollup.scope == scope, GestureRollup.mistakes > 0
+    ).order_by(GestureRollup.mistakes.desc(), GestureRollup.gesture_id).limit(hardest)
+    for row in rows:
+        gesture = catalog.get_gesture(row.gesture_id)
+        gestures.append({
+            'gesture_id': row.gesture_id,
+            'word': gesture.word if gesture else None,
+            'mistakes': row.mistakes,
+            'answers': row.answers,
+            'accuracy': _accuracy(row.correct, row.answers),
+        })
+
+    lesson_rows = {
+        row.lesson_id: row for row in db_sess.query(LessonRollup).filter(LessonRollup.scope == scope)
+    }
+    histograms = {}
+    for row in db_sess.query(ModuleHistogram).filter(ModuleHistogram.scope == scope, ModuleHistogram.students > 0):
+        histograms.setdefault(row.module_id, {})[row.completed_lessons] = row.students
+
+    modules = []
+    for module in catalog.modules:
+        lessons = []
+        for lesson in catalog.module_lessons(module.id):
+            row = lesson_rows.get(lesson.id)
+            lessons.append({
+                'lesson_id': lesson.id,
+                'title': lesson.title,
+                'total_answers': row.total_answers if row else 0,
+                'accuracy': _accuracy(row.correct_answers, row.total_answers) if row else None,
+                'completions': row.completions if row else 0,
+            })
+        histogram = histograms.get(module.id, {})
+        modules.append({
+            'module_id': module.id,
+            'title': module.title,
+            'lessons': lessons,
+            #учеников, прошедших ровно k уроков модуля, k = 1..число уроков
+            'completion_histogram': [histogram.get(k, 0) for k in range(1, len(module.lesson_ids) + 1)],
+        })
+
+    return {'class': scope or None, 'hardest_gestures': gestures, 'modules': modules}
@@ -0,0 +1,310 @@
+"""Отложенная запись ответов (write-behind).
+
+Ответ сначала дописывается в локальный журнал (JSON-строки, fsync) и
+сразу подтверждается клиенту. Фоновый поток раз в flush_interval секунд
+забирает все накопленные ответы и применяет их в базе одной транзакцией.
+
+Журнал разбит на сегменты: при каждом сбросе процесс начинает новый
+сегмент, а старый удаляет только после коммита. Сегменты, оставшиеся
+после падения процесса, проигрываются при следующем старте. Повторное
+применение безопасно, потому что у каждого ответа есть ключ
+идемпотентности (см. data/answers.py).
+
+Если пачка не применяется не из-за недоступной базы, а из-за самих
+записей, она делится по пользователям, а затем по одной записи. Записи,
+которые не применяются и поодиночке, откладываются в dead-letter.log
+рядом с сегментами, чтобы одна плохая запись не останавливала сброс
+ответов всех учеников.
+"""
+import glob
+import json
+import logging
+import os
+import threading
+import time
+import uuid
+
+from sqlalchemy.exc import OperationalError
+
+try:
+    import fcntl
+except ImportError:  # Windows: блокировок нет, сегменты других процессов не различаем
+    fcntl = None
+
+from . import db_session
+from .answers import apply_answers, prune_receipts, PRUNE_BATCH_SIZE
+from .catalog import get_catalog
+
+log = logging.getLogger(__name__)
+
+#как часто (в секундах) фоновый поток удаляет устаревшие ключи идемпотентности
+PRUNE_INTERVAL = 3600.0
+
+#файл записей, которые не удалось применить (JSON-строки: запись и ошибка)
+DEAD_LETTER_FILE = 'dead-letter.log'
+
+
+def _lock(fh):
+    """Берет эксклюзивную блокировку сегмента, False - если им владеет живой процесс"""
+    if fcntl is None:
+        return True
+    try:
+        fcntl.flock(fh.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
+        return True
+    except OSError:
+        return False
+
+
+def _read_segment(path):
+    records = []
+    # Битые байты в оборванной строке не должны мешать прочитать остальные
+    with open(path, encoding='utf-8', errors='replace') as fh:
+        for line in fh:
+            line = line.strip()
+            if not line:
+                continue
+            try:
+                records.append(json.loads(line))
+            except ValueError:
+                # Оборванная последняя строка после падения - ответ не был подтвержден
+                continue
+    return records
+
+
+def _record_user(record):
+    return record.get('user_id') if isinstance(record, dict) else None
+
+
+def apply_records(db_sess, records):
+    """Применяет записи журнала, сгруппировав их по пользователям"""
+    by_user = {}
+    for record in records:
+        by_user.setdefault(record['user_id'], []).append(record['answer'])
+
+    catalog = get_catalog()
+    applied = 0
+    for user_id, answers in by_user.items():
+        applied += apply_answers(db_sess, user_id, answers, catalog)
+    return applied
+
+
+class AnswerLog:
+    def __init__(self, directory, flush_interval=0.5, fsync=True):
+        self.directory = directory
+        self.flush_interval = flush_interval
+        self.fsync = fsync
+
+        self._lock = threading.Lock()
+        self._wakeup = threading.Event()
+        self._stopped = threading.Event()
+        self._thread = None
+
+        self._segment = None  #открытый файл текущего сегмента
+        self._segment_no = 0
+        self._pending = []  #записи, еще не примененные в базе
+        self._inflight = []  #записи, которые сейчас применяются в базе
+        self._retired = []  #закрытые для записи сегменты, чьи записи еще не в базе
+        self.dead_letters = 0  #сколько записей отложено в DEAD_LETTER_FILE
+
+    # --- запись ---
+
+    def _open_segment(self):
+        self._segment_no += 1
+        path = os.path.join(self.directory, f'answers-{os.getpid()}-{self._segment_no}.log')
+        self._segment = open(path, 'a', encoding='utf-8')
+        _lock(self._segment)
+
+    def append(self, user_id, answers):
+        """Надежно записывает ответы в журнал. После возврата их можно подтверждать"""
+        records = []
+        for answer in answers:
+            if answer.get('key') is None:
+                # Ключ нужен, чтобы проигрывание журнала было идемпотентным
+                answer = dict(answer, key=f'srv-{uuid.uuid4().hex}')
+            records.append({'user_id': user_id, 'answer': answer})
+
+        data = ''.join(json.dumps(r, ensure_ascii=False) + '\n' for r in records)
+        with self._lock:
+            if self._segment is None:
+                self._open_segment()
+            self._segment.write(data)
+            self._segment.flush()
+            if self.fsync:
+                os.fsync(self._segment.fileno())
+            self._pending.extend(records)
+        return [r['answer']['key'] for r in records]
+
+    def pending_for_user(self, user_id):
+        """Ответы пользователя, которые еще не попали в базу (для чтения своих записей).
+
+        Видны только ответы, принятые этим процессом. При нескольких воркерах
+        ответ, принятый другим воркером, появится после его сброса в базу -
+        не позже чем через flush_interval, если база доступна.
+        """
+        with self._lock:
+            records = self._inflight + self._pending
+        seen = set()
+        answers = []
+        for record in records:
+            answer = record['answer']
+            if record['user_id'] == user_id and answer['key'] not in seen:
+                seen.add(answer['key'])
+                answers.append(answer)
+        return answers
+
+    def pending_totals(self, user_id):
+        """Неучтенные в базе ответы пользователя по модулям: {module_id: (всего, правильных)}.
+
+        Как и pending_for_user, только ответы этого процесса.
+        """
+        totals = {}
+        for answer in self.pending_for_user(user_id):
+            total, correct = totals.get(answer['module_id'], (0, 0))
+            totals[answer['module_id']] = (total + 1, correct + (1 if answer['is_correct'] else 0))
+        return totals
+
+    # --- сброс в базу ---
+
+    def _dead_letter(self, records, error):
+        path = os.path.join(self.directory, DEAD_LETTER_FILE)
+        data = ''.join(
+            json.dumps({'record': record, 'error': repr(error)}, ensure_ascii=False, default=str) + '\n'
+            for record in records
+        )
+        with open(path, 'a', encoding='utf-8') as fh:
+            fh.write(data)
+            fh.flush()
+            if self.fsync:
+                os.fsync(fh.fileno())
+        self.dead_letters += len(records)
+        log.error("Записей журнала ответов отложено в %s: %s (%r)", path, len(records), error)
+
+    def _apply(self, records):
+        """Применяет записи, откладывая те, что не применяются и поодиночке.
+
+        OperationalError (база недоступна или занята) пробрасывается: дело не
+        в записях, их нужно повторить позже.
+        """
+        try:
+            db_session.transaction(apply_records, records)
+            return
+        except OperationalError:
+            raise
+        except Exception as e:
+            if len(records) == 1:
+                self._dead_letter(records, e)
+                return
+            log.warning("Пачка журнала ответов не применилась (%r), применяем по частям", e)
+
+        by_user = {}
+        for record in records:
+            by_user.setdefault(_record_user(record), []).append(record)
+        parts = list(by_user.values()) if len(by_user) > 1 else [[record] for record in records]
+        for part in parts:
+            self._apply(part)
+
+    def flush(self):
+        """Применяет все накопленные ответы одной транзакцией. Возвращает число записей"""
+        with self._lock:
+            if not self._pending:
+                return 0
+            records = self._pending
+            self._pending = []
+            self._inflight = records
+            # Следующий сегмент откроет append. После неудачного сброса текущий
+            # сегмент не сменяем, иначе каждая попытка оставляла бы открытый файл
+            if not self._retired and self._segment is not None:
+                self._retired = [self._segment]
+                self._segment = None
+            segments = self._retired
+            self._retired = []
+
+        try:
+            self._apply(records)
+        except Exception:
+            with self._lock:
+                # Сегменты остаются на диске, записи вернутся в очередь и применятся позже
+                self._pending = records + self._pending
+                self._retired = segments + self._retired
+                self._inflight = []
+            raise
+
+        with self._lock:
+            self._inflight = []
+        for segment in segments:
+            segment.close()
+            os.remove(segment.name)
+        return len(records)
+
+    def recover(self):
+        """Проигрывает сегменты, оставшиеся от упавших процессов"""
+        recovered = 0
+        for path in sorted(glob.glob(os.path.join(self.directory, 'answers-*.log'))):
+            if self._segment is not None and os.path.abspath(path) == os.path.abspath(self._segment.name):
+                continue
+            with open(path, 'a', encoding='utf-8') as fh:
+                if not _lock(fh):
+                    continue  #сегмент живого процесса
+                records = _read_segment(path)
+                try:
+                    if records:
+                        self._apply(records)
+                except OperationalError:
+                    log.exception("Сегмент %s не восстановлен, повтор при следующем старте", path)
+                    continue
+            os.remove(path)
+            recovered += len(records)
+        if recovered:
+            log.info("Восстановлено ответов из журнала: %s", recovered)
+        return recovered
+
+    def prune(self):
+        """Удаляет устаревшие ключи идемпотентности небольшими транзакциями"""
+        pruned = 0
+        while True:
+            deleted = db_session.transaction(prune_receipts)
+            pruned += deleted
+            if deleted < PRUNE_BATCH_SIZE or self._stopped.is_set():
+                break
+        if pruned:
+            log.info("Удалено устаревших ключей ответов: %s", pruned)
+        return pruned
+
+    def _run(self):
+        pruned_at = 0.0
+        while not self._stopped.is_set():
+            self._wakeup.wait(self.flush_interval)
+            self._wakeup.clear()
+            try:
+                self.flush()
+            except Exception:
+                log.exception("Ошибка при сбросе журнала ответов")
+            if time.monotonic() - pruned_at >= PRUNE_INTERVAL:
+                pruned_at = time.monotonic()
+                try:
+                    self.prune()
+                except Exception:
+                    log.exception("Ошибка при удалении старых ключей ответов")
+
+    def start(self):
+        """Восстанавливает старые сегменты и запускает фоновый сброс"""
+        if self._thread is not None:
+            return
+        os.makedirs(self.directory, exist_ok=True)
+        # Старт приложения не должен зависеть от старых сегментов: не восстановленные останутся на диске
+        try:
+            self.recover()
+        except Exception:
+            log.exception("Ошибка при восстановлении журнала ответов")
+        self._thread = threading.Thread(target=self._run, name='answer-log-flusher', daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        """Останавливает фоновый поток и сбрасывает остаток"""
+        if self._thread is None:
+            return
+        self._stopped.set()
+        self._wakeup.set()
+        self._thread.join()
+        self._thread = None
+        self.flush()
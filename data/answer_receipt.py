@@ -0,0 +1,14 @@
+import datetime
+import sqlalchemy as sa
+from sqlalchemy import ForeignKey
+from .db_session import SqlAlchemyBase
+
+class AnswerReceipt(SqlAlchemyBase):
+    """Ключ идемпотентности уже учтенного ответа, чтобы повтор запроса не считался дважды"""
+    __tablename__ = 'answer_receipts'
+    __table_args__ = (sa.UniqueConstraint('user_id', 'idempotency_key', name='uq_answer_receipts_user_key'),)
+
+    id = sa.Column(sa.Integer, primary_key=True, autoincrement=True)
+    user_id = sa.Column(sa.Integer, ForeignKey('users.id'), nullable=False)
+    idempotency_key = sa.Column(sa.String(64), nullable=False) #генерируется на клиенте для каждого ответа
+    created_at = sa.Column(sa.DateTime, default=datetime.datetime.now, index=True) #старые ключи удаляет prune_receipts
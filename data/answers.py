@@ -0,0 +1,248 @@
+"""Учет ответов пользователя.
+
+Пачка ответов применяется в одной транзакции: счетчики UserLesson и
+UserProgress и ошибки UserMistake обновляются одним проходом атомарными
+upsert-запросами. У каждого ответа может быть ключ идемпотентности -
+повторно присланный ответ с тем же ключом не учитывается второй раз.
+"""
+import datetime
+from collections import Counter
+
+import sqlalchemy as sa
+from sqlalchemy.dialects.sqlite import insert
+
+from . import analytics
+from . import distractors
+from . import leaderboard
+from .answer_receipt import AnswerReceipt
+from .render_cache import bump_state_version
+from .review import schedule_answers
+from .user_lesson import UserLesson
+from .user_mistake import UserMistake
+from .user_progress import UserProgress
+
+#максимальное число ответов в одном запросе /save_answers
+MAX_BATCH_SIZE = 200
+MAX_KEY_LENGTH = 64
+#сколько дней хранятся ключи идемпотентности: дольше клиент ответ не повторяет
+RECEIPT_TTL_DAYS = 7
+#ключей, удаляемых одной транзакцией, чтобы не держать блокировку записи долго
+PRUNE_BATCH_SIZE = 5000
+
+
+class AnswerError(ValueError):
+    """Некорректный ответ в пачке"""
+
+
+def is_id(value):
+    """Целый id из JSON: True и False в Python тоже int, но id не являются"""
+    return isinstance(value, int) and not isinstance(value, bool)
+
+
+def parse_answer(data, catalog, require_key=True):
+    """Проверяет один ответ из JSON и приводит его к словарю с нужными полями"""
+    if not isinstance(data, dict):
+        raise AnswerError('Ответ должен быть объектом')
+
+    key = data.get('key')
+    if require_key or key is not None:
+        if not isinstance(key, str) or not key or len(key) > MAX_KEY_LENGTH:
+            raise AnswerError('Нужен ключ ответа длиной до 64 символов')
+
+    lesson_id, gesture_id = data.get('lesson_id'), data.get('gesture_id')
+    # Только целые id: список или словарь в JSON сломал бы поиск в каталоге уже при записи в базу
+    lesson = catalog.get_lesson(lesson_id) if is_id(lesson_id) else None
+    if not lesson:
+        raise AnswerError('Урок не найден')
+    if not is_id(gesture_id) or not catalog.get_gesture(gesture_id):
+        raise AnswerError('Жест не найден')
+
+    # Выбранный ответ - текст одного из вариантов, длиннее самого длинного он быть не может
+    selected_answer = data.get('selected_answer')
+    if selected_answer is not None:
+        selected_answer = str(selected_answer).strip()[:distractors.max_option_length(catalog)] or None
+
+    return {
+        'key': key,
+        'lesson_id': lesson.id,
+        'module_id': lesson.module_id,
+        'gesture_id': gesture_id,
+        'is_correct': bool(data.get('is_correct')),
+        'selected_answer': selected_answer,
+    }
+
+
+def parse_answers(items, catalog):
+    """Проверяет пачку ответов по одному: (корректные, ключи отклоненных).
+
+    Один некорректный ответ (например, урок удален при обновлении курса) не
+    должен отклонять всю пачку - иначе клиент будет присылать ее снова и снова.
+    """
+    answers, rejected = [], []
+    for item in items:
+        try:
+            answers.append(parse_answer(item, catalog))
+        except AnswerError:
+            key = item.get('key') if isinstance(item, dict) else None
+            if isinstance(key, str):
+                rejected.append(key)
+    return answers, rejected
+
+
+def _drop_duplicates(db_sess, user_id, answers):
+    """Убирает ответы, ключи которых уже встречались в пачке или учтены раньше.
+
+    Квитанции вставляются одним INSERT ... ON CONFLICT DO NOTHING, а RETURNING
+    возвращает только новые ключи - отдельный SELECT не нужен, и два
+    параллельных запроса с одним ключом не учтут ответ дважды.
+    """
+    keys = list(dict.fromkeys(a['key'] for a in answers if a['key'] is not None))
+    inserted = set()
+    if keys:
+        inserted = set(db_sess.execute(
+            insert(AnswerReceipt)
+            .values([{'user_id': user_id, 'idempotency_key': key} for key in keys])
+            .on_conflict_do_nothing(index_elements=['user_id', 'idempotency_key'])
+            .returning(AnswerReceipt.idempotency_key)
+        ).scalars())
+
+    fresh = []
+    for answer in answers:
+        if answer['key'] is not None:
+            if answer['key'] not in inserted:
+                continue
+            inserted.discard(answer['key'])
+        fresh.append(answer)
+    return fresh
+
+
+def prune_receipts(db_sess, older_than_days=RECEIPT_TTL_DAYS, limit=PRUNE_BATCH_SIZE):
+    """Удаляет до limit ключей старше older_than_days дней. Коммит за вызывающим кодом.
+
+    Возвращает число удаленных ключей: пока оно равно limit, стоит вызвать еще раз.
+    """
+    cutoff = datetime.datetime.now() - datetime.timedelta(days=older_than_days)
+    expired = sa.select(AnswerReceipt.id).where(AnswerReceipt.created_at < cutoff).limit(limit)
+    return db_sess.execute(sa.delete(AnswerReceipt).where(AnswerReceipt.id.in_(expired))).rowcount
+
+
+def _increment(stmt, column):
+    """column = column + excluded.column для ON CONFLICT DO UPDATE"""
+    return sa.func.coalesce(column, 0) + stmt.excluded[column.key]
+
+
+def apply_answers(db_sess, user_id, answers, catalog):
+    """Учитывает проверенные ответы (см. parse_answer). Коммит за вызывающим кодом.
+
+    Счетчики увеличиваются на стороне базы (INSERT ... ON CONFLICT DO UPDATE
+    SET n = n + excluded.n), поэтому параллельные воркеры не теряют
+    обновлений, а пачка стоит не больше четырех запросов. Еще два запроса -
+    чтение и запись отвеченных жестов в очереди повторения (см.
+    data/review.py), один - веса вариантов ответа (см. data/distractors.py),
+    до трех - итоги для учителя (см. data/analytics.py), до трех - рейтинг
+    (см. data/leaderboard.py) и еще один - увеличение версии состояния
+    пользователя.
+
+    Ответы по урокам, которых уже нет в каталоге (удалены при обновлении
+    курса, пока ответы ждали в журнале), пропускаются.
+
+    Возвращает число реально учтенных ответов.
+    """
+    answers = [answer for answer in answers if catalog.get_lesson(answer['lesson_id'])]
+    answers = _drop_duplicates(db_sess, user_id, answers)
+    if not answers:
+        return 0
+
+    lesson_total, lesson_correct = Counter(), Counter()
+    module_total, module_correct = Counter(), Counter()
+    mistakes = {}
+    for answer in answers:
+        lesson_total[answer['lesson_id']] += 1
+        module_total[answer['module_id']] += 1
+        if answer['is_correct']:
+            lesson_correct[answer['lesson_id']] += 1
+            module_correct[answer['module_id']] += 1
+        elif answer['selected_answer'] and catalog.get_gesture(answer['gesture_id']):
+            # Неправильный ответ - запоминаем ошибку
+            mistake_key = (answer['gesture_id'], answer['lesson_id'])
+            count, _ = mistakes.get(mistake_key, (0, None))
+            mistakes[mistake_key] = (count + 1, answer['selected_answer'])
+
+    # Записи об уроках
+    stmt = insert(UserLesson).values([
+        {
+            'user_id': user_id,
+            'lesson_id': lesson_id,
+            'total_answers': total,
+            'correct_answers': lesson_correct[lesson_id],
+        }
+        for lesson_id, total in lesson_total.items()
+    ])
+    db_sess.execute(stmt.on_conflict_do_update(
+        index_elements=['user_id', 'lesson_id'],
+        set_={
+            'total_answers': _increment(stmt, UserLesson.total_answers),
+            'correct_answers': _increment(stmt, UserLesson.correct_answers),
+        }
+    ))
+
+    # Прогресс по модулям (процент завершения меняется только в finish_lesson)
+    stmt = insert(UserProgress).values([
+        {
+            'user_id': user_id,
+            'module_id': module_id,
+            'correct_answers': module_correct[module_id],
+            'total_questions': total,
+            'completed_lessons': 0,
+            'completion_percentage': 0.0,
+            'is_completed': False,
+        }
+        for module_id, total in module_total.items()
+    ])
+    db_sess.execute(stmt.on_conflict_do_update(
+        index_elements=['user_id', 'module_id'],
+        set_={
+            'total_questions': _increment(stmt, UserProgress.total_questions),
+            'correct_answers': _increment(stmt, UserProgress.correct_answers),
+        }
+    ))
+
+    # Ошибки
+    if mistakes:
+        stmt = insert(UserMistake).values([
+            {
+                'user_id': user_id,
+                'gesture_id': gesture_id,
+                'lesson_id': lesson_id,
+                'module_id': catalog.get_lesson(lesson_id).module_id,
+                'incorrect_answer': incorrect_answer,
+                'mistake_count': count,
+            }
+            for (gesture_id, lesson_id), (count, incorrect_answer) in mistakes.items()
+        ])
+        db_sess.execute(stmt.on_conflict_do_update(
+            index_elements=['user_id', 'gesture_id', 'lesson_id'],
+            set_={
+                'mistake_count': _increment(stmt, UserMistake.mistake_count),
+                'incorrect_answer': stmt.excluded.incorrect_answer,
+            }
+        ))
+
+    # Веса неправильных вариантов ответа (см. data/distractors.py)
+    distractors.record_mistakes(db_sess, answers, catalog)
+
+    # Сроки интервального повторения
+    schedule_answers(db_sess, user_id, answers, catalog)
+
+    # Итоги класса для учителя (см. data/analytics.py)
+    analytics.record_answers(db_sess, user_id, answers, catalog)
+
+    # Точность в рейтинге (см. data/leaderboard.py)
+    leaderboard.record(db_sess, user_id, {
+        module_id: (0, module_correct[module_id], total) for module_id, total in module_total.items()
+    })
+
+    # Страницы уроков и прогресса пользователя устарели (см. data/render_cache.py)
+    bump_state_version(db_sess, user_id)
+
+    return len(answers)
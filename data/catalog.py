@@ -0,0 +1,176 @@
+"""Каталог учебного контента в памяти.
+
+Модули, уроки, жесты уроков и сами жесты меняются очень редко, поэтому
+мы один раз читаем их из базы в неизменяемый снимок и дальше отвечаем
+на запросы маршрутов без SQL. Снимок заменяется целиком (одним
+присваиванием) когда меняется номер версии контента в content_version.
+"""
+import threading
+import time
+from collections import namedtuple
+from types import MappingProxyType
+
+from . import db_session
+from .content_version import ContentVersion
+from .gesture import Gesture
+from .lesson import Lesson
+from .lesson_gesture import LessonGesture
+from .module import Module
+
+#как часто (в секундах) сверяемся с версией контента в базе
+CHECK_INTERVAL = 5.0
+
+CatalogModule = namedtuple('CatalogModule', [
+    'id', 'title', 'description', 'order_index',
+    'lesson_ids',  #кортеж id уроков модуля по order_index
+])
+
+CatalogLesson = namedtuple('CatalogLesson', [
+    'id', 'module_id', 'title', 'lesson_type', 'order_index',
+    'position',  #номер урока внутри модуля, начиная с 0
+    'prev_id',  #предыдущий урок того же модуля или None
+    'next_id',  #следующий урок того же модуля или None
+    'gesture_ids',  #кортеж id жестов урока по LessonGesture.order_index
+])
+
+CatalogGesture = namedtuple('CatalogGesture', ['id', 'word', 'video_filename', 'description'])
+
+
+class Catalog:
+    """Неизменяемый снимок учебного контента"""
+
+    __slots__ = ('version', 'modules', 'modules_by_id', 'lessons_by_id', 'gestures_by_id')
+
+    def __init__(self, version, modules, lessons, gestures):
+        self.version = version
+        self.modules = tuple(modules)
+        self.modules_by_id = MappingProxyType({m.id: m for m in self.modules})
+        self.lessons_by_id = MappingProxyType({l.id: l for l in lessons})
+        self.gestures_by_id = MappingProxyType({g.id: g for g in gestures})
+
+    def get_module(self, module_id):
+        return self.modules_by_id.get(module_id)
+
+    def get_lesson(self, lesson_id):
+        return self.lessons_by_id.get(lesson_id)
+
+    def get_gesture(self, gesture_id):
+        return self.gestures_by_id.get(gesture_id)
+
+    def module_lessons(self, module_id):
+        """Уроки модуля в порядке order_index"""
+        module = self.modules_by_id.get(module_id)
+        if module is None:
+            return ()
+        return tuple(self.lessons_by_id[lesson_id] for lesson_id in module.lesson_ids)
+
+    def lesson_count(self, module_id):
+        module = self.modules_by_id.get(module_id)
+        return len(module.lesson_ids) if module else 0
+
+    def lesson_gestures(self, lesson_id):
+        """Жесты урока в порядке LessonGesture.order_index"""
+        lesson = self.lessons_by_id.get(lesson_id)
+        if lesson is None:
+            return ()
+        return tuple(self.gestures_by_id[gesture_id] for gesture_id in lesson.gesture_ids)
+
+
+def read_content_version(db_sess):
+    row = db_sess.query(ContentVersion.version).filter(ContentVersion.id == 1).first()
+    return row[0] if row else 0
+
+
+def bump_content_version(db_sess):
+    """Увеличивает версию контента. Коммит остается за вызывающим кодом"""
+    row = db_sess.query(ContentVersion).filter(ContentVersion.id == 1).first()
+    if row is None:
+        row = ContentVersion(id=1, version=0)
+        db_sess.add(row)
+    row.version = (row.version or 0) + 1
+    return row.version
+
+
+def load_catalog(db_sess):
+    """Читает весь учебный контент четырьмя запросами и строит снимок"""
+    version = read_content_version(db_sess)
+
+    gestures = [
+        CatalogGesture(g.id, g.word, g.video_filename, g.description)
+        for g in db_sess.query(Gesture).order_by(Gesture.id)
+    ]
+    known_gestures = {g.id for g in gestures}
+
+    gesture_ids_by_lesson = {}
+    for lg in db_sess.query(LessonGesture).order_by(LessonGesture.lesson_id, LessonGesture.order_index, LessonGesture.id):
+        if lg.gesture_id in known_gestures:
+            gesture_ids_by_lesson.setdefault(lg.lesson_id, []).append(lg.gesture_id)
+
+    rows_by_module = {}
+    for lesson in db_sess.query(Lesson).order_by(Lesson.module_id, Lesson.order_index, Lesson.id):
+        rows_by_module.setdefault(lesson.module_id, []).append(lesson)
+
+    lessons = []
+    modules = []
+    for module in db_sess.query(Module).order_by(Module.order_index, Module.id):
+        module_rows = rows_by_module.get(module.id, [])
+        for position, lesson in enumerate(module_rows):
+            lessons.append(CatalogLesson(
+                id=lesson.id,
+                module_id=module.id,
+                title=lesson.title,
+                lesson_type=lesson.lesson_type,
+                order_index=lesson.order_index,
+                position=position,
+                prev_id=module_rows[position - 1].id if position > 0 else None,
+                next_id=module_rows[position + 1].id if position + 1 < len(module_rows) else None,
+                gesture_ids=tuple(gesture_ids_by_lesson.get(lesson.id, ())),
+            ))
+        modules.append(CatalogModule(
+            id=module.id,
+            title=module.title,
+            description=module.description,
+            order_index=module.order_index,
+            lesson_ids=tuple(lesson.id for lesson in module_rows),
+        ))
+
+    return Catalog(version, modules, lessons, gestures)
+
+
+_catalog = None
+_checked_at = 0.0
+_lock = threading.Lock()
+
+
+def get_catalog():
+    """Возвращает актуальный снимок каталога.
+
+    Версию контента проверяем не чаще раза в CHECK_INTERVAL секунд, так что
+    обычный запрос не делает ни одного SQL-запроса к каталогу.
+    """
+    global _catalog, _checked_at
+
+    catalog = _catalog
+    if catalog is not None and time.monotonic() - _checked_at < CHECK_INTERVAL:
+        return catalog
+
+    with _lock:
+        if _catalog is not None and time.monotonic() - _checked_at < CHECK_INTERVAL:
+            return _catalog
+
+        db_sess = db_session.create_read_session()
+        try:
+            version = read_content_version(db_sess)
+            if _catalog is None or _catalog.version != version:
+                #строим новый снимок целиком и только потом подменяем ссылку
+                _catalog = load_catalog(db_sess)
+        finally:
+            db_sess.close()
+        _checked_at = time.monotonic()
+        return _catalog
+
+
+def invalidate_catalog():
+    """Заставляет следующий get_catalog() сверить версию с базой"""
+    global _checked_at
+    _checked_at = 0.0
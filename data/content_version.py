@@ -0,0 +1,8 @@
+import sqlalchemy as sa
+from .db_session import SqlAlchemyBase
+
+class ContentVersion(SqlAlchemyBase):
+    __tablename__ = 'content_version'
+
+    id = sa.Column(sa.Integer, primary_key=True) #всегда одна строка с id = 1
+    version = sa.Column(sa.Integer, nullable=False, default=0) #увеличивается при любом изменении учебного контента
@@ -0,0 +1,313 @@
+"""Учебный контент из файла-манифеста.
+
+Манифест (JSON) целиком описывает модули, уроки, жесты уроков и словарь:
+
+    {
+      "gestures": [{"id": 1, "word": "Привет", "video": "Привет.mp4", "description": "..."}],
+      "modules": [{"id": 1, "title": "...", "description": "...",
+                   "lessons": [{"id": 1, "title": "...", "type": "new_gestures", "gestures": [1, 2]}]}]
+    }
+
+id записей постоянные: на них ссылается прогресс учеников. Порядок модулей,
+уроков и жестов урока задается порядком в списках.
+
+Импорт сравнивает манифест с базой по контрольной сумме каждой записи и
+применяет только изменившиеся записи - пачками, в одной транзакции, вместе
+с новой версией контента. Работающие процессы видят новую версию и
+перестраивают каталог без перезапуска (см. data/catalog.py).
+
+С prune записи, которых нет в манифесте, удаляются. Если на них ссылаются
+данные учеников (уроки, прогресс по модулям, ошибки), импорт отказывается,
+пока не указан force - тогда эти строки удаляются в той же транзакции.
+Итоги аналитики и сроки повторения по удаленным записям удаляются всегда.
+"""
+import hashlib
+import json
+import os
+from collections import namedtuple
+
+import sqlalchemy as sa
+from sqlalchemy.dialects.sqlite import insert
+
+from .catalog import bump_content_version
+from .distractor_weight import DistractorWeight
+from .gesture import Gesture
+from .gesture_rollup import GestureRollup
+from .lesson import Lesson
+from .lesson_gesture import LessonGesture
+from .lesson_rollup import LessonRollup
+from .module import Module
+from .module_histogram import ModuleHistogram
+from .review_item import ReviewItem
+from .user_lesson import UserLesson
+from .user_mistake import UserMistake
+from .user_progress import UserProgress
+
+LESSON_TYPES = ('new_gestures', 'repeat_new', 'repeat_old', 'final_review')
+
+#данные учеников по записям контента (поле Plan -> колонки): без force удалять их нельзя
+USER_DATA = {
+    'gestures': (UserMistake.gesture_id,),
+    'modules': (UserProgress.module_id, UserMistake.module_id),
+    'lessons': (UserLesson.lesson_id, UserMistake.lesson_id),
+}
+#итоги аналитики, веса вариантов и сроки повторения по записям контента: удаляются вместе с записью
+DERIVED_DATA = {
+    'gestures': (GestureRollup.gesture_id, DistractorWeight.gesture_id, ReviewItem.gesture_id),
+    'modules': (ModuleHistogram.module_id,),
+    'lessons': (LessonRollup.lesson_id,),
+}
+
+
+class ManifestError(ValueError):
+    """Манифест нельзя применить"""
+
+
+#изменения одной таблицы: новые и изменившиеся записи (словари колонок) и id удаляемых
+TableChanges = namedtuple('TableChanges', ['inserted', 'updated', 'deleted'])
+#жесты уроков меняются целиком для урока: {lesson_id: (gesture_id, ...)};
+#user_data - сколько строк учеников ссылается на удаляемые записи: {таблица: число}
+Plan = namedtuple('Plan', ['gestures', 'modules', 'lessons', 'lesson_gestures', 'removed_lesson_gestures',
+                           'user_data'])
+
+
+def checksum(values):
+    """Контрольная сумма записи по значениям ее колонок"""
+    raw = json.dumps(values, ensure_ascii=False, sort_keys=True, separators=(',', ':'))
+    return hashlib.sha1(raw.encode('utf-8')).hexdigest()
+
+
+def load_manifest(path):
+    try:
+        with open(path, encoding='utf-8') as f:
+            return json.load(f)
+    except (OSError, ValueError) as e:
+        raise ManifestError(f'Не удалось прочитать манифест {path}: {e}')
+
+
+def _unique_ids(items, what):
+    ids = [item.get('id') for item in items]
+    if not all(isinstance(i, int) and i > 0 for i in ids):
+        raise ManifestError(f'У каждой записи "{what}" должен быть целый положительный id')
+    if len(set(ids)) != len(ids):
+        raise ManifestError(f'Повторяющиеся id в "{what}"')
+
+
+def manifest_rows(manifest):
+    """Строки таблиц по манифесту: (жесты, модули, уроки, {lesson_id: жесты урока})"""
+    if not isinstance(manifest, dict):
+        raise ManifestError('Манифест должен быть объектом')
+    gestures_in = manifest.get('gestures') or []
+    modules_in = manifest.get('modules') or []
+    lessons_in = [lesson for module in modules_in for lesson in module.get('lessons') or []]
+    _unique_ids(gestures_in, 'gestures')
+    _unique_ids(modules_in, 'modules')
+    _unique_ids(lessons_in, 'lessons')
+
+    gestures = {}
+    for g in gestures_in:
+        if not g.get('word') or not g.get('video'):
+            raise ManifestError(f'У жеста {g["id"]} нет слова или видео')
+        gestures[g['id']] = {
+            'id': g['id'], 'word': g['word'], 'video_filename': g['video'], 'description': g.get('description'),
+        }
+
+    modules, lessons, lesson_gestures = {}, {}, {}
+    for module_order, m in enumerate(modules_in, start=1):
+        if not m.get('title'):
+            raise ManifestError(f'У модуля {m["id"]} нет названия')
+        modules[m['id']] = {
+            'id': m['id'], 'title': m['title'], 'description': m.get('description'), 'order_index': module_order,
+        }
+        for lesson_order, l in enumerate(m.get('lessons') or [], start=1):
+            if not l.get('title') or l.get('type') not in LESSON_TYPES:
+                raise ManifestError(f'У урока {l["id"]} нет названия или неизвестный тип {l.get("type")!r}')
+            lessons[l['id']] = {
+                'id': l['id'], 'module_id': m['id'], 'title': l['title'],
+                'lesson_type': l['type'], 'order_index': lesson_order,
+            }
+            gesture_ids = tuple(l.get('gestures') or ())
+            unknown = [gesture_id for gesture_id in gesture_ids if gesture_id not in gestures]
+            if unknown:
+                raise ManifestError(f'Урок {l["id"]} ссылается на неизвестные жесты: {unknown}')
+            lesson_gestures[l['id']] = gesture_ids
+    return gestures, modules, lessons, lesson_gestures
+
+
+def missing_videos(gestures, video_dir):
+    """Видео жестов, которых нет в папке видео"""
+    return sorted({
+        g['video_filename'] for g in gestures.values()
+        if not os.path.isfile(os.path.join(video_dir, g['video_filename']))
+    })
+
+
+def database_rows(db_sess):
+    """Те же строки, но из базы"""
+    gestures = {
+        g.id: {'id': g.id, 'word': g.word, 'video_filename': g.video_filename, 'description': g.description}
+        for g in db_sess.query(Gesture)
+    }
+    modules = {
+        m.id: {'id': m.id, 'title': m.title, 'description': m.description, 'order_index': m.order_index}
+        for m in db_sess.query(Module)
+    }
+    lessons = {
+        l.id: {'id': l.id, 'module_id': l.module_id, 'title': l.title,
+               'lesson_type': l.lesson_type, 'order_index': l.order_index}
+        for l in db_sess.query(Lesson)
+    }
+    lesson_gestures = {}
+    for lg in db_sess.query(LessonGesture).order_by(LessonGesture.lesson_id, LessonGesture.order_index, LessonGesture.id):
+        lesson_gestures.setdefault(lg.lesson_id, []).append(lg.gesture_id)
+    return gestures, modules, lessons, {lesson_id: tuple(ids) for lesson_id, ids in lesson_gestures.items()}
+
+
+def _diff(wanted, current, prune):
+    inserted = [row for row_id, row in wanted.items() if row_id not in current]
+    updated = [
+        row for row_id, row in wanted.items()
+        if row_id in current and checksum(row) != checksum(current[row_id])
+    ]
+    deleted = sorted(set(current) - set(wanted)) if prune else []
+    return TableChanges(inserted, updated, deleted)
+
+
+def plan_changes(manifest, db_sess, prune=False):
+    """Что нужно изменить в базе, чтобы она совпала с манифестом"""
+    gestures, modules, lessons, lesson_gestures = manifest_rows(manifest)
+    db_gestures, db_modules, db_lessons, db_lesson_gestures = database_rows(db_sess)
+
+    changed_lessons = {
+        lesson_id: gesture_ids for lesson_id, gesture_ids in lesson_gestures.items()
+        if checksum(list(gesture_ids)) != checksum(list(db_lesson_gestures.get(lesson_id, ())))
+    }
+    removed = sorted(set(db_lesson_gestures) - set(lesson_gestures)) if prune else []
+    tables = {
+        'gestures': _diff(gestures, db_gestures, prune),
+        'modules': _diff(modules, db_modules, prune),
+        'lessons': _diff(lessons, db_lessons, prune),
+    }
+    return Plan(
+        tables['gestures'], tables['modules'], tables['lessons'], changed_lessons, removed,
+        _user_data(db_sess, tables),
+    )
+
+
+def _user_data(db_sess, tables):
+    """Сколько строк учеников в каждой таблице ссылается на удаляемые записи"""
+    counts = {}
+    for name, columns in USER_DATA.items():
+        deleted = tables[name].deleted
+        for column in columns if deleted else ():
+            count = db_sess.execute(
+                sa.select(sa.func.count()).select_from(column.table).where(column.in_(deleted))
+            ).scalar()
+            if count:
+                counts[column.table.name] = counts.get(column.table.name, 0) + count
+    return counts
+
+
+def plan_is_empty(plan):
+    tables = (plan.gestures, plan.modules, plan.lessons)
+    return not plan.lesson_gestures and not plan.removed_lesson_gestures and not any(
+        changes.inserted or changes.updated or changes.deleted for changes in tables
+    )
+
+
+def describe_plan(plan):
+    parts = []
+    for name, changes in (('жесты', plan.gestures), ('модули', plan.modules), ('уроки', plan.lessons)):
+        parts.append(f'{name}: +{len(changes.inserted)} ~{len(changes.updated)} -{len(changes.deleted)}')
+    parts.append(f'жесты уроков: ~{len(plan.lesson_gestures)} -{len(plan.removed_lesson_gestures)}')
+    if plan.user_data:
+        parts.append('данные учеников по удаляемым записям: ' + ', '.join(
+            f'{table} {count}' for table, count in sorted(plan.user_data.items())
+        ))
+    return ', '.join(parts)
+
+
+def _apply_table(db_sess, model, changes):
+    if changes.inserted:
+        db_sess.execute(insert(model), changes.inserted)
+    if changes.updated:
+        #массовое обновление по первичному ключу (executemany)
+        db_sess.execute(sa.update(model), changes.updated)
+    if changes.deleted:
+        db_sess.execute(sa.delete(model).where(model.id.in_(changes.deleted)))
+
+
+def _delete_dependents(db_sess, plan):
+    """Удаляет данные учеников и итоги, ссылающиеся на удаляемые записи"""
+    for name in ('lessons', 'modules', 'gestures'):
+        deleted = getattr(plan, name).deleted
+        for column in (USER_DATA[name] + DERIVED_DATA[name]) if deleted else ():
+            db_sess.execute(sa.delete(column.table).where(column.in_(deleted)))
+
+
+def apply_plan(db_sess, plan):
+    """Применяет изменения и поднимает версию контента. Коммит за вызывающим кодом"""
+    _delete_dependents(db_sess, plan)
+    _apply_table(db_sess, Gesture, plan.gestures)
+    _apply_table(db_sess, Module, plan.modules)
+    _apply_table(db_sess, Lesson, plan.lessons)
+
+    lesson_ids = list(plan.lesson_gestures) + list(plan.removed_lesson_gestures)
+    if lesson_ids:
+        db_sess.execute(sa.delete(LessonGesture).where(LessonGesture.lesson_id.in_(lesson_ids)))
+    rows = [
+        {'lesson_id': lesson_id, 'gesture_id': gesture_id, 'order_index': order}
+        for lesson_id, gesture_ids in plan.lesson_gestures.items()
+        for order, gesture_id in enumerate(gesture_ids, start=1)
+    ]
+    if rows:
+        db_sess.execute(insert(LessonGesture), rows)
+    return bump_content_version(db_sess)
+
+
+def import_manifest(db_sess, manifest, video_dir, prune=False, dry_run=False, force=False):
+    """Сверяет манифест с базой и применяет разницу.
+
+    Возвращает (план, новая версия контента или None, если менять нечего или dry_run).
+    Если на удаляемые записи ссылаются данные учеников, без force (и не в
+    dry_run) поднимает ManifestError.
+    Коммит за вызывающим кодом.
+    """
+    gestures = manifest_rows(manifest)[0]
+    missing = missing_videos(gestures, video_dir)
+    if missing:
+        raise ManifestError(f'Нет файлов видео в {video_dir}: {", ".join(missing)}')
+
+    plan = plan_changes(manifest, db_sess, prune)
+    if plan.user_data and not force and not dry_run:
+        raise ManifestError(
+            describe_plan(plan) + '. На удаляемые записи ссылаются данные учеников - '
+            'чтобы удалить и их, повторите импорт с --force'
+        )
+    if dry_run or plan_is_empty(plan):
+        return plan, None
+    return plan, apply_plan(db_sess, plan)
+
+
+def export_manifest(db_sess):
+    """Манифест по текущему содержимому базы"""
+    gestures, modules, lessons, lesson_gestures = database_rows(db_sess)
+    lessons_by_module = {}
+    for lesson in sorted(lessons.values(), key=lambda l: (l['order_index'], l['id'])):
+        lessons_by_module.setdefault(lesson['module_id'], []).append({
+            'id': lesson['id'],
+            'title': lesson['title'],
+            'type': lesson['lesson_type'],
+            'gestures': list(lesson_gestures.get(lesson['id'], ())),
+        })
+    return {
+        'gestures': [
+            {'id': g['id'], 'word': g['word'], 'video': g['video_filename'], 'description': g['description']}
+            for g in sorted(gestures.values(), key=lambda g: g['id'])
+        ],
+        'modules': [
+            {'id': m['id'], 'title': m['title'], 'description': m['description'],
+             'lessons': lessons_by_module.get(m['id'], [])}
+            for m in sorted(modules.values(), key=lambda m: (m['order_index'], m['id']))
+        ],
+    }
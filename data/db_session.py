@@ -1,16 +1,78 @@
+import logging
+import os
+import random
+import time
+
 import sqlalchemy as sa
 import sqlalchemy.orm as orm
 from sqlalchemy.orm import Session
+from sqlalchemy.exc import OperationalError
 import sqlalchemy.ext.declarative as dec
 
+log = logging.getLogger(__name__)
+
 #SqlAlchemyBase — некоторую абстрактную декларативную базу, в которую позднее будем наследовать все наши модели
 SqlAlchemyBase = dec.declarative_base()
 
 #__factory, которую будем использовать для получения сессий подключения к нашей базе данных
 __factory = None
+#__read_factory - сессии только для чтения, у них свой пул соединений и они не ждут писателя
+__read_factory = None
+#сессия чтения на время одного запроса (см. init_app); запись - только через transaction()
+__read_scoped = None
 
-def global_init(db_file):
-    global __factory
+#сколько раз повторять транзакцию, если база занята другим писателем
+__retries = 3
+#пауза перед первым повтором в секундах, дальше удваивается
+__retry_delay = 0.05
+
+
+def _sqlite_pragmas(busy_timeout_ms, read_only):
+    pragmas = [
+        f'PRAGMA busy_timeout = {int(busy_timeout_ms)}',
+        'PRAGMA cache_size = -20000',  #~20 МБ кэша страниц на соединение
+        'PRAGMA temp_store = MEMORY',
+        'PRAGMA mmap_size = 268435456',
+    ]
+    if read_only:
+        pragmas.append('PRAGMA query_only = ON')
+    else:
+        #WAL: читатели не блокируют писателя и наоборот
+        pragmas.append('PRAGMA journal_mode = WAL')
+        pragmas.append('PRAGMA synchronous = NORMAL')
+    return pragmas
+
+
+def _create_engine(url, busy_timeout_ms, read_only, pool_size):
+    engine = sa.create_engine(
+        url,
+        echo=False,
+        pool_size=pool_size,
+        max_overflow=pool_size,
+        connect_args={'check_same_thread': False, 'timeout': busy_timeout_ms / 1000},
+    )
+    pragmas = _sqlite_pragmas(busy_timeout_ms, read_only)
+
+    @sa.event.listens_for(engine, 'connect')
+    def on_connect(dbapi_connection, connection_record):
+        #транзакции начинаем сами (см. on_begin), а не драйвер sqlite3
+        dbapi_connection.isolation_level = None
+        cursor = dbapi_connection.cursor()
+        for pragma in pragmas:
+            cursor.execute(pragma)
+        cursor.close()
+
+    @sa.event.listens_for(engine, 'begin')
+    def on_begin(connection):
+        #писатель сразу берет блокировку записи, чтобы не получить "database is locked"
+        #при повышении блокировки посреди транзакции; читатели берут обычный снимок
+        connection.exec_driver_sql('BEGIN' if read_only else 'BEGIN IMMEDIATE')
+
+    return engine
+
+
+def global_init(db_file, busy_timeout_ms=None, retries=None, read_pool_size=None, write_pool_size=None):
+    global __factory, __read_factory, __read_scoped, __retries
 
     if __factory:
         return
@@ -18,17 +80,106 @@ def global_init(db_file):
     if not db_file or not db_file.strip():
         raise Exception("Необходимо указать файл базы данных.")
 
-    conn_str = f'sqlite:///{db_file.strip()}?check_same_thread=False'
-    print(f"Подключение к базе данных по адресу {conn_str}")
+    if busy_timeout_ms is None:
+        busy_timeout_ms = int(os.environ.get('DB_BUSY_TIMEOUT_MS', 5000))
+    if retries is None:
+        retries = int(os.environ.get('DB_RETRIES', 3))
+    if read_pool_size is None:
+        read_pool_size = int(os.environ.get('DB_READ_POOL_SIZE', 10))
+    if write_pool_size is None:
+        write_pool_size = int(os.environ.get('DB_WRITE_POOL_SIZE', 5))
+    __retries = retries
 
-    engine = sa.create_engine(conn_str, echo=False)
-    __factory = orm.sessionmaker(bind=engine)
+    db_file = db_file.strip()
+    conn_str = f'sqlite:///{db_file}'
+    log.info("Подключение к базе данных по адресу %s", conn_str)
+
+    engine = _create_engine(conn_str, busy_timeout_ms, read_only=False, pool_size=write_pool_size)
+    __factory = orm.sessionmaker(bind=engine, expire_on_commit=False)
 
     from . import __all_models
+    from .migrations import migrate
+
+    #вместо create_all - версионные миграции, см. data/migrations.py
+    migrate(engine)
+
+    #читатели открывают тот же файл в режиме только для чтения
+    read_engine = _create_engine(
+        f'sqlite:///file:{db_file}?mode=ro&uri=true', busy_timeout_ms, read_only=True, pool_size=read_pool_size
+    )
+    __read_factory = orm.sessionmaker(bind=read_engine, autoflush=False)
+
+    __read_scoped = orm.scoped_session(__read_factory)
 
-    SqlAlchemyBase.metadata.create_all(engine)
+
+def engines():
+    """Движки для записи и для чтения (например, чтобы подключить события)"""
+    return __factory.kw['bind'], __read_factory.kw['bind']
 
 
 def create_session() -> Session:
+    """Сессия для записи. Закрывать ее должен вызывающий код"""
     global __factory
-    return __factory()
\ No newline at end of file
+    return __factory()
+
+
+def create_read_session() -> Session:
+    """Сессия только для чтения из отдельного пула. Закрывать ее должен вызывающий код"""
+    global __read_factory
+    return __read_factory()
+
+
+def get_read_session(fresh=False) -> Session:
+    """Сессия только для чтения на время текущего запроса, закрывается автоматически.
+
+    Первый запрос через сессию открывает снимок базы, и до конца запроса
+    сессия видит базу такой, какой она была в тот момент - в том числе не
+    видит записей самого запроса через transaction(). fresh=True завершает
+    снимок, и следующий запрос прочитает базу заново.
+    """
+    db_sess = __read_scoped()
+    if fresh:
+        db_sess.rollback()
+    return db_sess
+
+
+def remove_sessions(exception=None):
+    """Закрывает сессию чтения текущего запроса (откатывая незавершенную транзакцию)"""
+    if __read_scoped is not None:
+        __read_scoped.remove()
+
+
+def init_app(app):
+    """Подключает закрытие сессии чтения в конце каждого запроса Flask"""
+    app.teardown_appcontext(remove_sessions)
+
+
+def is_locked_error(error):
+    message = str(getattr(error, 'orig', error)).lower()
+    return isinstance(error, OperationalError) and ('locked' in message or 'busy' in message)
+
+
+def transaction(func, *args, **kwargs):
+    """Выполняет func(db_sess, *args, **kwargs) в отдельной транзакции и коммитит.
+
+    Если база занята другим писателем, транзакция повторяется с растущей паузой.
+    """
+    attempt = 0
+    while True:
+        db_sess = create_session()
+        try:
+            result = func(db_sess, *args, **kwargs)
+            db_sess.commit()
+            return result
+        except OperationalError as e:
+            db_sess.rollback()
+            if not is_locked_error(e) or attempt >= __retries:
+                raise
+        except Exception:
+            db_sess.rollback()
+            raise
+        finally:
+            db_sess.close()
+
+        time.sleep(__retry_delay * (2 ** attempt) * (1 + random.random()))
+        attempt += 1
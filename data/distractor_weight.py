@@ -0,0 +1,11 @@
+import sqlalchemy as sa
+from sqlalchemy import ForeignKey
+from .db_session import SqlAlchemyBase
+
+class DistractorWeight(SqlAlchemyBase):
+    """Сколько раз слово выбирали вместо жеста - веса вариантов ответа (см. data/distractors.py)"""
+    __tablename__ = 'distractor_weights'
+
+    gesture_id = sa.Column(sa.Integer, ForeignKey('gestures.id'), primary_key=True)
+    word = sa.Column(sa.String, primary_key=True) #слово словаря в нижнем регистре, без пробелов по краям
+    mistakes = sa.Column(sa.Integer, nullable=False, default=0)
@@ -0,0 +1,273 @@
+"""Неправильные варианты ответов (дистракторы) для вопросов урока.
+
+Для каждого урока заранее строится пул слов-кандидатов из словаря жестов:
+слова самого урока, а если их мало - слова модуля и всего курса. Итоговый
+урок модуля (final_review) берет слова из всего модуля. Для каждого жеста
+урока кандидаты взвешиваются по ошибкам учеников: слово, которое часто
+выбирали вместо этого жеста (UserMistake.incorrect_answer), выпадает чаще.
+
+Ошибки по словам копятся в маленькой таблице distractor_weights (жест,
+слово словаря, число ошибок): apply_answers увеличивает ее upsert-запросом
+в той же транзакции, что и остальные счетчики, как итоги в data/analytics.py.
+
+По весам строится alias-таблица (метод Уолкера-Возе), поэтому выбор
+варианта стоит O(1). Индекс целиком перестраивается, только когда меняется
+версия каталога; веса перечитываются раз в MISTAKES_INTERVAL секунд, и
+пересчитываются таблицы только тех жестов, чьи веса изменились. Пока один
+поток перечитывает веса, остальные без ожидания получают прежний индекс.
+Индекс неизменяемый и заменяется одним присваиванием, как и каталог.
+"""
+import threading
+import time
+from collections import Counter
+
+from sqlalchemy.dialects.sqlite import insert
+
+from . import db_session
+from .catalog import get_catalog
+from .distractor_weight import DistractorWeight
+
+#сколько неправильных вариантов показываем в вопросе
+DISTRACTOR_COUNT = 3
+#как часто (в секундах) перечитываем статистику ошибок
+MISTAKES_INTERVAL = 60.0
+#насколько ошибки могут поднять вес слова (вес = 1 + min(ошибок, предел))
+MAX_MISTAKE_BOOST = 20
+#запасные слова, если в словаре курса слишком мало жестов
+FALLBACK_WORDS = ('Дом', 'Машина', 'Солнце')
+
+
+class AliasTable:
+    """Выбор элемента с заданными весами за O(1) (alias method)"""
+
+    __slots__ = ('items', 'prob', 'alias')
+
+    def __init__(self, items, weights):
+        n = len(items)
+        self.items = tuple(items)
+        self.prob = [0.0] * n
+        self.alias = [0] * n
+        if n == 0:
+            return
+
+        total = float(sum(weights))
+        scaled = [w * n / total for w in weights]
+        small = [i for i, w in enumerate(scaled) if w < 1.0]
+        large = [i for i, w in enumerate(scaled) if w >= 1.0]
+        while small and large:
+            s, l = small.pop(), large.pop()
+            self.prob[s] = scaled[s]
+            self.alias[s] = l
+            scaled[l] -= 1.0 - scaled[s]
+            (small if scaled[l] < 1.0 else large).append(l)
+        for i in small + large:
+            self.prob[i] = 1.0
+
+    def __len__(self):
+        return len(self.items)
+
+    def sample(self, rng):
+        i = rng.randrange(len(self.items))
+        return self.items[i] if rng.random() < self.prob[i] else self.items[self.alias[i]]
+
+
+def normalize_word(word):
+    return (word or '').strip().lower()
+
+
+def lesson_pool(catalog, lesson, size=DISTRACTOR_COUNT + 1):
+    """Слова-кандидаты урока: урок, затем модуль, затем весь курс"""
+    def words(gestures):
+        return [g.word for g in gestures]
+
+    module = catalog.get_module(lesson.module_id)
+    module_words = []
+    for lesson_id in (module.lesson_ids if module else (lesson.id,)):
+        module_words += words(catalog.lesson_gestures(lesson_id))
+
+    if lesson.lesson_type == 'final_review':
+        candidates = module_words
+    else:
+        candidates = words(catalog.lesson_gestures(lesson.id)) + module_words
+
+    pool = list(dict.fromkeys(candidates))
+    if len(pool) < size:
+        pool += [g.word for g in catalog.gestures_by_id.values()]
+        pool = list(dict.fromkeys(pool))
+    if len(pool) < size:
+        pool = list(dict.fromkeys(pool + list(FALLBACK_WORDS)))
+    return tuple(pool)
+
+
+def build_table(pool, gesture, mistakes):
+    """Alias-таблица дистракторов жеста: все слова пула, кроме правильного, с весами ошибок"""
+    correct = normalize_word(gesture.word)
+    items = [word for word in pool if normalize_word(word) != correct]
+    weights = [1 + min(mistakes.get(normalize_word(word), 0), MAX_MISTAKE_BOOST) for word in items]
+    return AliasTable(items, weights)
+
+
+class DistractorIndex:
+    """Неизменяемый индекс: пулы уроков и alias-таблицы (урок, жест)"""
+
+    __slots__ = ('catalog_version', 'mistakes', 'pools', 'tables')
+
+    def __init__(self, catalog_version, mistakes, pools, tables):
+        self.catalog_version = catalog_version
+        self.mistakes = mistakes  #gesture_id -> Counter(слово -> число ошибок)
+        self.pools = pools  #lesson_id -> кортеж слов
+        self.tables = tables  #(lesson_id, gesture_id) -> AliasTable
+
+    def table(self, lesson_id, gesture_id):
+        return self.tables.get((lesson_id, gesture_id))
+
+
+_vocabulary = (None, frozenset())
+
+
+def vocabulary(catalog):
+    """Слова словаря жестов (нормализованные) - только они бывают вариантами ответа"""
+    global _vocabulary
+    version, words = _vocabulary
+    if version != catalog.version:
+        words = frozenset(normalize_word(g.word) for g in catalog.gestures_by_id.values())
+        _vocabulary = (catalog.version, words)
+    return words
+
+
+def max_option_length(catalog):
+    """Длина самого длинного текста варианта ответа"""
+    return max(len(word) for word in vocabulary(catalog) | set(FALLBACK_WORDS))
+
+
+def record_mistakes(db_sess, answers, catalog):
+    """Добавляет неправильные ответы пачки к весам вариантов. Коммит за вызывающим кодом.
+
+    Учитываются только слова словаря: другие слова вариантами не бывают, а
+    таблица остается размером не больше (жесты x слова).
+    """
+    words = vocabulary(catalog)
+    counts = Counter()
+    for answer in answers:
+        word = normalize_word(answer['selected_answer'])
+        if not answer['is_correct'] and word in words and catalog.get_gesture(answer['gesture_id']):
+            counts[(answer['gesture_id'], word)] += 1
+    if not counts:
+        return
+
+    stmt = insert(DistractorWeight).values([
+        {'gesture_id': gesture_id, 'word': word, 'mistakes': count}
+        for (gesture_id, word), count in counts.items()
+    ])
+    db_sess.execute(stmt.on_conflict_do_update(
+        index_elements=['gesture_id', 'word'],
+        set_={'mistakes': DistractorWeight.mistakes + stmt.excluded.mistakes}
+    ))
+
+
+def read_mistakes(db_sess):
+    """Сколько раз каждое слово выбирали вместо каждого жеста: {gesture_id: Counter}"""
+    mistakes = {}
+    for gesture_id, word, count in db_sess.query(
+            DistractorWeight.gesture_id, DistractorWeight.word, DistractorWeight.mistakes):
+        mistakes.setdefault(gesture_id, Counter())[word] += count
+    return mistakes
+
+
+def build_index(catalog, mistakes):
+    """Полная сборка индекса для версии каталога"""
+    pools = {}
+    tables = {}
+    for lesson in catalog.lessons_by_id.values():
+        pool = pools[lesson.id] = lesson_pool(catalog, lesson)
+        for gesture in catalog.lesson_gestures(lesson.id):
+            tables[(lesson.id, gesture.id)] = build_table(pool, gesture, mistakes.get(gesture.id, {}))
+    return DistractorIndex(catalog.version, mistakes, pools, tables)
+
+
+def update_index(index, catalog, mistakes):
+    """Новый индекс, в котором пересчитаны таблицы только жестов с изменившимися ошибками"""
+    changed = {
+        gesture_id for gesture_id in set(index.mistakes) | set(mistakes)
+        if index.mistakes.get(gesture_id) != mistakes.get(gesture_id)
+    }
+    if not changed:
+        return DistractorIndex(index.catalog_version, mistakes, index.pools, index.tables)
+
+    tables = dict(index.tables)
+    for (lesson_id, gesture_id) in index.tables:
+        if gesture_id in changed:
+            tables[(lesson_id, gesture_id)] = build_table(
+                index.pools[lesson_id], catalog.get_gesture(gesture_id), mistakes.get(gesture_id, {})
+            )
+    return DistractorIndex(index.catalog_version, mistakes, index.pools, tables)
+
+
+_index = None
+_mistakes_read_at = 0.0
+_lock = threading.Lock()
+
+
+def get_distractor_index(catalog=None):
+    """Актуальный индекс дистракторов для текущего каталога"""
+    global _index, _mistakes_read_at
+
+    catalog = catalog or get_catalog()
+    index = _index
+    if (index is not None and index.catalog_version == catalog.version
+            and time.monotonic() - _mistakes_read_at < MISTAKES_INTERVAL):
+        return index
+
+    # Для того же каталога веса обновляет один поток, остальные пока получают прежний индекс
+    catalog_changed = index is None or index.catalog_version != catalog.version
+    if not _lock.acquire(blocking=catalog_changed):
+        return index
+    try:
+        index = _index
+        catalog_changed = index is None or index.catalog_version != catalog.version
+        if not catalog_changed and time.monotonic() - _mistakes_read_at < MISTAKES_INTERVAL:
+            return index
+
+        db_sess = db_session.create_read_session()
+        try:
+            mistakes = read_mistakes(db_sess)
+        finally:
+            db_sess.close()
+
+        if catalog_changed:
+            _index = build_index(catalog, mistakes)
+        else:
+            _index = update_index(index, catalog, mistakes)
+        _mistakes_read_at = time.monotonic()
+        return _index
+    finally:
+        _lock.release()
+
+
+def invalidate_mistakes():
+    """Заставляет следующий вызов перечитать статистику ошибок"""
+    global _mistakes_read_at
+    _mistakes_read_at = 0.0
+
+
+def pick_distractors(catalog, lesson, gesture, rng, count=DISTRACTOR_COUNT):
+    """count разных неправильных слов для вопроса; каждое выбирается за O(1)"""
+    table = get_distractor_index(catalog).table(lesson.id, gesture.id)
+    if table is None:
+        table = build_table(lesson_pool(catalog, lesson), gesture, {})
+
+    count = min(count, len(table))
+    picked = []
+    # Повторы отбрасываем; попыток с запасом, чтобы редкий перекос весов не зациклил выбор
+    for _ in range(count * 8):
+        if len(picked) == count:
+            break
+        word = table.sample(rng)
+        if word not in picked:
+            picked.append(word)
+    for word in table.items:
+        if len(picked) == count:
+            break
+        if word not in picked:
+            picked.append(word)
+    return picked
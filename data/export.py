@@ -0,0 +1,206 @@
+"""Выгрузка данных учеников в CSV или NDJSON потоком.
+
+Наборы данных:
+  - progress: прогресс по модулям (user_progress);
+  - lessons: уроки учеников (user_lessons);
+  - mistakes: ошибки (user_mistakes).
+К каждой строке добавляются почта, имя и класс ученика, а названия модулей,
+уроков и слова жестов берутся из каталога.
+
+Строки читаются пачками по BATCH_SIZE (yield_per) из сессии только для
+чтения и сразу превращаются в текст: в памяти одновременно лежит одна пачка
+и один кусок ответа, сколько бы учеников ни было в школе. Чтение идет в
+обычной транзакции WAL - писатели в это время работают как обычно.
+При gzip куски сжимаются на лету. Текстовые ячейки CSV, начинающиеся с
+= + - @, получают апостроф спереди, чтобы таблица не выполнила их как формулу.
+"""
+import csv
+import io
+import json
+import zlib
+from collections import namedtuple
+
+import sqlalchemy as sa
+
+from . import db_session
+from .user_lesson import UserLesson
+from .user_mistake import UserMistake
+from .user_progress import UserProgress
+from .users import User
+
+BATCH_SIZE = 1000
+#примерный размер куска ответа в символах
+CHUNK_SIZE = 64 * 1024
+FORMATS = ('csv', 'ndjson')
+MIMETYPES = {'csv': 'text/csv', 'ndjson': 'application/x-ndjson'}
+
+USER_COLUMNS = ('user_id', 'email', 'username', 'class')
+#с этих символов Excel и LibreOffice начинают формулу (имя ученика '=HYPERLINK(...)')
+FORMULA_PREFIXES = ('=', '+', '-', '@', '\t', '\r')
+
+#columns - заголовок, query(class_name) - запрос, values(row, catalog) - значения строки
+Dataset = namedtuple('Dataset', ['columns', 'query', 'values'])
+
+
+class ExportError(ValueError):
+    """Неизвестный набор данных или формат"""
+
+
+def _users(stmt, model, class_name):
+    stmt = stmt.join(User, User.id == model.user_id)
+    if class_name:
+        stmt = stmt.where(User.class_name == class_name)
+    return stmt
+
+
+def _title(item):
+    return item.title if item else None
+
+
+def _progress_query(class_name):
+    stmt = sa.select(
+        UserProgress.user_id, User.email, User.username, User.class_name, UserProgress.module_id,
+        UserProgress.completed_lessons, UserProgress.correct_answers, UserProgress.total_questions,
+        UserProgress.completion_percentage, UserProgress.is_completed,
+    )
+    #порядок совпадает с уникальным индексом (user_id, module_id) - без сортировки
+    return _users(stmt, UserProgress, class_name).order_by(UserProgress.user_id, UserProgress.module_id)
+
+
+def _progress_values(row, catalog):
+    return (
+        *row[:4], row.module_id, _title(catalog.get_module(row.module_id)), row.completed_lessons or 0,
+        row.correct_answers or 0, row.total_questions or 0, row.completion_percentage or 0.0, bool(row.is_completed),
+    )
+
+
+def _lessons_query(class_name):
+    stmt = sa.select(
+        UserLesson.user_id, User.email, User.username, User.class_name, UserLesson.lesson_id,
+        UserLesson.completed_at, UserLesson.correct_answers, UserLesson.total_answers,
+    )
+    return _users(stmt, UserLesson, class_name).order_by(UserLesson.user_id, UserLesson.lesson_id)
+
+
+def _lessons_values(row, catalog):
+    lesson = catalog.get_lesson(row.lesson_id)
+    module_id = lesson.module_id if lesson else None
+    return (
+        *row[:4], module_id, _title(catalog.get_module(module_id)), row.lesson_id, _title(lesson),
+        row.completed_at.isoformat(sep=' ') if row.completed_at else None,
+        row.correct_answers or 0, row.total_answers or 0,
+    )
+
+
+def _mistakes_query(class_name):
+    stmt = sa.select(
+        UserMistake.user_id, User.email, User.username, User.class_name, UserMistake.module_id,
+        UserMistake.lesson_id, UserMistake.gesture_id, UserMistake.incorrect_answer, UserMistake.mistake_count,
+    )
+    return _users(stmt, UserMistake, class_name).order_by(
+        UserMistake.user_id, UserMistake.gesture_id, UserMistake.lesson_id
+    )
+
+
+def _mistakes_values(row, catalog):
+    gesture = catalog.get_gesture(row.gesture_id)
+    return (
+        *row[:4], row.module_id, _title(catalog.get_module(row.module_id)), row.lesson_id,
+        _title(catalog.get_lesson(row.lesson_id)), row.gesture_id, gesture.word if gesture else None,
+        row.incorrect_answer, row.mistake_count or 0,
+    )
+
+
+DATASETS = {
+    'progress': Dataset(
+        USER_COLUMNS + ('module_id', 'module', 'completed_lessons', 'correct_answers',
+                        'total_questions', 'completion_percentage', 'is_completed'),
+        _progress_query, _progress_values,
+    ),
+    'lessons': Dataset(
+        USER_COLUMNS + ('module_id', 'module', 'lesson_id', 'lesson', 'completed_at',
+                        'correct_answers', 'total_answers'),
+        _lessons_query, _lessons_values,
+    ),
+    'mistakes': Dataset(
+        USER_COLUMNS + ('module_id', 'module', 'lesson_id', 'lesson', 'gesture_id', 'word',
+                        'incorrect_answer', 'mistake_count'),
+        _mistakes_query, _mistakes_values,
+    ),
+}
+
+
+def get_dataset(name, fmt):
+    if name not in DATASETS:
+        raise ExportError(f'Неизвестный набор данных {name!r}, есть: {", ".join(DATASETS)}')
+    if fmt not in FORMATS:
+        raise ExportError(f'Неизвестный формат {fmt!r}, есть: {", ".join(FORMATS)}')
+    return DATASETS[name]
+
+
+def filename(name, fmt, compress=False):
+    return f'{name}.{fmt}' + ('.gz' if compress else '')
+
+
+def iter_rows(dataset, catalog, class_name=None, batch_size=BATCH_SIZE):
+    """Строки набора пачками из своей сессии только для чтения"""
+    db_sess = db_session.create_read_session()
+    try:
+        result = db_sess.execute(dataset.query(class_name).execution_options(yield_per=batch_size))
+        for row in result:
+            yield dataset.values(row, catalog)
+    finally:
+        db_sess.close()
+
+
+def _csv_cell(value):
+    """Текст, похожий на формулу, экранируется апострофом - таблица покажет его как есть"""
+    if isinstance(value, str) and value.startswith(FORMULA_PREFIXES):
+        return "'" + value
+    return value
+
+
+def _csv_chunks(columns, rows):
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    writer.writerow(columns)
+    for row in rows:
+        writer.writerow([_csv_cell(value) for value in row])
+        if buffer.tell() >= CHUNK_SIZE:
+            yield buffer.getvalue()
+            buffer.seek(0)
+            buffer.truncate()
+    yield buffer.getvalue()
+
+
+def _ndjson_chunks(columns, rows):
+    lines = []
+    size = 0
+    for row in rows:
+        line = json.dumps(dict(zip(columns, row)), ensure_ascii=False) + '\n'
+        lines.append(line)
+        size += len(line)
+        if size >= CHUNK_SIZE:
+            yield ''.join(lines)
+            lines = []
+            size = 0
+    yield ''.join(lines)
+
+
+def _gzip(chunks):
+    #wbits=31 - формат gzip с заголовком и контрольной суммой
+    compressor = zlib.compressobj(6, zlib.DEFLATED, 31)
+    for chunk in chunks:
+        data = compressor.compress(chunk)
+        if data:
+            yield data
+    yield compressor.flush()
+
+
+def stream(name, fmt, catalog, class_name=None, compress=False):
+    """Генератор кусков выгрузки (bytes) для потокового ответа или файла"""
+    dataset = get_dataset(name, fmt)
+    rows = iter_rows(dataset, catalog, class_name)
+    chunks = _csv_chunks(dataset.columns, rows) if fmt == 'csv' else _ndjson_chunks(dataset.columns, rows)
+    chunks = (chunk.encode('utf-8') for chunk in chunks if chunk)
+    return _gzip(chunks) if compress else chunks
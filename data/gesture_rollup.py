@@ -0,0 +1,13 @@
+import sqlalchemy as sa
+from sqlalchemy import ForeignKey
+from .db_session import SqlAlchemyBase
+
+class GestureRollup(SqlAlchemyBase):
+    """Итоги ответов по жесту для класса (scope - название класса, '' - все ученики), см. data/analytics.py"""
+    __tablename__ = 'gesture_rollups'
+
+    scope = sa.Column(sa.String, primary_key=True)
+    gesture_id = sa.Column(sa.Integer, ForeignKey('gestures.id'), primary_key=True)
+    answers = sa.Column(sa.Integer, nullable=False, default=0)
+    correct = sa.Column(sa.Integer, nullable=False, default=0)
+    mistakes = sa.Column(sa.Integer, nullable=False, default=0) #неправильные ответы, включая историю до появления итогов
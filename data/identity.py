@@ -0,0 +1,118 @@
+"""Кэш личности пользователя для Flask-Login.
+
+user_loader вызывается на каждом запросе авторизованного пользователя.
+Вместо полной строки User (с хэшем пароля и "о себе") мы держим в памяти
+легкий объект Principal с полями, которые нужны маршрутам и шаблонам,
+и достаем его из базы не чаще раза в ttl секунд.
+
+Кэш ограничен по размеру (вытесняется давно не использованный пользователь)
+и сбрасывается для пользователя при выходе и при изменении его данных.
+"""
+import threading
+import time
+from collections import OrderedDict
+
+from . import db_session
+from .users import User
+
+#сколько секунд живет запись кэша и сколько пользователей помним
+DEFAULT_TTL = 60.0
+DEFAULT_MAX_SIZE = 10000
+
+
+class Principal:
+    """Минимальный пользователь для current_user (интерфейс Flask-Login)"""
+
+    __slots__ = ('id', 'username', 'email')
+
+    is_authenticated = True
+    is_active = True
+    is_anonymous = False
+
+    def __init__(self, id, username, email):
+        self.id = id
+        self.username = username
+        self.email = email
+
+    def get_id(self):
+        return str(self.id)
+
+    def __eq__(self, other):
+        return isinstance(other, Principal) and self.id == other.id
+
+    def __hash__(self):
+        return hash(self.id)
+
+
+class IdentityCache:
+    """Кэш Principal по id пользователя с TTL и вытеснением LRU"""
+
+    def __init__(self, ttl=DEFAULT_TTL, max_size=DEFAULT_MAX_SIZE):
+        self.ttl = ttl
+        self.max_size = max_size
+        self._items = OrderedDict()  #user_id -> (principal, время загрузки)
+        self._lock = threading.Lock()
+
+    def get(self, user_id):
+        now = time.monotonic()
+        with self._lock:
+            item = self._items.get(user_id)
+            if item is None:
+                return None
+            principal, loaded_at = item
+            if now - loaded_at >= self.ttl:
+                del self._items[user_id]
+                return None
+            self._items.move_to_end(user_id)
+            return principal
+
+    def put(self, principal):
+        with self._lock:
+            self._items[principal.id] = (principal, time.monotonic())
+            self._items.move_to_end(principal.id)
+            while len(self._items) > self.max_size:
+                self._items.popitem(last=False)
+
+    def invalidate(self, user_id):
+        with self._lock:
+            self._items.pop(user_id, None)
+
+    def clear(self):
+        with self._lock:
+            self._items.clear()
+
+    def __len__(self):
+        return len(self._items)
+
+
+def read_principal(db_sess, user_id):
+    """Читает из базы только поля Principal, без хэша пароля и "о себе" """
+    row = db_sess.query(User.id, User.username, User.email).filter(User.id == user_id).first()
+    return Principal(*row) if row else None
+
+
+_cache = IdentityCache()
+
+
+def configure(ttl=None, max_size=None):
+    """Меняет настройки кэша (например, из конфигурации приложения)"""
+    if ttl is not None:
+        _cache.ttl = ttl
+    if max_size is not None:
+        _cache.max_size = max_size
+
+
+def load_principal(user_id):
+    """Principal для user_loader: из кэша или одним узким запросом"""
+    principal = _cache.get(user_id)
+    if principal is None:
+        #удаленного пользователя не кэшируем - пусть сессия просто станет анонимной
+        principal = read_principal(db_session.get_read_session(), user_id)
+        if principal is not None:
+            _cache.put(principal)
+    return principal
+
+
+def invalidate_identity(user_id):
+    """Сбрасывает кэш пользователя. Вызывать после выхода и после изменения User"""
+    _cache.invalidate(user_id)
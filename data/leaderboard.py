@@ -0,0 +1,147 @@
+"""Рейтинг учеников: общий, по модулю и за неделю.
+
+Очки ученика в таблице рейтинга - число пройденных уроков, а при равенстве
+точность ответов в процентах: score = уроки * 1000 + точность. Очки
+хранятся в leaderboard_scores с индексом (board, score DESC, user_id),
+поэтому первая страница рейтинга - это начало индекса.
+
+Для места ученика рядом хранится гистограмма очков leaderboard_buckets:
+сколько учеников набрали ровно столько очков. Место = 1 + число учеников
+с большими очками, то есть сумма по корзинам выше своей. Различных очков
+немного (уроки * 101 вариант точности), так что место считается за
+время, не зависящее от числа учеников. Ученики с одинаковыми очками
+делят место.
+
+Ответ или пройденный урок меняет строку ученика и две корзины в каждой
+затронутой таблице (общей, модуля и текущей недели) - это несколько
+обращений к индексам, O(log n), в той же транзакции, что и сам ответ.
+"""
+import datetime
+from collections import namedtuple
+
+import sqlalchemy as sa
+from sqlalchemy.dialects.sqlite import insert
+
+from .leaderboard_bucket import LeaderboardBucket
+from .leaderboard_score import LeaderboardScore
+from .users import User
+
+ALL = 'all'
+TOP_SIZE = 20
+#сколько очков дает один пройденный урок; точность (0..100) только различает равных
+LESSON_POINTS = 1000
+
+Standing = namedtuple('Standing', ['user_id', 'username', 'rank', 'score', 'lessons', 'accuracy'])
+
+
+def module_board(module_id):
+    return f'module:{module_id}'
+
+
+def week_board(day=None):
+    year, week, _ = (day or datetime.date.today()).isocalendar()
+    return f'week:{year}-W{week:02d}'
+
+
+def score(lessons, correct, answers):
+    accuracy = correct * 100 // answers if answers else 0
+    return lessons * LESSON_POINTS + accuracy
+
+
+def record(db_sess, user_id, deltas, day=None):
+    """Добавляет ученику пройденные уроки и ответы. Коммит за вызывающим кодом.
+
+    deltas: {module_id: (уроков, правильных ответов, всего ответов)}. Изменения
+    попадают в таблицы модулей, общую и текущей недели.
+    """
+    changes = {}
+    for module_id, delta in deltas.items():
+        changes[module_board(module_id)] = delta
+    total = tuple(map(sum, zip(*deltas.values())))
+    if not total or not any(total):
+        return
+    changes[ALL] = total
+    changes[week_board(day)] = total
+
+    # Старые значения нужны, чтобы переложить ученика из старой корзины в новую;
+    # писатель держит блокировку записи (BEGIN IMMEDIATE), так что чтение и запись согласованы
+    old = {
+        row.board: row for row in db_sess.query(LeaderboardScore).filter(
+            LeaderboardScore.user_id == user_id, LeaderboardScore.board.in_(list(changes))
+        )
+    }
+
+    rows = []
+    buckets = []
+    for board, (lessons, correct, answers) in changes.items():
+        previous = old.get(board)
+        if previous is not None:
+            lessons += previous.lessons
+            correct += previous.correct
+            answers += previous.answers
+        new_score = score(lessons, correct, answers)
+        rows.append({'board': board, 'user_id': user_id, 'lessons': lessons,
+                     'correct': correct, 'answers': answers, 'score': new_score})
+        if previous is None or previous.score != new_score:
+            buckets.append({'board': board, 'score': new_score, 'students': 1})
+            if previous is not None:
+                buckets.append({'board': board, 'score': previous.score, 'students': -1})
+
+    stmt = insert(LeaderboardScore).values(rows)
+    db_sess.execute(stmt.on_conflict_do_update(
+        index_elements=['board', 'user_id'],
+        set_={name: stmt.excluded[name] for name in ('lessons', 'correct', 'answers', 'score')}
+    ))
+    if buckets:
+        stmt = insert(LeaderboardBucket).values(buckets)
+        db_sess.execute(stmt.on_conflict_do_update(
+            index_elements=['board', 'score'],
+            set_={'students': LeaderboardBucket.students + stmt.excluded.students}
+        ))
+
+
+def _accuracy(row):
+    return round(row.correct * 100.0 / row.answers, 1) if row.answers else None
+
+
+def rank_of(db_sess, board, score_value):
+    """Место для очков score_value: 1 + число учеников с большими очками"""
+    above = db_sess.query(sa.func.coalesce(sa.func.sum(LeaderboardBucket.students), 0)).filter(
+        LeaderboardBucket.board == board, LeaderboardBucket.score > score_value
+    ).scalar()
+    return above + 1
+
+
+def top(db_sess, board, limit=TOP_SIZE):
+    """Первые limit учеников таблицы рейтинга"""
+    rows = db_sess.query(LeaderboardScore, User.username).join(
+        User, User.id == LeaderboardScore.user_id
+    ).filter(LeaderboardScore.board == board).order_by(
+        LeaderboardScore.score.desc(), LeaderboardScore.user_id
+    ).limit(limit).all()
+
+    standings = []
+    rank = 1
+    for position, (row, username) in enumerate(rows, start=1):
+        # Равные очки - одно место (1, 2, 2, 4)
+        if position > 1 and row.score != standings[-1].score:
+            rank = position
+        standings.append(Standing(row.user_id, username, rank, row.score, row.lessons, _accuracy(row)))
+    return standings
+
+
+def my_standing(db_sess, board, user_id):
+    """Место ученика в таблице рейтинга или None, если он в ней еще не появился"""
+    found = db_sess.query(LeaderboardScore, User.username).join(
+        User, User.id == LeaderboardScore.user_id
+    ).filter(LeaderboardScore.board == board, LeaderboardScore.user_id == user_id).first()
+    if found is None:
+        return None
+    row, username = found
+    return Standing(user_id, username, rank_of(db_sess, board, row.score), row.score, row.lessons, _accuracy(row))
+
+
+def board_size(db_sess, board):
+    return db_sess.query(sa.func.coalesce(sa.func.sum(LeaderboardBucket.students), 0)).filter(
+        LeaderboardBucket.board == board
+    ).scalar()
@@ -0,0 +1,10 @@
+import sqlalchemy as sa
+from .db_session import SqlAlchemyBase
+
+class LeaderboardBucket(SqlAlchemyBase):
+    """Сколько учеников в таблице рейтинга набрали ровно score очков (см. data/leaderboard.py)"""
+    __tablename__ = 'leaderboard_buckets'
+
+    board = sa.Column(sa.String, primary_key=True)
+    score = sa.Column(sa.Integer, primary_key=True)
+    students = sa.Column(sa.Integer, nullable=False, default=0)
@@ -0,0 +1,17 @@
+import sqlalchemy as sa
+from sqlalchemy import ForeignKey
+from .db_session import SqlAlchemyBase
+
+class LeaderboardScore(SqlAlchemyBase):
+    """Очки ученика в одной таблице рейтинга (см. data/leaderboard.py)"""
+    __tablename__ = 'leaderboard_scores'
+
+    board = sa.Column(sa.String, primary_key=True) #'all', 'module:<id>' или 'week:<год>-W<неделя>'
+    user_id = sa.Column(sa.Integer, ForeignKey('users.id'), primary_key=True)
+    lessons = sa.Column(sa.Integer, nullable=False, default=0)
+    correct = sa.Column(sa.Integer, nullable=False, default=0)
+    answers = sa.Column(sa.Integer, nullable=False, default=0)
+    score = sa.Column(sa.Integer, nullable=False, default=0)
+
+# Первая страница рейтинга - начало этого индекса
+sa.Index('ix_leaderboard_scores_board_score', LeaderboardScore.board, LeaderboardScore.score.desc(), LeaderboardScore.user_id)
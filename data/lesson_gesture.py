@@ -4,6 +4,9 @@ from .db_session import SqlAlchemyBase
 
 class LessonGesture(SqlAlchemyBase):
     __tablename__ = 'lesson_gestures'
+    __table_args__ = (
+        sa.Index('ix_lesson_gestures_lesson_order', 'lesson_id', 'order_index'),
+    )
     
     id = sa.Column(sa.Integer, primary_key=True, autoincrement=True)
     lesson_id = sa.Column(sa.Integer, ForeignKey('lessons.id'), nullable=False)
@@ -0,0 +1,109 @@
+"""Весь урок одним JSON-ответом.
+
+Payload строится только из каталога и общего для всех индекса
+дистракторов, поэтому он одинаковый для всех учеников (кроме уроков
+"Повторение старых", жесты которых берутся из очереди повторения ученика,
+см. data/review.py): варианты ответов
+выбираются и перемешиваются детерминированно для версии каталога и весов
+дистракторов. Когда веса меняются (раз в MISTAKES_INTERVAL, см.
+data/distractors.py), варианты и ETag тоже могут измениться. ETag
+считается от содержимого и позволяет браузеру не скачивать урок повторно.
+"""
+import hashlib
+import json
+import random
+
+from .distractors import pick_distractors
+from .prefetch import next_lesson_videos
+from .review import gesture_lessons
+
+
+def build_options(catalog, lesson, gesture):
+    """Варианты ответов для вопроса, одинаковые для одной версии каталога и весов дистракторов"""
+    rng = random.Random(f'{catalog.version}:{lesson.id}:{gesture.id}')
+
+    options = [{'text': gesture.word, 'is_correct': True}]
+    options += [{'text': word, 'is_correct': False} for word in pick_distractors(catalog, lesson, gesture, rng)]
+    rng.shuffle(options)
+    return options
+
+
+def options_lesson(catalog, lesson, gesture):
+    """Урок, по которому выбираются варианты ответа: жест из очереди повторения - по своему уроку"""
+    if gesture.id in lesson.gesture_ids:
+        return lesson
+    return gesture_lessons(catalog).get(gesture.id, lesson)
+
+
+def build_question(catalog, lesson, number, gesture, video_url):
+    """Один вопрос: жест, видео и варианты ответов. lesson_id - урок, к которому относится ответ"""
+    return {
+        'number': number,
+        'lesson_id': lesson.id,
+        'gesture_id': gesture.id,
+        'word': gesture.word,
+        'description': gesture.description,
+        'video_url': video_url(gesture.video_filename),
+        'options': build_options(catalog, options_lesson(catalog, lesson, gesture), gesture),
+    }
+
+
+def build_lesson_payload(catalog, lesson, video_url, finish_url, gestures=None):
+    """Собирает словарь с уроком целиком.
+
+    video_url - функция, превращающая Gesture.video_filename в URL;
+    finish_url - адрес, на который нужно перейти после последнего вопроса;
+    gestures - жесты вопросов, если они не из курса (урок повторения).
+    """
+    module = catalog.get_module(lesson.module_id)
+    if gestures is None:
+        gestures = catalog.lesson_gestures(lesson.id)
+
+    questions = [
+        build_question(catalog, lesson, number, gesture, video_url)
+        for number, gesture in enumerate(gestures, start=1)
+    ]
+
+    return {
+        'lesson': {
+            'id': lesson.id,
+            'title': lesson.title,
+            'lesson_type': lesson.lesson_type,
+            'module_id': lesson.module_id,
+            'module_title': module.title if module else None,
+        },
+        'catalog_version': catalog.version,
+        'questions': questions,
+        # Первые видео следующего урока - страница подсказывает их браузеру под конец урока
+        'next_lesson_videos': [video_url(name) for name in next_lesson_videos(catalog, lesson)],
+        'finish_url': finish_url,
+    }
+
+
+def build_review_payload(catalog, gestures, lessons, video_url, finish_url):
+    """Занятие "Повторить сейчас": жесты из очереди повторения.
+
+    lessons - {gesture_id: CatalogLesson}, урок, к которому относится каждый жест.
+    """
+    return {
+        'lesson': {
+            'id': None,
+            'title': 'Повторение',
+            'lesson_type': 'review',
+            'module_id': None,
+            'module_title': None,
+        },
+        'catalog_version': catalog.version,
+        'questions': [
+            build_question(catalog, lessons[gesture.id], number, gesture, video_url)
+            for number, gesture in enumerate(gestures, start=1)
+        ],
+        'next_lesson_videos': [],
+        'finish_url': finish_url,
+    }
+
+
+def payload_etag(payload):
+    """Сильный ETag по содержимому payload"""
+    raw = json.dumps(payload, ensure_ascii=False, sort_keys=True).encode('utf-8')
+    return hashlib.sha1(raw).hexdigest()
@@ -0,0 +1,13 @@
+import sqlalchemy as sa
+from sqlalchemy import ForeignKey
+from .db_session import SqlAlchemyBase
+
+class LessonRollup(SqlAlchemyBase):
+    """Итоги ответов и прохождений урока для класса (см. data/analytics.py)"""
+    __tablename__ = 'lesson_rollups'
+
+    scope = sa.Column(sa.String, primary_key=True)
+    lesson_id = sa.Column(sa.Integer, ForeignKey('lessons.id'), primary_key=True)
+    correct_answers = sa.Column(sa.Integer, nullable=False, default=0)
+    total_answers = sa.Column(sa.Integer, nullable=False, default=0)
+    completions = sa.Column(sa.Integer, nullable=False, default=0) #учеников, прошедших урок
@@ -0,0 +1,58 @@
+"""Статусы уроков пользователя: пройден, доступен, заблокирован.
+
+Порядок уроков берется из каталога, а состояние пользователя одним
+запросом к user_lessons, поэтому число запросов не зависит от количества
+модулей и уроков.
+"""
+from .catalog import get_catalog
+from .user_lesson import UserLesson
+
+LOCKED = {'available': False, 'completed': False}
+
+
+def _status(lesson, records):
+    """Статус урока по словарю lesson_id -> пройден ли урок"""
+    if lesson.id in records:
+        # Если есть запись - урок доступен (пройден или нет)
+        return {'available': True, 'completed': records[lesson.id]}
+
+    # Первый урок модуля всегда доступен
+    if lesson.prev_id is None:
+        return {'available': True, 'completed': False}
+
+    # Для остальных уроков - только если предыдущий ПРОЙДЕН
+    if records.get(lesson.prev_id):
+        return {'available': True, 'completed': False}
+
+    return dict(LOCKED)
+
+
+def _load_records(db_sess, user_id, lesson_ids=None):
+    query = db_sess.query(UserLesson.lesson_id, UserLesson.completed_at).filter(
+        UserLesson.user_id == user_id
+    )
+    if lesson_ids is not None:
+        query = query.filter(UserLesson.lesson_id.in_(lesson_ids))
+
+    records = {}
+    for lesson_id, completed_at in query:
+        records[lesson_id] = records.get(lesson_id, False) or completed_at is not None
+    return records
+
+
+def resolve_lesson_statuses(db_sess, user_id, catalog=None):
+    """Статусы всех уроков пользователя: {lesson_id: {'available', 'completed'}}"""
+    catalog = catalog or get_catalog()
+    records = _load_records(db_sess, user_id)
+    return {lesson_id: _status(lesson, records) for lesson_id, lesson in catalog.lessons_by_id.items()}
+
+
+def get_lesson_status(db_sess, user_id, lesson_id, catalog=None):
+    """Статус одного урока. Читает только сам урок и предыдущий"""
+    catalog = catalog or get_catalog()
+    lesson = catalog.get_lesson(lesson_id)
+    if not lesson:
+        return dict(LOCKED)
+
+    lesson_ids = [lesson.id] if lesson.prev_id is None else [lesson.id, lesson.prev_id]
+    return _status(lesson, _load_records(db_sess, user_id, lesson_ids))
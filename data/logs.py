@@ -0,0 +1,38 @@
+"""Логирование без задержек в потоке запроса.
+
+Все записи уходят в QueueHandler: поток запроса только кладет запись в
+очередь в памяти, а форматирование и запись в stderr (или файл) делает
+отдельный поток QueueListener.
+"""
+import atexit
+import logging
+import logging.handlers
+import queue
+
+FORMAT = '%(asctime)s %(levelname)s %(name)s: %(message)s'
+
+_listener = None
+
+
+def configure_logging(level=logging.INFO, filename=None):
+    """Подключает очередь к корневому логгеру. Повторный вызов ничего не делает"""
+    global _listener
+    if _listener is not None:
+        return _listener
+
+    if filename:
+        target = logging.FileHandler(filename, encoding='utf-8')
+    else:
+        target = logging.StreamHandler()
+    target.setFormatter(logging.Formatter(FORMAT))
+
+    records = queue.SimpleQueue()
+    root = logging.getLogger()
+    root.addHandler(logging.handlers.QueueHandler(records))
+    root.setLevel(level)
+
+    _listener = logging.handlers.QueueListener(records, target, respect_handler_level=True)
+    _listener.start()
+    #при выходе дописываем все, что осталось в очереди
+    atexit.register(_listener.stop)
+    return _listener
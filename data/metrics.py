@@ -0,0 +1,223 @@
+"""Метрики запросов и SQL в памяти процесса.
+
+События движков SQLAlchemy считают и замеряют каждый запрос к базе и
+относят его к текущему запросу Flask (по потоку). В конце запроса время
+попадает в гистограмму маршрута, а число и время SQL - в счетчики того
+же маршрута. У потоковых ответов конец запроса - закрытие ответа сервером,
+чтобы SQL генератора тела тоже попал под маршрут. Медленные запросы к базе (дольше SLOW_QUERY_SECONDS) пишутся
+в лог вместе с именем маршрута. SQL фоновых потоков (журнал ответов)
+учитывается под маршрутом BACKGROUND.
+
+Все собирается в текстовом формате Prometheus (render), маршрут /metrics
+в main.py. Дополнительные значения (кэши, подсказки видео) подключаются
+через register_gauge.
+"""
+import logging
+import threading
+import time
+
+import sqlalchemy as sa
+
+#границы корзин гистограммы задержки в секундах
+BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0)
+SLOW_QUERY_SECONDS = 0.1
+BACKGROUND = 'background'
+UNMATCHED = 'unmatched'
+
+slow_log = logging.getLogger('sql.slow')
+
+_local = threading.local()
+
+
+class RequestStats:
+    """SQL одного запроса Flask"""
+
+    __slots__ = ('route', 'started', 'statements', 'sql_seconds', 'streaming')
+
+    def __init__(self, route):
+        self.route = route
+        self.started = time.perf_counter()
+        self.statements = 0
+        self.sql_seconds = 0.0
+        self.streaming = False  #потоковый ответ: замер закроется в call_on_close
+
+
+class Histogram:
+    """Гистограмма Prometheus: накопительные счетчики по корзинам, сумма и число"""
+
+    __slots__ = ('counts', 'total', 'count')
+
+    def __init__(self):
+        self.counts = [0] * len(BUCKETS)
+        self.total = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        for i, bound in enumerate(BUCKETS):
+            if value <= bound:
+                self.counts[i] += 1
+                break
+        self.total += value
+        self.count += 1
+
+
+class Metrics:
+    def __init__(self, slow_query_seconds=SLOW_QUERY_SECONDS):
+        self.slow_query_seconds = slow_query_seconds
+        self._lock = threading.Lock()
+        self.latency = {}  #(маршрут, метод) -> Histogram
+        self.requests = {}  #(маршрут, метод, статус) -> число
+        self.statements = {}  #маршрут -> число запросов к базе
+        self.sql_seconds = {}  #маршрут -> суммарное время запросов к базе
+        self.slow_statements = {}  #маршрут -> число медленных запросов к базе
+        self._gauges = []  #(имя, описание, тип, функция)
+
+    def observe_request(self, route, method, status, seconds, statements, sql_seconds):
+        with self._lock:
+            histogram = self.latency.get((route, method))
+            if histogram is None:
+                histogram = self.latency[(route, method)] = Histogram()
+            histogram.observe(seconds)
+            key = (route, method, status)
+            self.requests[key] = self.requests.get(key, 0) + 1
+            self._add_sql(route, statements, sql_seconds)
+
+    def _add_sql(self, route, statements, sql_seconds):
+        self.statements[route] = self.statements.get(route, 0) + statements
+        self.sql_seconds[route] = self.sql_seconds.get(route, 0.0) + sql_seconds
+
+    def observe_background_statement(self, seconds):
+        with self._lock:
+            self._add_sql(BACKGROUND, 1, seconds)
+
+    def observe_slow(self, route):
+        with self._lock:
+            self.slow_statements[route] = self.slow_statements.get(route, 0) + 1
+
+    def register_gauge(self, name, description, func, kind='gauge'):
+        """func() возвращает число или {значение метки: число} (метка - key)"""
+        self._gauges.append((name, description, kind, func))
+
+    def reset(self):
+        with self._lock:
+            self.latency.clear()
+            self.requests.clear()
+            self.statements.clear()
+            self.sql_seconds.clear()
+            self.slow_statements.clear()
+
+    def render(self):
+        """Все метрики в текстовом формате Prometheus"""
+        with self._lock:
+            latency = {key: (list(h.counts), h.total, h.count) for key, h in self.latency.items()}
+            requests = dict(self.requests)
+            statements = dict(self.statements)
+            sql_seconds = dict(self.sql_seconds)
+            slow = dict(self.slow_statements)
+
+        lines = [
+            '# HELP http_request_duration_seconds Время обработки запроса по маршрутам',
+            '# TYPE http_request_duration_seconds histogram',
+        ]
+        for (route, method), (counts, total, count) in sorted(latency.items()):
+            labels = f'route="{_escape(route)}",method="{method}"'
+            cumulative = 0
+            for bound, bucket in zip(BUCKETS, counts):
+                cumulative += bucket
+                lines.append(f'http_request_duration_seconds_bucket{{{labels},le="{bound}"}} {cumulative}')
+            lines.append(f'http_request_duration_seconds_bucket{{{labels},le="+Inf"}} {count}')
+            lines.append(f'http_request_duration_seconds_sum{{{labels}}} {total:.6f}')
+            lines.append(f'http_request_duration_seconds_count{{{labels}}} {count}')
+
+        lines += ['# HELP http_requests_total Запросы по маршрутам и статусам', '# TYPE http_requests_total counter']
+        for (route, method, status), count in sorted(requests.items()):
+            lines.append(f'http_requests_total{{route="{_escape(route)}",method="{method}",status="{status}"}} {count}')
+
+        for name, description, values, fmt in (
+            ('db_statements_total', 'Запросы к базе по маршрутам', statements, '{}'),
+            ('db_statement_seconds_total', 'Время запросов к базе по маршрутам', sql_seconds, '{:.6f}'),
+            ('db_slow_statements_total', 'Медленные запросы к базе по маршрутам', slow, '{}'),
+        ):
+            lines += [f'# HELP {name} {description}', f'# TYPE {name} counter']
+            for route, value in sorted(values.items()):
+                lines.append(f'{name}{{route="{_escape(route)}"}} ' + fmt.format(value))
+
+        for name, description, kind, func in self._gauges:
+            value = func()
+            lines += [f'# HELP {name} {description}', f'# TYPE {name} {kind}']
+            if isinstance(value, dict):
+                for key, item in sorted(value.items()):
+                    if item is not None:
+                        lines.append(f'{name}{{key="{_escape(str(key))}"}} {item}')
+            elif value is not None:
+                lines.append(f'{name} {value}')
+        return '\n'.join(lines) + '\n'
+
+
+def _escape(value):
+    return value.replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+metrics = Metrics()
+
+
+def instrument_engine(engine, registry=metrics):
+    """Считает и замеряет запросы движка и пишет медленные в лог sql.slow"""
+
+    @sa.event.listens_for(engine, 'before_cursor_execute')
+    def before_execute(conn, cursor, statement, parameters, context, executemany):
+        conn.info.setdefault('query_started', []).append(time.perf_counter())
+
+    @sa.event.listens_for(engine, 'after_cursor_execute')
+    def after_execute(conn, cursor, statement, parameters, context, executemany):
+        seconds = time.perf_counter() - conn.info['query_started'].pop()
+        stats = getattr(_local, 'stats', None)
+        if stats is None:
+            registry.observe_background_statement(seconds)
+            route = BACKGROUND
+        else:
+            stats.statements += 1
+            stats.sql_seconds += seconds
+            route = stats.route
+        if seconds >= registry.slow_query_seconds:
+            registry.observe_slow(route)
+            slow_log.warning('%.1f мс [%s] %s', seconds * 1000, route, ' '.join(statement.split()))
+
+
+def init_app(app, registry=metrics):
+    """Замеры каждого запроса Flask: время, статус и SQL"""
+    from flask import request
+
+    @app.before_request
+    def start_request():
+        rule = request.url_rule
+        _local.stats = RequestStats(rule.rule if rule is not None else UNMATCHED)
+
+    @app.after_request
+    def finish_request(response):
+        stats = getattr(_local, 'stats', None)
+        if stats is not None and response.is_streamed:
+            # Тело потокового ответа (выгрузки, видео) читает базу уже после after_request
+            # и после teardown_request - замер закрывается, когда сервер дочитает ответ
+            stats.streaming = True
+            method, status = request.method, response.status_code
+            response.call_on_close(lambda: _finish(stats, method, status))
+            return response
+        _finish(stats, request.method, response.status_code)
+        return response
+
+    @app.teardown_request
+    def teardown_request(exception=None):
+        #after_request не вызывается, если обработчик упал
+        stats = getattr(_local, 'stats', None)
+        if stats is not None and not stats.streaming:
+            _finish(stats, request.method, 500)
+
+    def _finish(stats, method, status):
+        if stats is None:
+            return
+        if getattr(_local, 'stats', None) is stats:
+            _local.stats = None
+        registry.observe_request(
+            stats.route, method, status, time.perf_counter() - stats.started, stats.statements, stats.sql_seconds
+        )
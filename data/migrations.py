@@ -0,0 +1,323 @@
+"""Версионные миграции схемы базы.
+
+Номер примененной миграции хранится в PRAGMA user_version. При старте
+приложения достаточно прочитать его одной командой: если схема уже
+актуальна, никакой интроспекции таблиц не происходит.
+
+Каждая миграция идемпотентна, поэтому одинаково работает и для новой
+пустой базы, и для старых db/app.db, созданных через create_all.
+Чтобы изменить схему, добавьте функцию в конец MIGRATIONS.
+
+Запуск вручную: python -m data.migrations db/app.db
+"""
+import logging
+import struct
+import sys
+import time
+
+from .db_session import SqlAlchemyBase
+
+log = logging.getLogger(__name__)
+
+
+def _create_tables(conn, *names):
+    """Создает таблицы (вместе с их индексами), если их еще нет"""
+    for name in names:
+        SqlAlchemyBase.metadata.tables[name].create(conn, checkfirst=True)
+
+
+def _create_indexes(conn, table_name):
+    for index in SqlAlchemyBase.metadata.tables[table_name].indexes:
+        index.create(conn, checkfirst=True)
+
+
+def _columns(conn, table_name):
+    return {row[1] for row in conn.exec_driver_sql(f'PRAGMA table_info({table_name})')}
+
+
+def baseline(conn):
+    """Таблицы, которые раньше создавал create_all"""
+    _create_tables(
+        conn,
+        'users', 'modules', 'lessons', 'gestures', 'lesson_gestures',
+        'user_lessons', 'user_progress', 'user_mistakes',
+        'content_version', 'answer_receipts',
+    )
+
+
+def add_completed_lessons(conn):
+    """Счетчик пройденных уроков в user_progress"""
+    if 'completed_lessons' in _columns(conn, 'user_progress'):
+        return
+    conn.exec_driver_sql('ALTER TABLE user_progress ADD COLUMN completed_lessons INTEGER DEFAULT 0')
+    #заполняем счетчик по уже пройденным урокам
+    conn.exec_driver_sql("""
+        UPDATE user_progress SET completed_lessons = (
+            SELECT COUNT(*) FROM user_lessons
+            JOIN lessons ON lessons.id = user_lessons.lesson_id
+            WHERE user_lessons.user_id = user_progress.user_id
+              AND lessons.module_id = user_progress.module_id
+              AND user_lessons.completed_at IS NOT NULL
+        )
+    """)
+
+
+def add_lookup_indexes(conn):
+    """Составные индексы по ключам поиска. Перед уникальными индексами склеиваем дубликаты"""
+    conn.exec_driver_sql("""
+        UPDATE user_lessons SET
+            total_answers = (SELECT SUM(COALESCE(d.total_answers, 0)) FROM user_lessons d
+                             WHERE d.user_id = user_lessons.user_id AND d.lesson_id = user_lessons.lesson_id),
+            correct_answers = (SELECT SUM(COALESCE(d.correct_answers, 0)) FROM user_lessons d
+                               WHERE d.user_id = user_lessons.user_id AND d.lesson_id = user_lessons.lesson_id),
+            completed_at = (SELECT MAX(d.completed_at) FROM user_lessons d
+                            WHERE d.user_id = user_lessons.user_id AND d.lesson_id = user_lessons.lesson_id)
+        WHERE id IN (SELECT MIN(id) FROM user_lessons WHERE user_id IS NOT NULL AND lesson_id IS NOT NULL
+                     GROUP BY user_id, lesson_id HAVING COUNT(*) > 1)
+    """)
+    conn.exec_driver_sql("""
+        DELETE FROM user_lessons
+        WHERE user_id IS NOT NULL AND lesson_id IS NOT NULL
+          AND id NOT IN (SELECT MIN(id) FROM user_lessons GROUP BY user_id, lesson_id)
+    """)
+
+    conn.exec_driver_sql("""
+        UPDATE user_progress SET
+            correct_answers = (SELECT SUM(COALESCE(d.correct_answers, 0)) FROM user_progress d
+                               WHERE d.user_id = user_progress.user_id AND d.module_id = user_progress.module_id),
+            total_questions = (SELECT SUM(COALESCE(d.total_questions, 0)) FROM user_progress d
+                               WHERE d.user_id = user_progress.user_id AND d.module_id = user_progress.module_id),
+            completed_lessons = (SELECT MAX(d.completed_lessons) FROM user_progress d
+                                 WHERE d.user_id = user_progress.user_id AND d.module_id = user_progress.module_id),
+            completion_percentage = (SELECT MAX(d.completion_percentage) FROM user_progress d
+                                     WHERE d.user_id = user_progress.user_id AND d.module_id = user_progress.module_id),
+            is_completed = (SELECT MAX(d.is_completed) FROM user_progress d
+                            WHERE d.user_id = user_progress.user_id AND d.module_id = user_progress.module_id)
+        WHERE id IN (SELECT MIN(id) FROM user_progress GROUP BY user_id, module_id HAVING COUNT(*) > 1)
+    """)
+    conn.exec_driver_sql("""
+        DELETE FROM user_progress
+        WHERE id NOT IN (SELECT MIN(id) FROM user_progress GROUP BY user_id, module_id)
+    """)
+
+    conn.exec_driver_sql("""
+        UPDATE user_mistakes SET
+            mistake_count = (SELECT SUM(COALESCE(d.mistake_count, 1)) FROM user_mistakes d
+                             WHERE d.user_id = user_mistakes.user_id AND d.gesture_id = user_mistakes.gesture_id
+                               AND d.lesson_id = user_mistakes.lesson_id),
+            incorrect_answer = (SELECT d.incorrect_answer FROM user_mistakes d
+                                WHERE d.user_id = user_mistakes.user_id AND d.gesture_id = user_mistakes.gesture_id
+                                  AND d.lesson_id = user_mistakes.lesson_id
+                                ORDER BY d.id DESC LIMIT 1)
+        WHERE id IN (SELECT MIN(id) FROM user_mistakes WHERE lesson_id IS NOT NULL
+                     GROUP BY user_id, gesture_id, lesson_id HAVING COUNT(*) > 1)
+    """)
+    conn.exec_driver_sql("""
+        DELETE FROM user_mistakes
+        WHERE lesson_id IS NOT NULL
+          AND id NOT IN (SELECT MIN(id) FROM user_mistakes WHERE lesson_id IS NOT NULL
+                         GROUP BY user_id, gesture_id, lesson_id)
+    """)
+
+    for table_name in ('user_lessons', 'user_progress', 'user_mistakes', 'lesson_gestures'):
+        _create_indexes(conn, table_name)
+
+
+def add_review_queues(conn):
+    """Очереди интервального повторения (упакованные строки review_queues)"""
+    #review_queues заменила таблица review_items: ее создает и заполняет add_review_items,
+    #а базы, где эта миграция уже прошла, переносит туда же
+
+
+def add_mistake_page_indexes(conn):
+    """Индексы для постраничного списка ошибок"""
+    #у ошибок старого формата мог не быть модуля или счетчика
+    conn.exec_driver_sql("""
+        UPDATE user_mistakes SET module_id = (SELECT module_id FROM lessons WHERE lessons.id = user_mistakes.lesson_id)
+        WHERE module_id IS NULL AND lesson_id IS NOT NULL
+    """)
+    conn.exec_driver_sql('UPDATE user_mistakes SET mistake_count = 1 WHERE mistake_count IS NULL')
+    _create_indexes(conn, 'user_mistakes')
+
+
+def add_user_state(conn):
+    """Версии состояния пользователей для кэша страниц (см. data/render_cache.py)"""
+    _create_tables(conn, 'user_state')
+
+
+#ученики с их областями итогов: '' - все ученики, и класс, если он указан
+_SCOPES = """
+    WITH scopes AS (
+        SELECT id AS user_id, '' AS scope FROM users
+        UNION ALL
+        SELECT id, class_name FROM users WHERE class_name IS NOT NULL
+    )
+"""
+
+
+def add_class_rollups(conn):
+    """Классы учеников и итоги для аналитики учителя, заполненные по накопленным данным"""
+    if 'class_name' not in _columns(conn, 'users'):
+        conn.exec_driver_sql('ALTER TABLE users ADD COLUMN class_name VARCHAR')
+    _create_indexes(conn, 'users')
+    _create_tables(conn, 'gesture_rollups', 'lesson_rollups', 'module_histograms')
+
+    #по жестам в истории есть только ошибки, ответы начнут считаться с этой версии
+    conn.exec_driver_sql(_SCOPES + """
+        INSERT OR IGNORE INTO gesture_rollups (scope, gesture_id, answers, correct, mistakes)
+        SELECT scopes.scope, m.gesture_id, 0, 0, SUM(COALESCE(m.mistake_count, 1))
+        FROM user_mistakes m JOIN scopes ON scopes.user_id = m.user_id
+        GROUP BY scopes.scope, m.gesture_id
+    """)
+    conn.exec_driver_sql(_SCOPES + """
+        INSERT OR IGNORE INTO lesson_rollups (scope, lesson_id, correct_answers, total_answers, completions)
+        SELECT scopes.scope, ul.lesson_id, SUM(COALESCE(ul.correct_answers, 0)),
+               SUM(COALESCE(ul.total_answers, 0)), SUM(ul.completed_at IS NOT NULL)
+        FROM user_lessons ul JOIN scopes ON scopes.user_id = ul.user_id
+        WHERE ul.lesson_id IS NOT NULL
+        GROUP BY scopes.scope, ul.lesson_id
+    """)
+    conn.exec_driver_sql(_SCOPES + """
+        INSERT OR IGNORE INTO module_histograms (scope, module_id, completed_lessons, students)
+        SELECT scopes.scope, p.module_id, p.completed_lessons, COUNT(*)
+        FROM user_progress p JOIN scopes ON scopes.user_id = p.user_id
+        WHERE p.completed_lessons > 0
+        GROUP BY scopes.scope, p.module_id, p.completed_lessons
+    """)
+
+
+def add_leaderboards(conn):
+    """Таблицы рейтинга, общая и по модулям заполнены по прогрессу учеников"""
+    from .leaderboard import LESSON_POINTS
+
+    _create_tables(conn, 'leaderboard_scores', 'leaderboard_buckets')
+    score = f"""lessons * {LESSON_POINTS} + CASE WHEN answers > 0 THEN correct * 100 / answers ELSE 0 END"""
+    conn.exec_driver_sql(f"""
+        INSERT OR IGNORE INTO leaderboard_scores (board, user_id, lessons, correct, answers, score)
+        SELECT board, user_id, lessons, correct, answers, {score} FROM (
+            SELECT 'module:' || module_id AS board, user_id,
+                   COALESCE(completed_lessons, 0) AS lessons,
+                   COALESCE(correct_answers, 0) AS correct,
+                   COALESCE(total_questions, 0) AS answers
+            FROM user_progress
+            UNION ALL
+            SELECT 'all', user_id, SUM(COALESCE(completed_lessons, 0)),
+                   SUM(COALESCE(correct_answers, 0)), SUM(COALESCE(total_questions, 0))
+            FROM user_progress GROUP BY user_id
+        ) WHERE lessons > 0 OR answers > 0
+    """)
+    #недельные таблицы начинаются с пустой текущей недели
+    conn.exec_driver_sql("""
+        INSERT OR IGNORE INTO leaderboard_buckets (board, score, students)
+        SELECT board, score, COUNT(*) FROM leaderboard_scores GROUP BY board, score
+    """)
+
+
+def add_distractor_weights(conn):
+    """Веса вариантов ответа по ошибкам, заполненные по накопленным ошибкам"""
+    from .distractors import normalize_word
+
+    _create_tables(conn, 'distractor_weights')
+    #слова нормализуем в Python: lower() в SQLite не понимает кириллицу
+    vocabulary = {normalize_word(word) for (word,) in conn.exec_driver_sql('SELECT word FROM gestures')}
+    weights = {}
+    rows = conn.exec_driver_sql("""
+        SELECT gesture_id, incorrect_answer, SUM(COALESCE(mistake_count, 1)) FROM user_mistakes
+        WHERE incorrect_answer IS NOT NULL GROUP BY gesture_id, incorrect_answer
+    """)
+    for gesture_id, answer, count in rows:
+        word = normalize_word(answer)
+        if word in vocabulary:
+            weights[(gesture_id, word)] = weights.get((gesture_id, word), 0) + int(count or 0)
+    if weights:
+        conn.exec_driver_sql(
+            'INSERT OR IGNORE INTO distractor_weights (gesture_id, word, mistakes) VALUES (?, ?, ?)',
+            [(gesture_id, word, count) for (gesture_id, word), count in weights.items()]
+        )
+
+
+def add_receipt_age_index(conn):
+    """Индекс по времени ключей идемпотентности, чтобы удалять старые"""
+    conn.exec_driver_sql("UPDATE answer_receipts SET created_at = datetime('now', 'localtime') WHERE created_at IS NULL")
+    _create_indexes(conn, 'answer_receipts')
+
+
+#запись упакованной очереди review_queues: срок, жест, интервал, серия
+_QUEUE_ITEM = struct.Struct('<IIIB')
+
+
+def add_review_items(conn):
+    """Очередь повторения строкой на жест вместо упакованной строки на ученика"""
+    _create_tables(conn, 'review_items')
+    tables = {name for (name,) in conn.exec_driver_sql("SELECT name FROM sqlite_master WHERE type = 'table'")}
+    if 'review_queues' in tables:
+        for user_id, data in conn.exec_driver_sql('SELECT user_id, data FROM review_queues').fetchall():
+            rows = [(user_id, gesture_id, due, interval, streak)
+                    for due, gesture_id, interval, streak in _QUEUE_ITEM.iter_unpack(data or b'')]
+            if rows:
+                conn.exec_driver_sql(
+                    'INSERT OR IGNORE INTO review_items (user_id, gesture_id, due, interval, streak) '
+                    'VALUES (?, ?, ?, ?, ?)',
+                    rows
+                )
+        conn.exec_driver_sql('DROP TABLE review_queues')
+
+    #у учеников без очереди все прошлые ошибки - к повторению прямо сейчас
+    conn.exec_driver_sql("""
+        INSERT OR IGNORE INTO review_items (user_id, gesture_id, due, interval, streak)
+        SELECT user_id, gesture_id, ?, 0, 0 FROM user_mistakes
+        WHERE user_id NOT IN (SELECT user_id FROM review_items)
+        GROUP BY user_id, gesture_id
+    """, (int(time.time()),))
+
+
+#порядок менять нельзя: номер миграции - ее позиция в списке, начиная с 1
+MIGRATIONS = [
+    baseline,
+    add_completed_lessons,
+    add_lookup_indexes,
+    add_review_queues,
+    add_mistake_page_indexes,
+    add_user_state,
+    add_class_rollups,
+    add_leaderboards,
+    add_distractor_weights,
+    add_receipt_age_index,
+    add_review_items,
+]
+
+
+def current_version(conn):
+    return conn.exec_driver_sql('PRAGMA user_version').scalar()
+
+
+def migrate(engine):
+    """Применяет недостающие миграции. Возвращает номер версии схемы"""
+    latest = len(MIGRATIONS)
+
+    with engine.connect() as conn:
+        if current_version(conn) >= latest:
+            return latest
+
+    from . import __all_models  # noqa: F401 - миграциям нужны описания всех таблиц
+
+    #одна транзакция с блокировкой записи: параллельно стартующие процессы
+    #дождутся друг друга и не применят миграции дважды
+    with engine.begin() as conn:
+        version = current_version(conn)
+        for number, migration in enumerate(MIGRATIONS, start=1):
+            if number <= version:
+                continue
+            log.info("Миграция схемы %s: %s", number, migration.__doc__.strip().splitlines()[0])
+            migration(conn)
+            conn.exec_driver_sql(f'PRAGMA user_version = {number}')
+        return max(version, latest)
+
+
+if __name__ == '__main__':
+    from . import db_session
+
+    logging.basicConfig(level=logging.INFO, format='%(message)s')
+    db_session.global_init(sys.argv[1] if len(sys.argv) > 1 else 'db/app.db')
+    with db_session.create_read_session() as db_sess:
+        print(f"Версия схемы: {current_version(db_sess.connection())} из {len(MIGRATIONS)}")
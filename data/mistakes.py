@@ -0,0 +1,139 @@
+"""Список ошибок пользователя постранично.
+
+Страница строится одним запросом user_mistakes JOIN gestures, а названия
+модулей и уроков берутся из каталога. Вместо OFFSET используется keyset-
+пагинация: курсор хранит ключ сортировки последней показанной ошибки, и
+следующая страница начинается поиском по индексу с этого места. Поэтому
+страница стоит одинаково и для десятка ошибок, и для тысяч.
+
+Два порядка:
+  - lesson: по модулям и урокам, внутри урока - по числу ошибок;
+  - count: сначала самые частые ошибки.
+Итоги по модулям считаются отдельным GROUP BY по тому же индексу.
+
+Ошибки старого формата без урока (lesson_id IS NULL) есть только в порядке count.
+"""
+import base64
+import json
+
+import sqlalchemy as sa
+
+from .gesture import Gesture
+from .user_mistake import UserMistake
+
+PAGE_SIZE = 20
+MAX_PAGE_SIZE = 100
+SORTS = ('lesson', 'count')
+
+
+class CursorError(ValueError):
+    """Испорченный курсор страницы"""
+
+
+def encode_cursor(sort, key):
+    raw = json.dumps([sort] + list(key), separators=(',', ':')).encode('utf-8')
+    return base64.urlsafe_b64encode(raw).decode('ascii').rstrip('=')
+
+
+def decode_cursor(sort, cursor):
+    try:
+        raw = base64.urlsafe_b64decode(cursor + '=' * (-len(cursor) % 4))
+        data = json.loads(raw)
+    except (ValueError, TypeError):
+        raise CursorError('Некорректный курсор')
+    size = 5 if sort == 'lesson' else 3
+    if (not isinstance(data, list) or len(data) != size or data[0] != sort
+            or not all(isinstance(value, int) for value in data[1:])):
+        raise CursorError('Некорректный курсор')
+    return data[1:]
+
+
+def _sort_key(sort, row):
+    if sort == 'lesson':
+        return (row.module_id, row.lesson_id, row.mistake_count or 0, row.id)
+    return (row.mistake_count or 0, row.id)
+
+
+def mistakes_page(db_sess, user_id, sort='lesson', after=None, limit=PAGE_SIZE):
+    """Одна страница ошибок: (строки, курсор следующей страницы или None)"""
+    limit = max(1, min(limit, MAX_PAGE_SIZE))
+    query = db_sess.query(
+        UserMistake.id,
+        UserMistake.module_id,
+        UserMistake.lesson_id,
+        UserMistake.gesture_id,
+        UserMistake.incorrect_answer,
+        UserMistake.mistake_count,
+        Gesture.word.label('gesture_word'),
+    ).join(Gesture, Gesture.id == UserMistake.gesture_id).filter(UserMistake.user_id == user_id)
+
+    if sort == 'lesson':
+        query = query.filter(UserMistake.module_id.isnot(None), UserMistake.lesson_id.isnot(None))
+        if after is not None:
+            module_id, lesson_id, count, mistake_id = after
+            # Поиск по индексу начинается с урока курсора; уже показанные ошибки
+            # этого урока (их не больше, чем жестов в уроке) отсеиваются фильтром
+            query = query.filter(
+                sa.tuple_(UserMistake.module_id, UserMistake.lesson_id) >= sa.tuple_(module_id, lesson_id),
+                sa.not_(sa.and_(
+                    UserMistake.module_id == module_id,
+                    UserMistake.lesson_id == lesson_id,
+                    sa.tuple_(UserMistake.mistake_count, UserMistake.id) >= sa.tuple_(count, mistake_id),
+                ))
+            )
+        query = query.order_by(
+            UserMistake.module_id, UserMistake.lesson_id,
+            UserMistake.mistake_count.desc(), UserMistake.id.desc()
+        )
+    else:
+        if after is not None:
+            count, mistake_id = after
+            query = query.filter(sa.tuple_(UserMistake.mistake_count, UserMistake.id) < sa.tuple_(count, mistake_id))
+        query = query.order_by(UserMistake.mistake_count.desc(), UserMistake.id.desc())
+
+    rows = query.limit(limit + 1).all()
+    next_cursor = None
+    if len(rows) > limit:
+        rows = rows[:limit]
+        next_cursor = encode_cursor(sort, _sort_key(sort, rows[-1]))
+    return rows, next_cursor
+
+
+def module_totals(db_sess, user_id):
+    """Итоги по модулям: {module_id: (разных ошибок, всего ошибок)}"""
+    query = db_sess.query(
+        UserMistake.module_id,
+        sa.func.count(),
+        sa.func.sum(sa.func.coalesce(UserMistake.mistake_count, 1))
+    ).filter(UserMistake.user_id == user_id).group_by(UserMistake.module_id)
+    return {module_id: (distinct, int(total or 0)) for module_id, distinct, total in query}
+
+
+def describe_mistake(catalog, row):
+    """Ошибка для шаблона и JSON: поля строки плюс названия модуля и урока из каталога"""
+    module = catalog.get_module(row.module_id)
+    lesson = catalog.get_lesson(row.lesson_id)
+    return {
+        'id': row.id,
+        'gesture_id': row.gesture_id,
+        'gesture_word': row.gesture_word,
+        'incorrect_answer': row.incorrect_answer,
+        'mistake_count': row.mistake_count or 0,
+        'module_id': row.module_id,
+        'module_title': module.title if module else None,
+        'lesson_id': row.lesson_id,
+        'lesson_title': lesson.title if lesson else None,
+    }
+
+
+def describe_totals(catalog, totals):
+    """Итоги по модулям в порядке каталога (ошибки без модуля - в конце)"""
+    modules = []
+    for module in catalog.modules:
+        if module.id in totals:
+            distinct, total = totals[module.id]
+            modules.append({'module_id': module.id, 'title': module.title, 'mistakes': distinct, 'total': total})
+    for module_id, (distinct, total) in totals.items():
+        if catalog.get_module(module_id) is None:
+            modules.append({'module_id': module_id, 'title': None, 'mistakes': distinct, 'total': total})
+    return modules
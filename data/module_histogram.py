@@ -0,0 +1,12 @@
+import sqlalchemy as sa
+from sqlalchemy import ForeignKey
+from .db_session import SqlAlchemyBase
+
+class ModuleHistogram(SqlAlchemyBase):
+    """Сколько учеников класса прошли ровно completed_lessons уроков модуля (см. data/analytics.py)"""
+    __tablename__ = 'module_histograms'
+
+    scope = sa.Column(sa.String, primary_key=True)
+    module_id = sa.Column(sa.Integer, ForeignKey('modules.id'), primary_key=True)
+    completed_lessons = sa.Column(sa.Integer, primary_key=True)
+    students = sa.Column(sa.Integer, nullable=False, default=0)
@@ -0,0 +1,148 @@
+"""Офлайн-режим: манифест предзагрузки и синхронизация накопленного.
+
+Манифест ученика - список адресов, которые service worker (templates/sw.js)
+держит в кэше, с ревизией каждого адреса:
+  - shell: HTML-страницы (список уроков, прогресс и страница каждого
+    открытого урока);
+  - lesson: JSON открытых уроков (/api/lesson/<id>), ревизия - ETag payload;
+  - video: видео жестов этих уроков, адрес и ревизия - хэш содержимого.
+Версия манифеста - хэш всех пар (адрес, ревизия). Клиент присылает версию,
+которая у него уже есть, и если сервер недавно выдавал ее, в ответ уходит
+только разница: новые или изменившиеся адреса и удаленные. Иначе (другой
+процесс, версия вытеснена из памяти) - манифест целиком.
+
+Синхронизация принимает ответы и завершенные без сети уроки. Ответы идут
+обычным путем с ключами идемпотентности (см. data/answers.py), а уроки
+завершаются по порядку в одной транзакции и с той же проверкой доступа,
+что и онлайн: повтор ничего не меняет, а урок, до которого ученик не
+дошел, отклоняется.
+"""
+import hashlib
+import os
+import threading
+from collections import OrderedDict, namedtuple
+
+from .answers import MAX_BATCH_SIZE, is_id, parse_answers
+from .lesson_status import resolve_lesson_statuses
+from .progress import complete_lesson
+
+#сколько последних версий манифестов помнит процесс, чтобы отдавать разницу
+MANIFEST_CACHE_SIZE = 1024
+
+Entry = namedtuple('Entry', ['url', 'kind', 'revision'])
+
+
+class SyncError(ValueError):
+    """Некорректный запрос синхронизации"""
+
+
+def directory_digest(directory):
+    """Хэш файлов папки (шаблонов): меняется при выкладке новой версии страниц"""
+    digest = hashlib.sha1()
+    for root, dirs, files in os.walk(directory):
+        dirs.sort()
+        for name in sorted(files):
+            path = os.path.join(root, name)
+            digest.update(os.path.relpath(path, directory).encode('utf-8'))
+            with open(path, 'rb') as f:
+                digest.update(f.read())
+    return digest.hexdigest()[:16]
+
+
+def unlocked_lessons(db_sess, user_id, catalog):
+    """Открытые ученику уроки с жестами в порядке каталога"""
+    statuses = resolve_lesson_statuses(db_sess, user_id, catalog)
+    return [
+        lesson
+        for module in catalog.modules
+        for lesson in catalog.module_lessons(module.id)
+        if statuses[lesson.id]['available'] and lesson.gesture_ids
+    ]
+
+
+def manifest_version(entries):
+    raw = '\n'.join(sorted(f'{entry.url} {entry.revision}' for entry in entries))
+    return hashlib.sha1(raw.encode('utf-8')).hexdigest()
+
+
+class ManifestCache:
+    """Недавно выданные манифесты: версия -> {адрес: ревизия}"""
+
+    def __init__(self, max_size=MANIFEST_CACHE_SIZE):
+        self.max_size = max_size
+        self._items = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, version):
+        with self._lock:
+            revisions = self._items.get(version)
+            if revisions is not None:
+                self._items.move_to_end(version)
+            return revisions
+
+    def put(self, version, entries):
+        with self._lock:
+            self._items[version] = {entry.url: entry.revision for entry in entries}
+            self._items.move_to_end(version)
+            while len(self._items) > self.max_size:
+                self._items.popitem(last=False)
+
+    def __len__(self):
+        return len(self._items)
+
+
+def manifest_response(entries, cache, since=None):
+    """Манифест для клиента: целиком или разница с версией since"""
+    version = manifest_version(entries)
+    cache.put(version, entries)
+    known = cache.get(since) if since else None
+    if known is None:
+        return {'version': version, 'full': True, 'entries': [entry._asdict() for entry in entries], 'remove': []}
+
+    urls = {entry.url for entry in entries}
+    return {
+        'version': version,
+        'full': False,
+        'entries': [entry._asdict() for entry in entries if known.get(entry.url) != entry.revision],
+        'remove': sorted(url for url in known if url not in urls),
+    }
+
+
+def parse_sync(data, catalog):
+    """Ответы и уроки из запроса синхронизации: (ответы, ключи отклоненных ответов, уроки по порядку).
+
+    Ответы проверяются по одному, как в /save_answers: один некорректный
+    ответ не должен отклонять остальные ответы и завершенные уроки.
+    """
+    if not isinstance(data, dict):
+        raise SyncError('Нет данных')
+    items = data.get('answers') or []
+    lesson_ids = data.get('completions') or []
+    if not isinstance(items, list) or not isinstance(lesson_ids, list):
+        raise SyncError('answers и completions должны быть списками')
+    if not all(is_id(lesson_id) for lesson_id in lesson_ids):
+        raise SyncError('completions - список id уроков')
+    if len(items) > MAX_BATCH_SIZE:
+        raise SyncError(f'Не больше {MAX_BATCH_SIZE} ответов за раз')
+    if len(lesson_ids) > len(catalog.lessons_by_id):
+        raise SyncError('Уроков больше, чем в курсе')
+
+    answers, rejected_keys = parse_answers(items, catalog)
+    return answers, rejected_keys, list(dict.fromkeys(lesson_ids))
+
+
+def apply_completions(db_sess, user_id, lesson_ids, catalog):
+    """Завершает уроки по порядку. Коммит за вызывающим кодом.
+
+    Возвращает (завершенные, отклоненные) id. Уже пройденный урок считается
+    завершенным: complete_lesson повторно ничего не меняет.
+    """
+    completed, rejected = [], []
+    for lesson_id in lesson_ids:
+        lesson = catalog.get_lesson(lesson_id)
+        # Следующий урок открывается предыдущим в этой же транзакции, поэтому порядок важен
+        if lesson is not None and complete_lesson(db_sess, user_id, lesson, catalog):
+            completed.append(lesson.id)
+        else:
+            rejected.append(lesson_id)
+    return completed, rejected
@@ -0,0 +1,96 @@
+"""Подсказки браузеру, какие видео жестов скачать заранее.
+
+Пока ученик отвечает на вопрос, браузер может в фоне скачать видео
+следующего вопроса, а ближе к концу урока - первые видео урока, который
+откроется после него. Что будет дальше, определяется порядком уроков в
+каталоге, без запросов к базе.
+
+Сколько подсказок оказались полезными, сообщает сама страница урока
+(см. /prefetch_report): сервер считает выданные подсказки, а клиент -
+сколько подсказанных видео потом действительно проигрывались.
+"""
+import threading
+
+#сколько первых видео следующего урока подсказываем
+NEXT_LESSON_VIDEOS = 2
+#за сколько вопросов до конца урока начинаем подсказывать следующий урок
+NEXT_LESSON_LEAD = 2
+
+
+def next_lesson(catalog, lesson):
+    """Урок, который откроется после этого: следующий в модуле или первый в следующем модуле"""
+    if lesson.next_id is not None:
+        return catalog.get_lesson(lesson.next_id)
+
+    module_ids = [module.id for module in catalog.modules]
+    if lesson.module_id not in module_ids:
+        return None
+    for module in catalog.modules[module_ids.index(lesson.module_id) + 1:]:
+        if module.lesson_ids:
+            return catalog.get_lesson(module.lesson_ids[0])
+    return None
+
+
+def next_lesson_videos(catalog, lesson, limit=NEXT_LESSON_VIDEOS):
+    """Имена файлов первых видео следующего урока"""
+    following = next_lesson(catalog, lesson)
+    if following is None:
+        return []
+    return [gesture.video_filename for gesture in catalog.lesson_gestures(following.id)[:limit]]
+
+
+def prefetch_videos(catalog, lesson, question, gestures=None):
+    """Видео, которые понадобятся после вопроса question (нумерация с 1).
+
+    gestures - жесты вопросов, если они не из курса (урок повторения).
+    """
+    if gestures is None:
+        gestures = catalog.lesson_gestures(lesson.id)
+    filenames = []
+    if question < len(gestures):
+        filenames.append(gestures[question].video_filename)
+    if question > len(gestures) - NEXT_LESSON_LEAD:
+        filenames += next_lesson_videos(catalog, lesson)
+
+    current = gestures[question - 1].video_filename if 0 < question <= len(gestures) else None
+    return [name for name in dict.fromkeys(filenames) if name != current]
+
+
+def link_header(urls):
+    """Значение заголовка Link с подсказками prefetch"""
+    return ', '.join(f'<{url}>; rel=prefetch; as=video' for url in urls)
+
+
+class PrefetchStats:
+    """Счетчики подсказок в памяти процесса"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.hints_sent = 0  #видео, подсказанных сервером
+        self.reported_hinted = 0  #подсказок, о которых отчитались страницы
+        self.reported_used = 0  #подсказанных видео, которые потом проигрывались
+        self.reported_cache_hits = 0  #из них взяты из кэша браузера (по Resource Timing)
+
+    def record_hints(self, count):
+        with self._lock:
+            self.hints_sent += count
+
+    def record_report(self, hinted, used, cache_hits):
+        with self._lock:
+            self.reported_hinted += hinted
+            self.reported_used += used
+            self.reported_cache_hits += cache_hits
+
+    def snapshot(self):
+        with self._lock:
+            hinted = self.reported_hinted
+            return {
+                'hints_sent': self.hints_sent,
+                'reported_hinted': hinted,
+                'reported_used': self.reported_used,
+                'reported_cache_hits': self.reported_cache_hits,
+                'use_rate': round(self.reported_used / hinted, 3) if hinted else None,
+            }
+
+
+stats = PrefetchStats()
@@ -0,0 +1,98 @@
+"""Прогресс пользователя по модулям.
+
+UserProgress хранит готовые счетчики: страницы уроков и прогресса их
+только читают, а меняются они в момент, когда урок впервые становится
+пройденным (finish_lesson).
+"""
+from datetime import datetime
+
+import sqlalchemy as sa
+from sqlalchemy.dialects.sqlite import insert
+
+from . import analytics
+from . import leaderboard
+from .lesson_status import get_lesson_status
+from .render_cache import bump_state_version
+from .user_lesson import UserLesson
+from .user_progress import UserProgress
+
+
+def completion_percentage(completed_lessons, total_lessons):
+    if total_lessons <= 0:
+        return 0.0
+    return min(100.0, completed_lessons * 100.0 / total_lessons)
+
+
+def record_lesson_completion(db_sess, user_id, lesson, catalog):
+    """Учитывает впервые пройденный урок в прогрессе модуля. Коммит за вызывающим кодом.
+
+    Счетчик увеличивается одним upsert-запросом на стороне базы, без чтения строки.
+    Возвращает новое число пройденных уроков модуля.
+    """
+    total_lessons = catalog.lesson_count(lesson.module_id)
+    # Финальный урок закрывает модуль целиком
+    is_final = lesson.lesson_type == 'final_review'
+
+    completed_lessons = sa.func.coalesce(UserProgress.completed_lessons, 0) + 1
+    update = {'completed_lessons': completed_lessons}
+    if is_final:
+        update['completion_percentage'] = 100.0
+        update['is_completed'] = True
+    elif total_lessons > 0:
+        update['completion_percentage'] = sa.func.min(100.0, completed_lessons * 100.0 / total_lessons)
+
+    return db_sess.execute(
+        insert(UserProgress)
+        .values(
+            user_id=user_id,
+            module_id=lesson.module_id,
+            correct_answers=0,
+            total_questions=0,
+            completed_lessons=1,
+            completion_percentage=100.0 if is_final else completion_percentage(1, total_lessons),
+            is_completed=is_final
+        )
+        .on_conflict_do_update(index_elements=['user_id', 'module_id'], set_=update)
+        .returning(UserProgress.completed_lessons)
+    ).scalar()
+
+
+def complete_lesson(db_sess, user_id, lesson, catalog):
+    """Отмечает урок пройденным и открывает следующий. Коммит за вызывающим кодом.
+
+    Возвращает False, если урок пользователю еще недоступен.
+    """
+    # Завершить можно только доступный урок
+    if not get_lesson_status(db_sess, user_id, lesson.id, catalog)['available']:
+        return False
+
+    # Отмечаем текущий урок как завершенный. Строку upsert возвращает, только
+    # если урок проходится впервые: повторное завершение ничего не меняет
+    now = datetime.now()
+    stmt = insert(UserLesson).values(user_id=user_id, lesson_id=lesson.id, completed_at=now)
+    first_time = db_sess.execute(
+        stmt.on_conflict_do_update(
+            index_elements=['user_id', 'lesson_id'],
+            set_={'completed_at': now},
+            where=UserLesson.completed_at.is_(None)
+        ).returning(UserLesson.id)
+    ).first() is not None
+
+    # Следующий урок В ТОМ ЖЕ МОДУЛЕ берем из каталога и создаем для него запись, если ее нет
+    if lesson.next_id is not None:
+        db_sess.execute(
+            insert(UserLesson)
+            .values(user_id=user_id, lesson_id=lesson.next_id, completed_at=None)
+            .on_conflict_do_nothing(index_elements=['user_id', 'lesson_id'])
+        )
+
+    # Обновляем прогресс модуля
+    if first_time:
+        completed_lessons = record_lesson_completion(db_sess, user_id, lesson, catalog)
+        # Итоги класса для учителя (см. data/analytics.py)
+        analytics.record_completion(db_sess, user_id, lesson, completed_lessons)
+        leaderboard.record(db_sess, user_id, {lesson.module_id: (1, 0, 0)})
+
+    bump_state_version(db_sess, user_id)
+
+    return True
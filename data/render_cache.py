@@ -0,0 +1,90 @@
+"""Кэш отрисованных страниц пользователя.
+
+Страницы /lessons и /progress меняются только когда пользователь отвечает
+на вопросы или завершает урок. Каждая такая запись увеличивает версию
+состояния пользователя (таблица user_state) в той же транзакции, поэтому
+ключ (страница, пользователь, версия состояния, версия каталога) однозначно
+определяет HTML. По этому ключу считается ETag: на If-None-Match отвечаем
+304 вообще без отрисовки, а готовый HTML держим в памяти в LRU-кэше,
+ограниченном суммарным размером.
+"""
+import hashlib
+import threading
+from collections import OrderedDict
+
+from sqlalchemy.dialects.sqlite import insert
+
+from .user_state import UserState
+
+#сколько байт HTML держим в кэше
+DEFAULT_MAX_BYTES = 16 * 1024 * 1024
+
+
+def read_state_version(db_sess, user_id):
+    version = db_sess.query(UserState.version).filter(UserState.user_id == user_id).scalar()
+    return version or 0
+
+
+def bump_state_version(db_sess, user_id):
+    """Увеличивает версию состояния пользователя. Коммит за вызывающим кодом"""
+    db_sess.execute(
+        insert(UserState)
+        .values(user_id=user_id, version=1)
+        .on_conflict_do_update(index_elements=['user_id'], set_={'version': UserState.version + 1})
+    )
+
+
+def page_etag(key):
+    """ETag страницы по ее ключу - без отрисовки"""
+    return hashlib.sha1(repr(key).encode('utf-8')).hexdigest()
+
+
+class RenderCache:
+    """LRU-кэш HTML, ограниченный суммарным размером в байтах"""
+
+    def __init__(self, max_bytes=DEFAULT_MAX_BYTES):
+        self.max_bytes = max_bytes
+        self.size = 0
+        self.hits = 0
+        self.misses = 0
+        self._items = OrderedDict()  #ключ -> (HTML, размер в байтах)
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            item = self._items.get(key)
+            if item is None:
+                self.misses += 1
+                return None
+            self._items.move_to_end(key)
+            self.hits += 1
+            return item[0]
+
+    def put(self, key, html):
+        size = len(html.encode('utf-8'))
+        if size > self.max_bytes:
+            return
+        with self._lock:
+            old = self._items.pop(key, None)
+            if old is not None:
+                self.size -= old[1]
+            self._items[key] = (html, size)
+            self.size += size
+            while self.size > self.max_bytes:
+                _, (_, evicted_size) = self._items.popitem(last=False)
+                self.size -= evicted_size
+
+    def get_or_render(self, key, render):
+        html = self.get(key)
+        if html is None:
+            html = render()
+            self.put(key, html)
+        return html
+
+    def clear(self):
+        with self._lock:
+            self._items.clear()
+            self.size = 0
+
+    def __len__(self):
+        return len(self._items)
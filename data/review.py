@@ -0,0 +1,201 @@
+"""Интервальное повторение жестов.
+
+Для каждого пользователя храним очередь с приоритетом: жесты, упорядоченные
+по сроку следующего повторения. Каждый ответ сдвигает срок своего жеста:
+правильный ответ увеличивает интервал (1 день, дальше в GROWTH раз, но не
+больше MAX_INTERVAL), ошибка возвращает жест через RELEARN_DELAY и сбрасывает
+интервал.
+
+Очередь хранится строками review_items, по одной на жест ученика, с индексом
+(user_id, due). Пачка ответов читает и перезаписывает только отвеченные
+жесты, сколько бы их ни было в очереди, а следующий набор для повторения -
+начало индекса по сроку, без просмотра всей очереди и истории ошибок.
+
+Из очереди берутся вопросы занятия "Повторить сейчас" и уроков "Повторение
+старых": такой урок сначала спрашивает пройденные к нему жесты, которые пора
+повторить, и добирает вопросы своими жестами из курса. Набор урока зависит
+только от состояния ученика, поэтому выбирается один раз на версию его
+состояния (LessonSets).
+"""
+import threading
+import time
+from collections import OrderedDict
+
+import sqlalchemy as sa
+from sqlalchemy.dialects.sqlite import insert
+
+from .review_item import ReviewItem
+
+FIRST_INTERVAL = 24 * 3600
+RELEARN_DELAY = 10 * 60
+GROWTH = 2.5
+MAX_INTERVAL = 180 * 24 * 3600
+#сколько жестов в одном занятии "Повторить сейчас"
+REVIEW_SIZE = 10
+#сколько наборов уроков повторения помнит процесс
+LESSON_SET_CACHE_SIZE = 10000
+
+
+def next_review(interval, streak, is_correct, now):
+    """Срок, интервал и серия жеста после ответа"""
+    if is_correct:
+        interval = FIRST_INTERVAL if interval < FIRST_INTERVAL else min(int(interval * GROWTH), MAX_INTERVAL)
+        return int(now) + interval, interval, streak + 1
+    return int(now) + RELEARN_DELAY, 0, 0
+
+
+def schedule_answers(db_sess, user_id, answers, catalog, now=None):
+    """Сдвигает сроки повторения по пачке ответов (см. data/answers.py). Коммит за вызывающим кодом"""
+    answers = [a for a in answers if catalog.get_gesture(a['gesture_id'])]
+    if not answers:
+        return
+    now = time.time() if now is None else now
+
+    gesture_ids = {a['gesture_id'] for a in answers}
+    state = {
+        gesture_id: (interval, streak)
+        for gesture_id, interval, streak in db_sess.execute(
+            sa.select(ReviewItem.gesture_id, ReviewItem.interval, ReviewItem.streak)
+            .where(ReviewItem.user_id == user_id, ReviewItem.gesture_id.in_(gesture_ids))
+        )
+    }
+    rows = {}
+    for answer in answers:
+        gesture_id = answer['gesture_id']
+        due, interval, streak = next_review(*state.get(gesture_id, (0, 0)), answer['is_correct'], now)
+        state[gesture_id] = (interval, streak)
+        rows[gesture_id] = {'user_id': user_id, 'gesture_id': gesture_id,
+                            'due': due, 'interval': interval, 'streak': streak}
+
+    # Строки отдельно от запроса: текст запроса один на любую пачку и компилируется один раз
+    stmt = insert(ReviewItem)
+    db_sess.execute(stmt.on_conflict_do_update(
+        index_elements=['user_id', 'gesture_id'],
+        set_={name: stmt.excluded[name] for name in ('due', 'interval', 'streak')}
+    ), list(rows.values()))
+
+
+def due_gestures(db_sess, user_id, now, limit=REVIEW_SIZE, ahead=False, allowed=None):
+    """До limit жестов очереди по возрастанию срока.
+
+    ahead=True добирает жесты, срок которых еще не наступил (режим "повторить
+    сейчас"); allowed - жесты, из которых можно выбирать (None - любые).
+    """
+    stmt = (
+        sa.select(ReviewItem.gesture_id)
+        .where(ReviewItem.user_id == user_id)
+        .order_by(ReviewItem.due, ReviewItem.gesture_id)
+    )
+    if not ahead:
+        stmt = stmt.where(ReviewItem.due <= now)
+    if allowed is None:
+        stmt = stmt.limit(limit)
+
+    # Строки читаются по индексу пачками по yield_per: чтение останавливается на limit подходящих
+    result = []
+    rows = db_sess.execute(stmt.execution_options(yield_per=2 * limit))
+    try:
+        for (gesture_id,) in rows:
+            if len(result) >= limit:
+                break
+            if allowed is None or gesture_id in allowed:
+                result.append(gesture_id)
+    finally:
+        rows.close()
+    return result
+
+
+_gesture_lessons = (None, {})
+
+
+def gesture_lessons(catalog):
+    """Первый урок, в котором встречается жест: {gesture_id: CatalogLesson}"""
+    global _gesture_lessons
+    version, lessons = _gesture_lessons
+    if version != catalog.version:
+        lessons = {}
+        for module in catalog.modules:
+            for lesson in catalog.module_lessons(module.id):
+                for gesture_id in lesson.gesture_ids:
+                    lessons.setdefault(gesture_id, lesson)
+        _gesture_lessons = (catalog.version, lessons)
+    return lessons
+
+
+_review_pools = (None, {})
+
+
+def review_pool(catalog, lesson):
+    """Жесты, пройденные к уроку lesson (вместе с его собственными) - из них урок повторения берет вопросы"""
+    global _review_pools
+    version, pools = _review_pools
+    if version != catalog.version:
+        pools = {}
+        seen = set()
+        for module in catalog.modules:
+            for course_lesson in catalog.module_lessons(module.id):
+                seen.update(course_lesson.gesture_ids)
+                if course_lesson.lesson_type == 'repeat_old':
+                    pools[course_lesson.id] = frozenset(seen)
+        _review_pools = (catalog.version, pools)
+    return pools.get(lesson.id, frozenset(lesson.gesture_ids))
+
+
+def lesson_review_set(db_sess, user_id, lesson, catalog, now=None):
+    """id жестов урока "Повторение старых": сначала те, что пора повторить, затем жесты урока.
+
+    Вопросов столько же, сколько жестов в уроке; пока повторять нечего,
+    урок совпадает с курсом.
+    """
+    now = time.time() if now is None else now
+    size = len(lesson.gesture_ids)
+    gesture_ids = due_gestures(db_sess, user_id, now, size, allowed=review_pool(catalog, lesson))
+    gesture_ids += [gesture_id for gesture_id in lesson.gesture_ids if gesture_id not in gesture_ids]
+    return tuple(gesture_ids[:size])
+
+
+class LessonSets:
+    """Наборы уроков повторения по ключу (ученик, версия состояния, версия каталога, урок), LRU.
+
+    Версия состояния растет с каждым ответом (см. data/render_cache.py), так
+    что набор выбирается заново только после новых ответов ученика.
+    """
+
+    def __init__(self, max_size=LESSON_SET_CACHE_SIZE):
+        self.max_size = max_size
+        self._items = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get_or_pick(self, key, pick):
+        with self._lock:
+            gesture_ids = self._items.get(key)
+            if gesture_ids is not None:
+                self._items.move_to_end(key)
+                return gesture_ids
+        gesture_ids = pick()
+        with self._lock:
+            self._items[key] = gesture_ids
+            while len(self._items) > self.max_size:
+                self._items.popitem(last=False)
+        return gesture_ids
+
+    def __len__(self):
+        return len(self._items)
+
+
+def review_set(db_sess, user_id, catalog, now=None, limit=REVIEW_SIZE, ahead=True):
+    """Жесты для занятия "Повторить сейчас": сначала просроченные, затем ближайшие"""
+    now = time.time() if now is None else now
+    lessons = gesture_lessons(catalog)
+    return [
+        catalog.get_gesture(gesture_id)
+        for gesture_id in due_gestures(db_sess, user_id, now, limit, ahead, allowed=lessons)
+    ]
+
+
+def has_due(db_sess, user_id, now=None):
+    """Есть ли жесты, которые пора повторить. Одно чтение начала индекса по сроку"""
+    now = time.time() if now is None else now
+    return db_sess.query(
+        sa.exists().where(ReviewItem.user_id == user_id, ReviewItem.due <= now)
+    ).scalar()
@@ -0,0 +1,18 @@
+import sqlalchemy as sa
+from sqlalchemy import ForeignKey
+from .db_session import SqlAlchemyBase
+
+class ReviewItem(SqlAlchemyBase):
+    """Жест в очереди повторения пользователя (см. data/review.py)"""
+    __tablename__ = 'review_items'
+    __table_args__ = (
+        sa.Index('ix_review_items_user_due', 'user_id', 'due'),
+        #строки живут прямо в B-дереве первичного ключа, без отдельного rowid
+        {'sqlite_with_rowid': False},
+    )
+
+    user_id = sa.Column(sa.Integer, ForeignKey('users.id'), primary_key=True)
+    gesture_id = sa.Column(sa.Integer, ForeignKey('gestures.id'), primary_key=True)
+    due = sa.Column(sa.Integer, nullable=False) #срок следующего повторения (unix-время)
+    interval = sa.Column(sa.Integer, nullable=False, default=0) #текущий интервал в секундах
+    streak = sa.Column(sa.Integer, nullable=False, default=0) #серия правильных ответов
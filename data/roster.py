@@ -0,0 +1,245 @@
+"""Массовый импорт учеников из списка класса или школы.
+
+Список - CSV с заголовком (name, email, password, about, class) или JSON
+(массив объектов с теми же полями, либо по объекту на строку в .jsonl).
+Импорт идет пачками по batch_size строк, и каждая пачка устроена так:
+  - повторы почты ищутся одним запросом email IN (...) по индексу и внутри файла;
+  - пароли новых учеников хэшируются параллельно в пуле процессов;
+  - пользователи и их начальный прогресс вставляются двумя запросами
+    в одной транзакции (или прогресс не создается вовсе - он появится
+    при первом ответе, см. data/answers.py).
+После каждой пачки номер обработанной строки пишется в файл прогресса
+рядом со списком, поэтому прерванный импорт продолжается с того же места,
+а уже созданные ученики не хэшируются повторно.
+"""
+import csv
+import hashlib
+import json
+import logging
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+from sqlalchemy.dialects.sqlite import insert
+from werkzeug.security import generate_password_hash
+
+from . import db_session
+from .catalog import get_catalog
+from .user_progress import UserProgress
+from .users import User
+
+BATCH_SIZE = 500
+
+log = logging.getLogger(__name__)
+
+
+class RosterError(ValueError):
+    """Список нельзя прочитать"""
+
+
+def read_roster(path):
+    """Строки списка как словари name, email, password, about, class"""
+    extension = os.path.splitext(path)[1].lower()
+    with open(path, encoding='utf-8-sig', newline='') as f:
+        if extension == '.csv':
+            rows = csv.DictReader(f)
+            missing = {'name', 'email', 'password'} - set(rows.fieldnames or ())
+            if missing:
+                raise RosterError(f'В заголовке CSV нет столбцов: {", ".join(sorted(missing))}')
+            yield from rows
+        elif extension == '.jsonl':
+            for number, line in enumerate(f, start=1):
+                if line.strip():
+                    try:
+                        yield json.loads(line)
+                    except json.JSONDecodeError as e:
+                        raise RosterError(f'Строка {number}: неверный JSON ({e.msg})') from e
+        elif extension == '.json':
+            try:
+                data = json.load(f)
+            except json.JSONDecodeError as e:
+                raise RosterError(f'Строка {e.lineno}, позиция {e.colno}: неверный JSON ({e.msg})') from e
+            if not isinstance(data, list):
+                raise RosterError('JSON-список должен быть массивом объектов')
+            yield from data
+        else:
+            raise RosterError('Поддерживаются списки .csv, .json и .jsonl')
+
+
+def clean_row(row):
+    """Проверенная строка списка или None, если в ней нет обязательных полей"""
+    if not isinstance(row, dict):
+        return None
+    values = {name: str(row.get(name) or '').strip() for name in ('name', 'email', 'password', 'about', 'class')}
+    if not values['name'] or not values['password'] or '@' not in values['email']:
+        return None
+    return values
+
+
+def roster_digest(path):
+    sha = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(1 << 20), b''):
+            sha.update(chunk)
+    return sha.hexdigest()
+
+
+class Checkpoint:
+    """Сколько строк списка уже обработано. Привязан к содержимому файла"""
+
+    def __init__(self, roster_path):
+        self.path = roster_path + '.progress'
+        self.digest = roster_digest(roster_path)
+        self.rows_done = 0
+        if os.path.exists(self.path):
+            with open(self.path, encoding='utf-8') as f:
+                data = json.load(f)
+            if data.get('digest') == self.digest:
+                self.rows_done = data.get('rows_done', 0)
+
+    def save(self, rows_done):
+        self.rows_done = rows_done
+        tmp = self.path + '.tmp'
+        with open(tmp, 'w', encoding='utf-8') as f:
+            json.dump({'digest': self.digest, 'rows_done': rows_done}, f)
+        os.replace(tmp, self.path)
+
+    def finish(self):
+        if os.path.exists(self.path):
+            os.remove(self.path)
+
+
+class ImportReport:
+    def __init__(self):
+        self.rows = 0
+        self.created = 0
+        self.duplicates = 0
+        self.invalid = 0
+        self.resumed_from = 0
+        self.hash_seconds = 0.0
+        self.insert_seconds = 0.0
+        self.started = time.perf_counter()
+
+    @property
+    def seconds(self):
+        return time.perf_counter() - self.started
+
+    def summary(self):
+        seconds = self.seconds
+        return (
+            f'строк: {self.rows} (продолжено со строки {self.resumed_from}), создано: {self.created}, '
+            f'уже были: {self.duplicates}, с ошибками: {self.invalid}; '
+            f'{seconds:.1f} с, {self.created / seconds if seconds else 0:.0f} учеников/с '
+            f'(хэширование {self.hash_seconds:.1f} с, запись {self.insert_seconds:.1f} с)'
+        )
+
+
+def existing_emails(db_sess, emails):
+    """Почты из списка, которые уже есть в базе - один запрос по индексу users.email"""
+    return {email for (email,) in db_sess.query(User.email).filter(User.email.in_(emails))}
+
+
+def insert_users(db_sess, users, module_ids):
+    """Вставляет пачку учеников и их начальный прогресс. Возвращает число созданных"""
+    # Список параметров - executemany, SQLAlchemy сам делит его на запросы по лимиту переменных sqlite
+    created = db_sess.execute(
+        insert(User).on_conflict_do_nothing(index_elements=['email']).returning(User.id),
+        users
+    ).scalars().all()
+    if created and module_ids:
+        db_sess.execute(
+            insert(UserProgress).on_conflict_do_nothing(index_elements=['user_id', 'module_id']),
+            [
+                {
+                    'user_id': user_id,
+                    'module_id': module_id,
+                    'correct_answers': 0,
+                    'total_questions': 0,
+                    'completed_lessons': 0,
+                    'completion_percentage': 0.0,
+                    'is_completed': False,
+                }
+                for user_id in created
+                for module_id in module_ids
+            ]
+        )
+    return len(created)
+
+
+def _batches(rows, size):
+    batch = []
+    for row in rows:
+        batch.append(row)
+        if len(batch) >= size:
+            yield batch
+            batch = []
+    if batch:
+        yield batch
+
+
+def import_roster(path, batch_size=BATCH_SIZE, workers=None, defer_progress=False, resume=True):
+    """Импортирует список path. Возвращает ImportReport"""
+    checkpoint = Checkpoint(path)
+    if not resume:
+        checkpoint.rows_done = 0
+    report = ImportReport()
+    report.resumed_from = checkpoint.rows_done
+    module_ids = [] if defer_progress else [module.id for module in get_catalog().modules]
+    workers = workers or os.cpu_count() or 1
+    seen = set()
+
+    rows = read_roster(path)
+    position = 0
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        for batch in _batches(rows, batch_size):
+            position += len(batch)
+            if position <= checkpoint.rows_done:
+                continue
+            batch = batch[max(0, checkpoint.rows_done - (position - len(batch))):]
+            report.rows += len(batch)
+
+            cleaned = []
+            first = position - len(batch) + 1
+            for number, row in enumerate(batch, start=first):
+                row = clean_row(row)
+                if row is None:
+                    report.invalid += 1
+                    log.warning('Строка %s списка %s пропущена: нужны name, email и password', number, path)
+                elif row['email'] in seen:
+                    report.duplicates += 1
+                else:
+                    seen.add(row['email'])
+                    cleaned.append(row)
+
+            db_sess = db_session.create_read_session()
+            try:
+                known = existing_emails(db_sess, [row['email'] for row in cleaned]) if cleaned else set()
+            finally:
+                db_sess.close()
+            new_rows = [row for row in cleaned if row['email'] not in known]
+            report.duplicates += len(cleaned) - len(new_rows)
+
+            if new_rows:
+                started = time.perf_counter()
+                chunksize = max(1, len(new_rows) // (4 * workers))
+                hashes = list(pool.map(generate_password_hash, [row['password'] for row in new_rows],
+                                       chunksize=chunksize))
+                report.hash_seconds += time.perf_counter() - started
+
+                users = [
+                    {'username': row['name'], 'email': row['email'], 'about': row['about'] or None,
+                     'class_name': row['class'] or None, 'hashed_password': hashed}
+                    for row, hashed in zip(new_rows, hashes)
+                ]
+                started = time.perf_counter()
+                created = db_session.transaction(insert_users, users, module_ids)
+                report.insert_seconds += time.perf_counter() - started
+                report.created += created
+                #ту же почту могли зарегистрировать через форму между проверкой и вставкой
+                report.duplicates += len(users) - created
+
+            checkpoint.save(position)
+            log.info('Импорт %s: обработано строк %s, создано %s', path, position, report.created)
+
+    checkpoint.finish()
+    return report
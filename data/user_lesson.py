@@ -5,11 +5,14 @@ from .db_session import SqlAlchemyBase
 
 class UserLesson(SqlAlchemyBase):
     __tablename__ = 'user_lessons'
+    __table_args__ = (
+        sqlalchemy.Index('ux_user_lessons_user_lesson', 'user_id', 'lesson_id', unique=True),
+    )
     
     id = sqlalchemy.Column(sqlalchemy.Integer, primary_key=True, autoincrement=True)
     user_id = sqlalchemy.Column(sqlalchemy.Integer, sqlalchemy.ForeignKey('users.id'))
     lesson_id = sqlalchemy.Column(sqlalchemy.Integer, sqlalchemy.ForeignKey('lessons.id'))
-    completed_at = sqlalchemy.Column(sqlalchemy.DateTime, default=sqlalchemy.func.now())
+    completed_at = sqlalchemy.Column(sqlalchemy.DateTime, nullable=True)  # заполняется только в finish_lesson
     correct_answers = sqlalchemy.Column(sqlalchemy.Integer, default=0)
     total_answers = sqlalchemy.Column(sqlalchemy.Integer, default=0)
     
@@ -4,6 +4,9 @@ from .db_session import SqlAlchemyBase
 
 class UserMistake(SqlAlchemyBase):
     __tablename__ = 'user_mistakes'
+    __table_args__ = (
+        sa.Index('ux_user_mistakes_user_gesture_lesson', 'user_id', 'gesture_id', 'lesson_id', unique=True),
+    )
     
     id = sa.Column(sa.Integer, primary_key=True, autoincrement=True)
     user_id = sa.Column(sa.Integer, ForeignKey('users.id'), nullable=False)
@@ -11,4 +14,13 @@ class UserMistake(SqlAlchemyBase):
     lesson_id = sa.Column(sa.Integer, ForeignKey('lessons.id'), nullable=True)
     module_id = sa.Column(sa.Integer, ForeignKey('modules.id'), nullable=True)
     incorrect_answer = sa.Column(sa.String, nullable=True)
-    mistake_count = sa.Column(sa.Integer, default=1)
\ No newline at end of file
+    mistake_count = sa.Column(sa.Integer, default=1)
+
+# Для страницы ошибок (data/mistakes.py): порядок индексов совпадает с ORDER BY,
+# поэтому страница читается по индексу без сортировки
+sa.Index(
+    'ix_user_mistakes_user_module_lesson_count',
+    UserMistake.user_id, UserMistake.module_id, UserMistake.lesson_id,
+    UserMistake.mistake_count.desc(), UserMistake.id.desc()
+)
+sa.Index('ix_user_mistakes_user_count', UserMistake.user_id, UserMistake.mistake_count.desc(), UserMistake.id.desc())
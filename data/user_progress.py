@@ -4,11 +4,15 @@ from .db_session import SqlAlchemyBase
 
 class UserProgress(SqlAlchemyBase):
     __tablename__ = 'user_progress'
+    __table_args__ = (
+        sa.Index('ux_user_progress_user_module', 'user_id', 'module_id', unique=True),
+    )
     
     id = sa.Column(sa.Integer, primary_key=True, autoincrement=True)
     user_id = sa.Column(sa.Integer, ForeignKey('users.id'), nullable=False)
     module_id = sa.Column(sa.Integer, ForeignKey('modules.id'), nullable=False)
     correct_answers = sa.Column(sa.Integer, default=0)
     total_questions = sa.Column(sa.Integer, default=0)
+    completed_lessons = sa.Column(sa.Integer, default=0, server_default='0') #счетчик пройденных уроков модуля, меняется в finish_lesson
     completion_percentage = sa.Column(sa.Float, default=0.0)
-    is_completed = sa.Column(sa.Boolean, default=False)
\ No newline at end of file
+    is_completed = sa.Column(sa.Boolean, default=False)
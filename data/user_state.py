@@ -0,0 +1,10 @@
+import sqlalchemy as sa
+from sqlalchemy import ForeignKey
+from .db_session import SqlAlchemyBase
+
+class UserState(SqlAlchemyBase):
+    """Версия состояния пользователя: растет при каждой записи в UserLesson и UserProgress"""
+    __tablename__ = 'user_state'
+
+    user_id = sa.Column(sa.Integer, ForeignKey('users.id'), primary_key=True)
+    version = sa.Column(sa.Integer, nullable=False, default=0)
@@ -15,6 +15,7 @@ class User(SqlAlchemyBase, UserMixin):
     email = sa.Column(sa.String, index=True, unique=True, nullable=False)
     hashed_password = sa.Column(sa.String, nullable=True)
     about = sa.Column(sa.Text, nullable=True)
+    class_name = sa.Column(sa.String, nullable=True, index=True) #класс ученика, например "5Б" (для аналитики учителя)
     
     def set_password(self, password):
         self.hashed_password = generate_password_hash(password)
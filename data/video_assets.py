@@ -0,0 +1,112 @@
+"""Манифест видео жестов с адресами по содержимому.
+
+Имена файлов в static/videos - слова жестов (с пробелами и кириллицей),
+и их содержимое может поменяться при обновлении курса. Поэтому каждому
+файлу мы сопоставляем адрес вида /videos/<хэш содержимого>.mp4: пока файл
+не изменился, адрес тот же, и браузер может хранить видео сколько угодно
+(Cache-Control: immutable). Изменился файл - изменился и адрес.
+
+Хэш файла пересчитывается, только если у него поменялись размер или
+время изменения; папку пересматриваем не чаще раза в CHECK_INTERVAL секунд.
+
+Запуск вручную: python -m data.video_assets [папка с видео]
+"""
+import hashlib
+import os
+import sys
+import threading
+import time
+from collections import namedtuple
+from types import MappingProxyType
+
+#как часто (в секундах) проверяем папку на новые и измененные файлы
+CHECK_INTERVAL = 5.0
+#сколько символов sha256 оставляем в адресе
+DIGEST_LENGTH = 16
+VIDEO_EXTENSIONS = ('.mp4', '.webm')
+
+VideoAsset = namedtuple('VideoAsset', [
+    'filename',  #имя файла, как в Gesture.video_filename
+    'path',  #полный путь на диске
+    'digest',  #хэш содержимого, он же сильный ETag
+    'url_name',  #имя в адресе: <digest>.<расширение>
+    'size', 'mtime',
+])
+
+
+def file_digest(path, chunk_size=1 << 20):
+    digest = hashlib.sha256()
+    with open(path, 'rb') as fh:
+        for chunk in iter(lambda: fh.read(chunk_size), b''):
+            digest.update(chunk)
+    return digest.hexdigest()[:DIGEST_LENGTH]
+
+
+def scan_directory(directory, previous=None):
+    """Строит манифест {filename: VideoAsset}, пересчитывая хэши только измененных файлов"""
+    previous = previous or {}
+    assets = {}
+    if not os.path.isdir(directory):
+        return assets
+
+    for entry in os.scandir(directory):
+        if not entry.is_file() or not entry.name.lower().endswith(VIDEO_EXTENSIONS):
+            continue
+        stat = entry.stat()
+        old = previous.get(entry.name)
+        if old is not None and old.size == stat.st_size and old.mtime == stat.st_mtime:
+            assets[entry.name] = old
+            continue
+        digest = file_digest(entry.path)
+        extension = os.path.splitext(entry.name)[1].lower()
+        assets[entry.name] = VideoAsset(
+            filename=entry.name,
+            path=os.path.abspath(entry.path),
+            digest=digest,
+            url_name=digest + extension,
+            size=stat.st_size,
+            mtime=stat.st_mtime,
+        )
+    return assets
+
+
+class VideoManifest:
+    """Неизменяемый снимок манифеста заменяется целиком, как и каталог"""
+
+    def __init__(self, directory):
+        self.directory = directory
+        self._by_filename = MappingProxyType({})
+        self._by_url_name = MappingProxyType({})
+        self._checked_at = 0.0
+        self._lock = threading.Lock()
+
+    def refresh(self, force=False):
+        if not force and time.monotonic() - self._checked_at < CHECK_INTERVAL:
+            return
+        with self._lock:
+            if not force and time.monotonic() - self._checked_at < CHECK_INTERVAL:
+                return
+            assets = scan_directory(self.directory, self._by_filename)
+            by_url_name = MappingProxyType({a.url_name: a for a in assets.values()})
+            self._by_filename = MappingProxyType(assets)
+            self._by_url_name = by_url_name
+            self._checked_at = time.monotonic()
+
+    def get(self, filename):
+        """VideoAsset по Gesture.video_filename или None, если файла нет"""
+        self.refresh()
+        return self._by_filename.get(filename)
+
+    def by_url_name(self, url_name):
+        self.refresh()
+        return self._by_url_name.get(url_name)
+
+    def assets(self):
+        self.refresh()
+        return tuple(self._by_filename.values())
+
+
+if __name__ == '__main__':
+    manifest = VideoManifest(sys.argv[1] if len(sys.argv) > 1 else 'static/videos')
+    for asset in sorted(manifest.assets(), key=lambda a: a.filename):
+        print(f'{asset.url_name}  {asset.size:>10}  {asset.filename}')
@@ -1,35 +1,218 @@
-from flask import Flask, render_template, redirect, request, jsonify
+from flask import Flask, Response, render_template, redirect, request, jsonify, send_file, abort, make_response
 from forms.user import RegisterForm, LoginForm
 from flask_login import LoginManager, login_user, login_required, logout_user, current_user
+from functools import wraps
 from data import db_session
 from flask import url_for
 from data.users import User
-from data.module import Module
-from data.lesson import Lesson
-from data.gesture import Gesture
-from data.lesson_gesture import LessonGesture
 from data.user_progress import UserProgress
-from data.user_mistake import UserMistake
-from data.user_lesson import UserLesson  
-import random
-from datetime import datetime
+from data.catalog import get_catalog
+from data.lesson_status import resolve_lesson_statuses, get_lesson_status
+from data.progress import complete_lesson
+from data.lesson_payload import build_lesson_payload, build_options, build_review_payload, options_lesson, payload_etag
+from data.answers import (
+    AnswerError, MAX_BATCH_SIZE, PRUNE_BATCH_SIZE, RECEIPT_TTL_DAYS, apply_answers, parse_answer, parse_answers,
+    prune_receipts
+)
+from data.answer_log import AnswerLog
+from data import identity
+from data.video_assets import VideoManifest
+from data import prefetch
+from data import review
+from data import mistakes
+from data.render_cache import DEFAULT_MAX_BYTES, RenderCache, page_etag, read_state_version
+from data import metrics
+from data.roster import BATCH_SIZE, RosterError, import_roster
+from data import curriculum
+from data import analytics
+from data import leaderboard
+from data import export
+from data import offline
+from data import admission
+from data.logs import configure_logging
+from sqlalchemy.exc import IntegrityError
+import atexit
+import click
+import hmac
+import json
+import logging
+import os
 
 
-db_session.global_init("db/app.db")
+# Логи пишет отдельный поток, запрос только кладет запись в очередь (см. data/logs.py)
+configure_logging(os.environ.get('LOG_LEVEL', 'INFO').upper(), os.environ.get('LOG_FILE'))
+log = logging.getLogger('app')
+
+db_session.global_init(os.environ.get('DB_PATH', 'db/app.db'))
 
 app = Flask(__name__)
 app.config['SECRET_KEY'] = '65432456uijhgfdsxcvbn'
+db_session.init_app(app)
+
+# Время, статусы и SQL каждого запроса для /metrics (см. data/metrics.py)
+metrics.metrics.slow_query_seconds = float(os.environ.get('SLOW_QUERY_MS', metrics.SLOW_QUERY_SECONDS * 1000)) / 1000
+# Если задан, /metrics требует заголовок Authorization: Bearer <токен>,
+# без него /metrics отвечает только на запросы с этой машины
+app.config['METRICS_TOKEN'] = os.environ.get('METRICS_TOKEN')
+LOCAL_ADDRESSES = frozenset(('127.0.0.1', '::1'))
+for engine in db_session.engines():
+    metrics.instrument_engine(engine)
+metrics.init_app(app)
+
+# Учителя - пользователи с этими почтами (через запятую), им доступна аналитика классов
+app.config['TEACHER_EMAILS'] = frozenset(
+    email.strip() for email in os.environ.get('TEACHER_EMAILS', '').split(',') if email.strip()
+)
+
 login_manager = LoginManager()
 login_manager.init_app(app)
 
+# Кэш личности пользователя для user_loader (см. data/identity.py)
+app.config['IDENTITY_CACHE_TTL'] = float(os.environ.get('IDENTITY_CACHE_TTL', identity.DEFAULT_TTL))
+app.config['IDENTITY_CACHE_SIZE'] = int(os.environ.get('IDENTITY_CACHE_SIZE', identity.DEFAULT_MAX_SIZE))
+identity.configure(app.config['IDENTITY_CACHE_TTL'], app.config['IDENTITY_CACHE_SIZE'])
+
+# Ответы пишутся в журнал на диске и попадают в базу фоновым потоком пачками
+app.config['ANSWER_WRITE_BEHIND'] = os.environ.get('ANSWER_WRITE_BEHIND', '1') == '1'
+app.config['ANSWER_LOG_DIR'] = os.environ.get('ANSWER_LOG_DIR', 'db/answer_log')
+answer_log = AnswerLog(app.config['ANSWER_LOG_DIR'])
+if app.config['ANSWER_WRITE_BEHIND']:
+    answer_log.start()
+    atexit.register(answer_log.stop)
+
+# Видео жестов отдаются по адресам с хэшем содержимого (см. data/video_assets.py)
+app.config['VIDEO_DIR'] = os.environ.get('VIDEO_DIR', os.path.join(app.static_folder, 'videos'))
+app.config['VIDEO_MAX_AGE'] = 365 * 24 * 3600
+# За nginx можно отдать саму передачу файла серверу: USE_X_SENDFILE=1
+app.config['USE_X_SENDFILE'] = os.environ.get('USE_X_SENDFILE', '0') == '1'
+video_manifest = VideoManifest(app.config['VIDEO_DIR'])
+
+# Отрисованные /lessons и /progress по версии состояния пользователя (см. data/render_cache.py)
+app.config['RENDER_CACHE_BYTES'] = int(os.environ.get('RENDER_CACHE_BYTES', DEFAULT_MAX_BYTES))
+render_cache = RenderCache(app.config['RENDER_CACHE_BYTES'])
+# Ревизия шаблонов: меняется с выкладкой и входит в ETag страниц и офлайн-манифест
+app.config['SHELL_REVISION'] = offline.directory_digest(app.template_folder)
+
+# Офлайн-режим: разницу манифестов процесс отдает по недавно выданным версиям (см. data/offline.py)
+offline_manifests = offline.ManifestCache()
+
+# Жесты уроков "Повторение старых" из очереди повторения по версии состояния ученика (см. data/review.py)
+lesson_sets = review.LessonSets()
+
+# Ограничение нагрузки на пишущие маршруты (см. data/admission.py):
+# одновременных запросов и очередь на маршрут, ожидание в очереди и частота от одного ученика
+app.config['ADMISSION_CONCURRENCY'] = int(os.environ.get('ADMISSION_CONCURRENCY', admission.DEFAULT_CONCURRENCY))
+app.config['ADMISSION_QUEUE_SIZE'] = int(os.environ.get('ADMISSION_QUEUE_SIZE', admission.DEFAULT_QUEUE_SIZE))
+app.config['ADMISSION_DEADLINE'] = float(os.environ.get('ADMISSION_DEADLINE_MS', admission.DEFAULT_DEADLINE * 1000)) / 1000
+app.config['USER_WRITE_RATE'] = float(os.environ.get('USER_WRITE_RATE', admission.DEFAULT_USER_RATE))
+app.config['USER_WRITE_BURST'] = int(os.environ.get('USER_WRITE_BURST', admission.DEFAULT_USER_BURST))
+admission_control = admission.AdmissionControl(
+    admission.TokenBuckets(app.config['USER_WRITE_RATE'], app.config['USER_WRITE_BURST'])
+)
+for route in ('save_answer', 'save_answers', 'finish_lesson', 'offline_sync'):
+    admission_control.add_gate(
+        route, app.config['ADMISSION_CONCURRENCY'], app.config['ADMISSION_QUEUE_SIZE'], app.config['ADMISSION_DEADLINE']
+    )
+admission_control.register_metrics(metrics.metrics)
+
+metrics.metrics.register_gauge('answer_log_dead_letters_total', 'Записи журнала ответов, отложенные как неприменимые',
+                               lambda: answer_log.dead_letters, 'counter')
+metrics.metrics.register_gauge('render_cache_hits_total', 'Попадания в кэш страниц', lambda: render_cache.hits, 'counter')
+metrics.metrics.register_gauge('render_cache_misses_total', 'Промахи кэша страниц', lambda: render_cache.misses, 'counter')
+metrics.metrics.register_gauge('render_cache_bytes', 'Размер HTML в кэше страниц', lambda: render_cache.size)
+metrics.metrics.register_gauge('prefetch_videos', 'Подсказки видео и отчеты страниц', prefetch.stats.snapshot)
+
+
+@app.template_global()
+def video_url(filename):
+    """URL видео жеста через манифест; если файла нет в манифесте - обычный static"""
+    asset = video_manifest.get(filename)
+    if asset is None:
+        return url_for('static', filename='videos/' + filename)
+    return url_for('video_asset', url_name=asset.url_name)
+
+
+@app.route('/videos/<url_name>')
+def video_asset(url_name):
+    """Видео по хэшу содержимого: вечный кэш, сильный ETag и Range-запросы (206)"""
+    asset = video_manifest.by_url_name(url_name)
+    if asset is None:
+        abort(404)
+    # conditional=True отвечает 304 на If-None-Match и 206 на Range,
+    # а сам файл передается через wsgi.file_wrapper (sendfile, где сервер умеет)
+    response = send_file(
+        asset.path,
+        mimetype='video/mp4' if asset.url_name.endswith('.mp4') else 'video/webm',
+        conditional=True,
+        etag=asset.digest,
+        last_modified=asset.mtime,
+        max_age=app.config['VIDEO_MAX_AGE']
+    )
+    response.cache_control.public = True
+    response.cache_control.immutable = True
+    return response
+
+
+def cached_page(key, render):
+    """Страница по ключу состояния: 304 без отрисовки или HTML из кэша"""
+    # HTML зависит и от шаблонов (выкладка), и от меню, которое у учителя свое (TEACHER_EMAILS)
+    key = key + (app.config['SHELL_REVISION'], is_teacher())
+    etag = page_etag(key)
+    if request.if_none_match.contains(etag):
+        response = app.response_class(status=304)
+    else:
+        response = make_response(render_cache.get_or_render(key, render))
+    response.set_etag(etag)
+    # Страница личная и должна проверяться при каждом заходе - проверка дешевая
+    response.cache_control.private = True
+    response.cache_control.no_cache = True
+    return response
+
+
+def admitted(view):
+    """Пишущий маршрут через ограничитель нагрузки: 429 или 503 с Retry-After вместо ожидания"""
+    @wraps(view)
+    def wrapper(*args, **kwargs):
+        try:
+            with admission_control.admit(view.__name__, current_user.id):
+                return view(*args, **kwargs)
+        except admission.Rejected as e:
+            if e.status == 429:
+                message = 'Слишком много запросов, повторите позже'
+            else:
+                message = 'Сервер занят, повторите через несколько секунд'
+            if request.method != 'POST':
+                # Переход по ссылке (завершение урока): вместо голой страницы с ошибкой -
+                # список уроков, который сам повторит переход (см. lessons.html)
+                attempt = request.args.get('attempt', 1, type=int)
+                return redirect(url_for('lessons', retry=request.path, attempt=attempt + 1, wait=e.retry_after))
+            # Страница урока оставляет неподтвержденные ответы в очереди и пришлет их снова
+            response = jsonify({'success': False, 'error': message})
+            response.status_code = e.status
+            response.headers['Retry-After'] = str(e.retry_after)
+            return response
+    return wrapper
+
+
+@app.template_global()
+def is_teacher():
+    return current_user.is_authenticated and current_user.email in app.config['TEACHER_EMAILS']
+
+def teacher_required(view):
+    """Доступ только для учителей из TEACHER_EMAILS"""
+    @wraps(view)
+    @login_required
+    def wrapper(*args, **kwargs):
+        if not is_teacher():
+            abort(403)
+        return view(*args, **kwargs)
+    return wrapper
+
 
 @login_manager.user_loader
 def load_user(user_id):
-    db_sess = db_session.create_session()
-    try:
-        return db_sess.query(User).get(int(user_id))
-    finally:
-        db_sess.close()
+    # Легкий объект из кэша вместо полной строки User на каждом запросе
+    return identity.load_principal(int(user_id))
 
 @app.route("/")
 def index():
@@ -38,7 +221,37 @@ def index():
 @app.route('/profile')
 @login_required
 def profile():
-    return render_template('profile.html', title='Профиль')
+    # "О себе" в кэше личности нет, для профиля читаем пользователя целиком
+    user = db_session.get_read_session().get(User, current_user.id)
+    return render_template('profile.html', title='Профиль', user=user)
+
+def create_user(db_sess, username, email, about, password):
+    """Создает пользователя вместе с начальным прогрессом по модулям"""
+    user = User(
+        username=username,
+        email=email,
+        about=about
+    )
+    user.set_password(password)
+    db_sess.add(user)
+    db_sess.flush()
+    
+    # Создаем начальный прогресс для пользователя
+    for module in get_catalog().modules:
+        progress = UserProgress(
+            user_id=user.id,
+            module_id=module.id,
+            correct_answers=0,
+            total_questions=0,
+            completion_percentage=0.0,
+            is_completed=False
+        )
+        db_sess.add(progress)
+        
+        # НЕ создаем запись UserLesson для первого урока
+        # Запись создастся только когда пользователь начнет урок
+    
+    return user
 
 @app.route('/register', methods=['GET', 'POST'])
 def register():
@@ -46,635 +259,826 @@ def register():
     if form.validate_on_submit():
         if form.password.data != form.password_again.data:
             return render_template('register.html', title='Регистрация', form=form, message='Пароли не совпадают')
-        db_sess = db_session.create_session()
+        db_sess = db_session.get_read_session()
+        if db_sess.query(User).filter(User.email == form.email.data).first():
+            return render_template('register.html', title='Регистрация',
+                                   form=form,
+                                   message="Такой пользователь уже есть")
         try:
-            if db_sess.query(User).filter(User.email == form.email.data).first():
-                return render_template('register.html', title='Регистрация',
-                                       form=form,
-                                       message="Такой пользователь уже есть")
-            user = User(
-                username=form.name.data,
-                email=form.email.data,
-                about=form.about.data
+            user = db_session.transaction(
+                create_user,
+                form.name.data,
+                form.email.data,
+                form.about.data,
+                form.password.data
             )
-            user.set_password(form.password.data)
-            db_sess.add(user)
-            db_sess.commit()
-            
-            # Создаем начальный прогресс для пользователя
-            modules = db_sess.query(Module).all()
-            for module in modules:
-                progress = UserProgress(
-                    user_id=user.id,
-                    module_id=module.id,
-                    correct_answers=0,
-                    total_questions=0,
-                    completion_percentage=0.0,
-                    is_completed=False
-                )
-                db_sess.add(progress)
-                
-                # НЕ создаем запись UserLesson для первого урока
-                # Запись создастся только когда пользователь начнет урок
-                
-            db_sess.commit()
-            
-            login_user(user)
-            return redirect('/')
-        finally:
-            db_sess.close()
+        except IntegrityError:
+            # Ту же почту только что зарегистрировали параллельно
+            return render_template('register.html', title='Регистрация',
+                                   form=form,
+                                   message="Такой пользователь уже есть")
+        
+        login_user(user)
+        return redirect('/')
     return render_template('register.html', title='Регистрация', form=form)
 
 @app.route('/login', methods=['GET', 'POST'])
 def login():
     form = LoginForm()
     if form.validate_on_submit():
-        db_sess = db_session.create_session()
-        try:
-            user = db_sess.query(User).filter(User.email == form.email.data).first()
-            if user and user.check_password(form.password.data):
-                login_user(user, remember=form.remember_me.data)
-                return redirect("/")
-            return render_template('login.html',
-                                   message="Неправильный логин или пароль",
-                                   form=form)
-        finally:
-            db_sess.close()
+        db_sess = db_session.get_read_session()
+        user = db_sess.query(User).filter(User.email == form.email.data).first()
+        if user and user.check_password(form.password.data):
+            login_user(user, remember=form.remember_me.data)
+            return redirect("/")
+        return render_template('login.html',
+                               message="Неправильный логин или пароль",
+                               form=form)
     return render_template('login.html', title='Авторизация', form=form)
 
-def get_lesson_status(user_id, lesson_id):
-    """Проверяет статус урока: пройден, доступен, заблокирован"""
-    db_sess = db_session.create_session()
-    try:
-        # Получаем урок
-        lesson = db_sess.query(Lesson).filter(Lesson.id == lesson_id).first()
-        if not lesson:
-            return {'available': False, 'completed': False}
-        
-        # Проверяем, есть ли запись об уроке
-        user_lesson = db_sess.query(UserLesson).filter(
-            UserLesson.user_id == user_id,
-            UserLesson.lesson_id == lesson_id
-        ).first()
-        
-        if user_lesson:
-            # Проверяем пройден ли урок
-            completed = user_lesson.completed_at is not None
-            # Если есть запись - урок доступен (пройден или нет)
-            return {'available': True, 'completed': completed}
-        
-        # Если записи нет - проверяем, доступен ли урок
-        # Получаем все уроки модуля
-        module_lessons = db_sess.query(Lesson).filter(
-            Lesson.module_id == lesson.module_id
-        ).order_by(Lesson.order_index).all()
-        
-        # Находим индекс текущего урока
-        current_index = -1
-        for i, module_lesson in enumerate(module_lessons):
-            if module_lesson.id == lesson_id:
-                current_index = i
-                break
-        
-        if current_index == -1:
-            return {'available': False, 'completed': False}
-        
-        # Первый урок всегда доступен
-        if current_index == 0:
-            # Урок доступен, но НЕ СОЗДАЕМ запись, пока пользователь не начнет его
-            return {'available': True, 'completed': False}
-        
-        # Для остальных уроков проверяем, пройден ли предыдущий урок
-        prev_lesson = module_lessons[current_index - 1]
-        prev_user_lesson = db_sess.query(UserLesson).filter(
-            UserLesson.user_id == user_id,
-            UserLesson.lesson_id == prev_lesson.id
-        ).first()
-        
-        # Урок доступен только если предыдущий ПРОЙДЕН
-        if prev_user_lesson and prev_user_lesson.completed_at is not None:
-            return {'available': True, 'completed': False}
-        
-        return {'available': False, 'completed': False}
-    finally:
-        db_sess.close()
-
 @app.route('/lessons')
 @login_required
 def lessons():
-    db_sess = db_session.create_session()
-    try:
-        modules = db_sess.query(Module).order_by(Module.order_index).all()
+    catalog = get_catalog()
+    db_sess = db_session.get_read_session()
+    # Кнопка "Повторить сейчас" зависит от времени, а не только от ответов, поэтому она часть ключа
+    review_due = review.has_due(db_sess, current_user.id)
+    key = ('lessons', current_user.id, read_state_version(db_sess, current_user.id), catalog.version, review_due)
+    return cached_page(key, lambda: render_lessons(db_sess, catalog, review_due))
+
+def render_lessons(db_sess, catalog, review_due):
+    # Статусы всех уроков одним запросом
+    statuses = resolve_lesson_statuses(db_sess, current_user.id, catalog)
+    
+    # Прогресс по всем модулям тоже одним запросом, он уже посчитан в finish_lesson
+    progress_by_module = {
+        p.module_id: p for p in db_sess.query(UserProgress).filter(
+            UserProgress.user_id == current_user.id
+        )
+    }
+    
+    modules_data = []
+    for module in catalog.modules:
+        lessons_list = catalog.module_lessons(module.id)
         
-        modules_data = []
-        for module in modules:
-            lessons_list = db_sess.query(Lesson).filter(
-                Lesson.module_id == module.id
-            ).order_by(Lesson.order_index).all()
-            
-            user_progress = db_sess.query(UserProgress).filter(
-                UserProgress.user_id == current_user.id,
-                UserProgress.module_id == module.id
-            ).first()
-            
-            # Убедись, что прогресс есть и обновлен
-            if user_progress:
-                # Пересчитываем прогресс на всякий случай
-                total_lessons_in_module = db_sess.query(Lesson).filter(
-                    Lesson.module_id == module.id
-                ).count()
-                
-                if total_lessons_in_module > 0:
-                    completed_lessons = db_sess.query(UserLesson).join(Lesson).filter(
-                        UserLesson.user_id == current_user.id,
-                        UserLesson.completed_at.isnot(None),
-                        Lesson.module_id == module.id
-                    ).count()
-                    
-                    progress_per_lesson = 100.0 / total_lessons_in_module
-                    user_progress.completion_percentage = min(100.0, completed_lessons * progress_per_lesson)
-                    db_sess.commit()
-            
-            progress_percentage = user_progress.completion_percentage if user_progress else 0
-            
-            lessons_data = []
-            for lesson in lessons_list:
-                # Получаем статус урока
-                status = get_lesson_status(current_user.id, lesson.id)
-                
-                lessons_data.append({
-                    'id': lesson.id,
-                    'title': lesson.title,
-                    'lesson_type': lesson.lesson_type,
-                    'available': status['available'],
-                    'completed': status['completed']
-                })
+        user_progress = progress_by_module.get(module.id)
+        progress_percentage = user_progress.completion_percentage if user_progress else 0
+        
+        lessons_data = []
+        for lesson in lessons_list:
+            status = statuses[lesson.id]
             
-            modules_data.append({
-                'id': module.id,
-                'title': module.title,
-                'description': module.description,
-                'progress_percentage': round(progress_percentage),  # Округляем для отображения
-                'lessons': lessons_data
+            lessons_data.append({
+                'id': lesson.id,
+                'title': lesson.title,
+                'lesson_type': lesson.lesson_type,
+                'available': status['available'],
+                'completed': status['completed']
             })
         
-        lesson_types = {
-            'new_gestures': 'Новые жесты',
-            'repeat_new': 'Повторение новых',
-            'repeat_old': 'Повторение старых',
-            'final_review': 'Итоговое повторение'
-        }
-        
-        lesson_icons = {
-            'new_gestures': 'star',
-            'repeat_new': 'redo',
-            'repeat_old': 'history',
-            'final_review': 'trophy'
-        }
-        
-        return render_template(
-            'lessons.html', 
-            title='Уроки',
-            modules=modules_data,
-            lesson_types=lesson_types,
-            lesson_icons=lesson_icons
-        )
-    finally:
-        db_sess.close()
+        modules_data.append({
+            'id': module.id,
+            'title': module.title,
+            'description': module.description,
+            'progress_percentage': round(progress_percentage),  # Округляем для отображения
+            'lessons': lessons_data
+        })
+    
+    lesson_types = {
+        'new_gestures': 'Новые жесты',
+        'repeat_new': 'Повторение новых',
+        'repeat_old': 'Повторение старых',
+        'final_review': 'Итоговое повторение'
+    }
+    
+    lesson_icons = {
+        'new_gestures': 'star',
+        'repeat_new': 'redo',
+        'repeat_old': 'history',
+        'final_review': 'trophy'
+    }
+    
+    return render_template(
+        'lessons.html', 
+        title='Уроки',
+        review_due=review_due,
+        modules=modules_data,
+        lesson_types=lesson_types,
+        lesson_icons=lesson_icons
+    )
 
 @app.route('/progress')
 @login_required
 def progress():
-    db_sess = db_session.create_session()
-    try:
-        user_progress = db_sess.query(UserProgress).filter(
-            UserProgress.user_id == current_user.id
-        ).all()
-        
-        modules = db_sess.query(Module).order_by(Module.order_index).all()
+    catalog = get_catalog()
+    db_sess = db_session.get_read_session()
+    # Ответы, которые еще лежат в журнале этого процесса и не дошли до базы. Ответы,
+    # принятые другим воркером, видны после его сброса (до flush_interval, 0.5 с)
+    pending = answer_log.pending_totals(current_user.id)
+    key = (
+        'progress', current_user.id, read_state_version(db_sess, current_user.id), catalog.version,
+        tuple(sorted(pending.items()))
+    )
+    return cached_page(key, lambda: render_progress(db_sess, catalog.modules, pending))
+
+def render_progress(db_sess, modules, pending):
+    user_progress = db_sess.query(UserProgress).filter(
+        UserProgress.user_id == current_user.id
+    ).all()
+    
+    modules_progress = []
+    total_correct = 0
+    total_questions = 0
+    completed_modules_count = 0
+    
+    #проверяем совпадение модуля с текущим
+    for module in modules:
+        progress = next((p for p in user_progress if p.module_id == module.id), None)
+        pending_questions, pending_correct = pending.get(module.id, (0, 0))
         
-        modules_progress = []
-        total_correct = 0
-        total_questions = 0
-        completed_modules_count = 0
+        module_correct = (progress.correct_answers or 0 if progress else 0) + pending_correct
+        module_questions = (progress.total_questions or 0 if progress else 0) + pending_questions
+        total_correct += module_correct
+        total_questions += module_questions
         
-        #проверяем совпадение модуля с текущим
-        for module in modules:
-            progress = next((p for p in user_progress if p.module_id == module.id), None)
-            
-            if progress:
-                total_correct += progress.correct_answers
-                total_questions += progress.total_questions
-                if progress.is_completed:
-                    completed_modules_count += 1
-            
-            # Подсчитываем пройденные уроки в модуле
-            completed_lessons_in_module = 0
-            total_lessons_in_module = db_sess.query(Lesson).filter(
-                Lesson.module_id == module.id
-            ).count()
-            
-            if total_lessons_in_module > 0:
-                completed_lessons_in_module = db_sess.query(UserLesson).join(Lesson).filter(
-                    UserLesson.user_id == current_user.id,
-                    UserLesson.completed_at.isnot(None),
-                    Lesson.module_id == module.id
-                ).count()
-                
-                # Пересчитываем процент завершения (25% за каждый урок)
-                if progress and not progress.is_completed:
-                    progress_per_lesson = 100.0 / total_lessons_in_module
-                    progress.completion_percentage = min(100.0, completed_lessons_in_module * progress_per_lesson)
-                    db_sess.commit()
-            
-            modules_progress.append({
-                'title': module.title,
-                'description': module.description,
-                'completion_percentage': progress.completion_percentage if progress else 0,
-                'correct_answers': progress.correct_answers if progress else 0,
-                'total_questions': progress.total_questions if progress else 0,
-                'is_completed': progress.is_completed if progress else False,
-                'last_activity': 'Сегодня',
-                'completed_lessons': completed_lessons_in_module,
-                'total_lessons': total_lessons_in_module
-            })
+        if progress and progress.is_completed:
+            completed_modules_count += 1
         
-        overall_accuracy = round((total_correct / total_questions * 100) if total_questions > 0 else 0, 1)
+        # Пройденные уроки считаются в finish_lesson, здесь только читаем
+        completed_lessons_in_module = progress.completed_lessons or 0 if progress else 0
+        total_lessons_in_module = len(module.lesson_ids)
         
-        return render_template(
-            'progress.html',
-            title='Прогресс',
-            modules_progress=modules_progress,
-            total_modules=len(modules),
-            completed_modules=completed_modules_count,
-            total_lessons=sum(m['total_lessons'] for m in modules_progress),
-            overall_accuracy=overall_accuracy
-        )
-    finally:
-        db_sess.close()
+        modules_progress.append({
+            'title': module.title,
+            'description': module.description,
+            'completion_percentage': progress.completion_percentage if progress else 0,
+            'correct_answers': module_correct,
+            'total_questions': module_questions,
+            'is_completed': progress.is_completed if progress else False,
+            'last_activity': 'Сегодня',
+            'completed_lessons': completed_lessons_in_module,
+            'total_lessons': total_lessons_in_module
+        })
+    
+    overall_accuracy = round((total_correct / total_questions * 100) if total_questions > 0 else 0, 1)
+    
+    return render_template(
+        'progress.html',
+        title='Прогресс',
+        modules_progress=modules_progress,
+        total_modules=len(modules),
+        completed_modules=completed_modules_count,
+        total_lessons=sum(m['total_lessons'] for m in modules_progress),
+        overall_accuracy=overall_accuracy
+    )
 
 @app.route('/lesson/<int:lesson_id>')
 @login_required
 def lesson(lesson_id):
-    db_sess = db_session.create_session()
-    try:
-        # Проверяем доступность урока
-        status = get_lesson_status(current_user.id, lesson_id)
-        if not status['available']:
-            return redirect('/lessons')
-        
-        # Получаем урок
-        lesson = db_sess.query(Lesson).filter(Lesson.id == lesson_id).first()
-        if not lesson:
-            return redirect('/lessons')
-        
-        # Получаем жесты для этого урока
-        lesson_gestures = db_sess.query(LessonGesture).filter(
-            LessonGesture.lesson_id == lesson_id
-        ).order_by(LessonGesture.order_index).all()
-        
-        if not lesson_gestures:
-            return redirect('/lessons')
-        
-        # Получаем информацию о жестах
-        gestures_info = []
-        for lg in lesson_gestures:
-            gesture = db_sess.query(Gesture).filter(Gesture.id == lg.gesture_id).first()
-            if gesture:
-                gestures_info.append({
-                    'lesson_gesture': lg,
-                    'gesture': gesture
-                })
-        
-        if not gestures_info:
-            return redirect('/lessons')
-        
-        current_question = request.args.get('question', 1, type=int)
-        
-        if current_question < 1 or current_question > len(gestures_info):
-            current_question = 1
-        
-        # Получаем текущий жест
-        current_item = gestures_info[current_question - 1]
-        gesture = current_item['gesture']
-        
-        
-        current_gesture_data = {
+    catalog = get_catalog()
+    # Проверяем доступность урока
+    db_sess = db_session.get_read_session()
+    status = get_lesson_status(db_sess, current_user.id, lesson_id, catalog)
+    if not status['available']:
+        return redirect('/lessons')
+    
+    # Получаем урок
+    lesson = catalog.get_lesson(lesson_id)
+    if not lesson:
+        return redirect('/lessons')
+    
+    # Получаем жесты для этого урока (уже упорядочены в каталоге, у урока повторения - из очереди)
+    gestures_info, gesture_set = lesson_gestures(db_sess, lesson, catalog)
+    
+    if not gestures_info:
+        return redirect('/lessons')
+    
+    current_question = request.args.get('question', 1, type=int)
+    
+    if current_question < 1 or current_question > len(gestures_info):
+        current_question = 1
+    
+    # Получаем текущий жест
+    gesture = gestures_info[current_question - 1]
+    
+    
+    current_gesture_data = {
+        'word': gesture.word,
+        'video_filename': gesture.video_filename,  # Только имя файла
+        'description': gesture.description,
+        'gesture_id': gesture.id
+    }
+    
+    # Создаем варианты ответов (так же, как в JSON-версии урока)
+    options = build_options(catalog, options_lesson(catalog, lesson, gesture), gesture)
+    
+    total_questions = len(gestures_info)
+    
+    # URL для следующего вопроса
+    next_question_url = None
+    if current_question < total_questions:
+        next_question_url = url_for('lesson', lesson_id=lesson_id, set=gesture_set, question=current_question + 1)
+    else:
+        next_question_url = url_for('finish_lesson', lesson_id=lesson_id)
+    
+    templates = {
+        'new_gestures': 'lesson_new_gestures.html',
+        'repeat_new': 'lesson_repeat_new.html',
+        'repeat_old': 'lesson_repeat_old.html',
+        'final_review': 'lesson_final_review.html'
+    }
+    
+    lesson_icons = {
+        'new_gestures': 'star',
+        'repeat_new': 'redo',
+        'repeat_old': 'history',
+        'final_review': 'trophy'
+    }
+    
+    lesson_descriptions = {
+        'new_gestures': 'Изучение новых жестов',
+        'repeat_new': 'Закрепление материала',
+        'repeat_old': 'Повторение пройденного',
+        'final_review': 'Итоговый тест модуля'
+    }
+    
+    template_name = templates.get(lesson.lesson_type, 'lesson_new_gestures.html')
+    
+    # Видео следующего вопроса и начала следующего урока браузер скачает заранее
+    prefetch_urls = [
+        video_url(name) for name in prefetch.prefetch_videos(catalog, lesson, current_question, gestures_info)
+    ]
+    prefetch.stats.record_hints(len(prefetch_urls))
+    
+    response = make_response(render_template(
+        template_name,
+        lesson_title=lesson.title,
+        lesson_description=lesson_descriptions.get(lesson.lesson_type, 'Урок'),
+        module_title=catalog.get_module(lesson.module_id).title,
+        lesson_icon=lesson_icons.get(lesson.lesson_type, 'star'),
+        current_question=current_question,
+        total_questions=total_questions,
+        current_gesture=current_gesture_data,
+        options=options,
+        next_question_url=next_question_url,
+        lesson_id=lesson_id,
+        payload_url=url_for('lesson_payload', lesson_id=lesson_id, set=gesture_set),
+        finish_url=url_for('finish_lesson', lesson_id=lesson_id),
+        prefetch_urls=prefetch_urls,
+        prefetch_lead=prefetch.NEXT_LESSON_LEAD
+    ))
+    if prefetch_urls:
+        response.headers['Link'] = prefetch.link_header(prefetch_urls)
+    return response
+
+def pick_lesson_set(db_sess, lesson, catalog):
+    """id жестов урока повторения для текущего ученика: один выбор на версию его состояния"""
+    key = (current_user.id, read_state_version(db_sess, current_user.id), catalog.version, lesson.id)
+    return lesson_sets.get_or_pick(
+        key, lambda: review.lesson_review_set(db_sess, current_user.id, lesson, catalog)
+    )
+
+def lesson_gestures(db_sess, lesson, catalog):
+    """Жесты вопросов урока и значение параметра set (None, если урок одинаков для всех).
+
+    Урок "Повторение старых" берет жесты из очереди повторения. Выбранный
+    набор передается дальше в параметре set, как в /review, чтобы вопросы
+    не менялись, пока ответы урока учитываются.
+    """
+    if lesson.lesson_type != 'repeat_old':
+        return catalog.lesson_gestures(lesson.id), None
+    
+    pool = review.review_pool(catalog, lesson)
+    requested = request.args.get('set', '').split(',')[:len(lesson.gesture_ids)]
+    gesture_ids = list(dict.fromkeys(int(part) for part in requested if part.isdigit() and int(part) in pool))
+    if not gesture_ids:
+        gesture_ids = pick_lesson_set(db_sess, lesson, catalog)
+    gestures = [catalog.get_gesture(gesture_id) for gesture_id in gesture_ids]
+    return gestures, ','.join(str(gesture.id) for gesture in gestures)
+
+@app.route('/api/lesson/<int:lesson_id>')
+@login_required
+def lesson_payload(lesson_id):
+    """Весь урок одним JSON: вопросы, видео, варианты ответов и адрес завершения"""
+    catalog = get_catalog()
+    lesson = catalog.get_lesson(lesson_id)
+    if not lesson or not lesson.gesture_ids:
+        return jsonify({'success': False, 'error': 'Урок не найден'}), 404
+    
+    db_sess = db_session.get_read_session()
+    status = get_lesson_status(db_sess, current_user.id, lesson_id, catalog)
+    if not status['available']:
+        return jsonify({'success': False, 'error': 'Урок пока недоступен'}), 403
+    
+    gestures, gesture_set = lesson_gestures(db_sess, lesson, catalog)
+    payload = build_lesson_payload(
+        catalog,
+        lesson,
+        video_url=video_url,
+        finish_url=url_for('finish_lesson', lesson_id=lesson_id),
+        gestures=gestures
+    )
+    
+    response = jsonify(payload)
+    # Содержимое урока одинаково для всех, но доступ проверяется для каждого пользователя
+    response.set_etag(payload_etag(payload))
+    response.cache_control.private = True
+    if gesture_set is None:
+        response.cache_control.max_age = 300
+    else:
+        # Набор урока повторения свой у ученика и меняется после его ответов
+        response.cache_control.no_cache = True
+    return response.make_conditional(request)
+
+def review_gestures(catalog):
+    """Жесты занятия "Повторить сейчас" и их уроки.
+
+    Набор выбирается из очереди повторения один раз и дальше передается в
+    параметре set, чтобы он не менялся, пока ответы занятия учитываются.
+    """
+    lessons = review.gesture_lessons(catalog)
+    requested = request.args.get('set', '')
+    if requested:
+        ids = [int(part) for part in requested.split(',')[:review.REVIEW_SIZE] if part.isdigit()]
+        gestures = [catalog.get_gesture(gesture_id) for gesture_id in ids if gesture_id in lessons]
+    else:
+        gestures = review.review_set(db_session.get_read_session(), current_user.id, catalog)
+    return gestures, lessons
+
+@app.route('/review')
+@login_required
+def review_now():
+    """Занятие "Повторить сейчас": жесты с вершины очереди интервального повторения"""
+    catalog = get_catalog()
+    gestures, lessons = review_gestures(catalog)
+    if not gestures:
+        return redirect('/lessons')
+    
+    gesture_set = ','.join(str(gesture.id) for gesture in gestures)
+    total_questions = len(gestures)
+    current_question = request.args.get('question', 1, type=int)
+    if current_question < 1 or current_question > total_questions:
+        current_question = 1
+    
+    gesture = gestures[current_question - 1]
+    lesson = lessons[gesture.id]
+    
+    if current_question < total_questions:
+        next_question_url = url_for('review_now', set=gesture_set, question=current_question + 1)
+    else:
+        next_question_url = url_for('lessons')
+    
+    prefetch_urls = []
+    if current_question < total_questions:
+        prefetch_urls.append(video_url(gestures[current_question].video_filename))
+    
+    response = make_response(render_template(
+        'lesson_repeat_old.html',
+        lesson_title='Повторить сейчас',
+        lesson_description='Жесты, которые пора повторить',
+        module_title='Повторение',
+        lesson_icon='history',
+        current_question=current_question,
+        total_questions=total_questions,
+        current_gesture={
             'word': gesture.word,
-            'video_filename': gesture.video_filename,  # Только имя файла
+            'video_filename': gesture.video_filename,
             'description': gesture.description,
             'gesture_id': gesture.id
-        }
-        
-        # Создаем варианты ответов
-        options = [
-            {'text': gesture.word, 'is_correct': True},
-            {'text': 'Дом', 'is_correct': False},
-            {'text': 'Машина', 'is_correct': False},
-            {'text': 'Солнце', 'is_correct': False}
-        ]
-        
-        random.shuffle(options)
-        
-        total_questions = len(gestures_info)
-        
-        # URL для следующего вопроса
-        next_question_url = None
-        if current_question < total_questions:
-            next_question_url = url_for('lesson', lesson_id=lesson_id, question=current_question + 1)
-        else:
-            next_question_url = url_for('finish_lesson', lesson_id=lesson_id)
-        
-        templates = {
-            'new_gestures': 'lesson_new_gestures.html',
-            'repeat_new': 'lesson_repeat_new.html',
-            'repeat_old': 'lesson_repeat_old.html',
-            'final_review': 'lesson_final_review.html'
-        }
-        
-        lesson_icons = {
-            'new_gestures': 'star',
-            'repeat_new': 'redo',
-            'repeat_old': 'history',
-            'final_review': 'trophy'
-        }
-        
-        lesson_descriptions = {
-            'new_gestures': 'Изучение новых жестов',
-            'repeat_new': 'Закрепление материала',
-            'repeat_old': 'Повторение пройденного',
-            'final_review': 'Итоговый тест модуля'
-        }
-        
-        template_name = templates.get(lesson.lesson_type, 'lesson_new_gestures.html')
-        
-        return render_template(
-            template_name,
-            lesson_title=lesson.title,
-            lesson_description=lesson_descriptions.get(lesson.lesson_type, 'Урок'),
-            module_title='Модуль',
-            lesson_icon=lesson_icons.get(lesson.lesson_type, 'star'),
-            current_question=current_question,
-            total_questions=total_questions,
-            current_gesture=current_gesture_data,
-            options=options,
-            next_question_url=next_question_url,
-            lesson_id=lesson_id
-        )
-    finally:
-        db_sess.close()
+        },
+        options=build_options(catalog, lesson, gesture),
+        next_question_url=next_question_url,
+        lesson_id=lesson.id,
+        payload_url=url_for('review_payload', set=gesture_set),
+        finish_url=url_for('lessons'),
+        prefetch_urls=prefetch_urls,
+        prefetch_lead=0
+    ))
+    if prefetch_urls:
+        response.headers['Link'] = prefetch.link_header(prefetch_urls)
+    return response
+
+@app.route('/api/review')
+@login_required
+def review_payload():
+    """Занятие "Повторить сейчас" одним JSON, как /api/lesson/<id>"""
+    catalog = get_catalog()
+    gestures, lessons = review_gestures(catalog)
+    if not gestures:
+        return jsonify({'success': False, 'error': 'Повторять пока нечего'}), 404
+    
+    payload = build_review_payload(catalog, gestures, lessons, video_url, url_for('lessons'))
+    response = jsonify(payload)
+    response.set_etag(payload_etag(payload))
+    response.cache_control.private = True
+    response.cache_control.no_cache = True
+    return response.make_conditional(request)
+
+@app.route('/prefetch_report', methods=['POST'])
+@login_required
+def prefetch_report():
+    """Отчет страницы урока: сколько подсказанных видео потом пригодились"""
+    data = request.get_json(force=True, silent=True) or {}
+    try:
+        counts = [max(0, min(int(data.get(name, 0)), 1000)) for name in ('hinted', 'used', 'cache_hits')]
+    except (TypeError, ValueError):
+        return jsonify({'success': False, 'error': 'Некорректный отчет'}), 400
+    prefetch.stats.record_report(*counts)
+    return jsonify({'success': True})
+
+@app.route('/api/prefetch_stats')
+@teacher_required
+def prefetch_stats():
+    """Статистика подсказок по всему серверу - только для учителей, как и остальные отчеты"""
+    return jsonify(prefetch.stats.snapshot())
+
+@app.route('/metrics')
+def metrics_endpoint():
+    """Метрики в текстовом формате Prometheus.
+
+    С METRICS_TOKEN нужен заголовок Authorization: Bearer <токен>, без него
+    метрики отдаются только локально (не через прокси с X-Forwarded-For).
+    """
+    token = app.config['METRICS_TOKEN']
+    if token:
+        if not hmac.compare_digest(request.headers.get('Authorization', ''), f'Bearer {token}'):
+            abort(401)
+    elif request.remote_addr not in LOCAL_ADDRESSES or 'X-Forwarded-For' in request.headers:
+        abort(403)
+    response = make_response(metrics.metrics.render())
+    response.mimetype = 'text/plain'
+    response.headers['Content-Type'] = 'text/plain; version=0.0.4; charset=utf-8'
+    return response
 
 @app.route('/finish_lesson/<int:lesson_id>')
 @login_required
+@admitted
 def finish_lesson(lesson_id):
     """Завершает урок и открывает доступ к следующему уроку"""
-    db_sess = db_session.create_session()
-    try:
-        # Получаем урок
-        lesson = db_sess.query(Lesson).filter(Lesson.id == lesson_id).first()
-        if not lesson:
-            return redirect('/lessons')
-        
-        # Отмечаем текущий урок как завершенный
-        user_lesson = db_sess.query(UserLesson).filter(
-            UserLesson.user_id == current_user.id,
-            UserLesson.lesson_id == lesson_id
-        ).first()
-        
-        if not user_lesson:
-            user_lesson = UserLesson(
-                user_id=current_user.id,
-                lesson_id=lesson_id,
-                completed_at=datetime.now()
-            )
-            db_sess.add(user_lesson)
-        else:
-            user_lesson.completed_at = datetime.now()
-        
-        # Находим следующий урок В ТОМ ЖЕ МОДУЛЕ
-        next_lesson = db_sess.query(Lesson).filter(
-            Lesson.module_id == lesson.module_id,
-            Lesson.order_index == lesson.order_index
-        ).first()
-        
-        if next_lesson:
-            # Проверяем, есть ли уже запись о следующем уроке
-            next_user_lesson = db_sess.query(UserLesson).filter(
-                UserLesson.user_id == current_user.id,
-                UserLesson.lesson_id == next_lesson.id
-            ).first()
-            
-            # Создаем запись для следующего урока, если ее нет
-            if not next_user_lesson:
-                next_user_lesson = UserLesson(
-                    user_id=current_user.id,
-                    lesson_id=next_lesson.id,
-                    completed_at=None
-                )
-                db_sess.add(next_user_lesson)
-        
-        # Обновляем прогресс модуля
-        user_progress = db_sess.query(UserProgress).filter(
-            UserProgress.user_id == current_user.id,
-            UserProgress.module_id == lesson.module_id
-        ).first()
-        
-        if user_progress:
-            # Считаем сколько уроков в модуле всего
-            total_lessons_in_module = db_sess.query(Lesson).filter(
-                Lesson.module_id == lesson.module_id
-            ).count()
-            
-            # Считаем сколько уроков пройдено
-            completed_lessons = db_sess.query(UserLesson).join(Lesson).filter(
-                UserLesson.user_id == current_user.id,
-                UserLesson.completed_at.isnot(None),
-                Lesson.module_id == lesson.module_id
-            ).count()
-            
-            # Увеличиваем прогресс: каждый урок = +25% (100% / 4 урока = 25% за урок)
-            # Но если в модуле другое количество уроков, считаем пропорционально
-            if total_lessons_in_module > 0:
-                progress_per_lesson = 100.0 / total_lessons_in_module
-                new_progress = min(100.0, completed_lessons * progress_per_lesson)
-                
-                # Принудительно обновляем прогресс
-                user_progress.completion_percentage = new_progress
-                print(f"Обновлен прогресс модуля {lesson.module_id}: {completed_lessons}/{total_lessons_in_module} уроков = {new_progress}%")
-            
-            # Если это финальный урок модуля
-            if lesson.lesson_type == 'final_review':
-                user_progress.is_completed = True
-                user_progress.completion_percentage = 100.0
-        
-        db_sess.commit()
-        
-        return redirect('/lessons')
-        
-    except Exception as e:
-        print(f"Ошибка при завершении урока: {e}")
-        db_sess.rollback()
+    catalog = get_catalog()
+    # Получаем урок
+    lesson = catalog.get_lesson(lesson_id)
+    if not lesson:
         return redirect('/lessons')
-    finally:
-        db_sess.close()
+    
+    try:
+        db_session.transaction(complete_lesson, current_user.id, lesson, catalog)
+    except Exception:
+        log.exception("Ошибка при завершении урока %s", lesson_id)
+    
+    return redirect('/lessons')
+
+def mistakes_request():
+    """Страница ошибок из параметров запроса sort, after и limit"""
+    sort = request.args.get('sort', 'lesson')
+    if sort not in mistakes.SORTS:
+        sort = 'lesson'
+    after = request.args.get('after')
+    after = mistakes.decode_cursor(sort, after) if after else None
+    limit = request.args.get('limit', mistakes.PAGE_SIZE, type=int)
+    
+    db_sess = db_session.get_read_session()
+    rows, next_cursor = mistakes.mistakes_page(db_sess, current_user.id, sort, after, limit)
+    totals = mistakes.module_totals(db_sess, current_user.id)
+    return sort, rows, next_cursor, totals
 
 @app.route('/errors')
 @login_required
 def errors():
     """Страница с ошибками пользователя"""
-    db_sess = db_session.create_session()
-    
-    mistakes = db_sess.query(UserMistake).filter(
-        UserMistake.user_id == current_user.id
-    ).all()
-    
-    mistakes_data = []
-    for mistake in mistakes:
-        gesture = db_sess.query(Gesture).filter(Gesture.id == mistake.gesture_id).first()
-        if gesture:
-            mistakes_data.append({
-                'gesture_word': gesture.word,
-                'incorrect_answer': mistake.incorrect_answer,
-                'mistake_count': mistake.mistake_count,
-                'gesture_id': gesture.id
-            })
+    catalog = get_catalog()
+    try:
+        sort, rows, next_cursor, totals = mistakes_request()
+    except mistakes.CursorError:
+        return redirect(url_for('errors'))
     
     return render_template('errors.html', 
                           title='Мои ошибки',
-                          mistakes=mistakes_data)
+                          mistakes=[mistakes.describe_mistake(catalog, row) for row in rows],
+                          modules=mistakes.describe_totals(catalog, totals),
+                          sort=sort,
+                          first_page='after' not in request.args,
+                          next_url=url_for('errors', sort=sort, after=next_cursor) if next_cursor else None)
 
-def save_mistake(user_id, gesture_id, lesson_id, incorrect_answer):
-    """Сохраняет ошибку пользователя"""
-    db_sess = db_session.create_session()
+@app.route('/api/errors')
+@login_required
+def errors_json():
+    """Ошибки пользователя в JSON: страница, курсор следующей и итоги по модулям"""
+    catalog = get_catalog()
     try:
-        # Проверяем, есть ли уже такая ошибка
-        existing_mistake = db_sess.query(UserMistake).filter(
-            UserMistake.user_id == user_id,
-            UserMistake.gesture_id == gesture_id,
-            UserMistake.lesson_id == lesson_id
-        ).first()
-        
-        if existing_mistake:
-            # Увеличиваем счетчик ошибок
-            existing_mistake.mistake_count += 1
-            if incorrect_answer:
-                existing_mistake.incorrect_answer = incorrect_answer
-        else:
-            # Получаем модуль для урока
-            lesson = db_sess.query(Lesson).filter(Lesson.id == lesson_id).first()
-            module_id = lesson.module_id if lesson else None
-            
-            # Создаем новую запись об ошибке
-            mistake = UserMistake(
-                user_id=user_id,
-                gesture_id=gesture_id,
-                lesson_id=lesson_id,
-                module_id=module_id,
-                incorrect_answer=incorrect_answer,
-                mistake_count=1
-            )
-            db_sess.add(mistake)
-        
-        db_sess.commit()
-        return True
-    except Exception as e:
-        print(f"Ошибка при сохранении ошибки: {e}")
-        db_sess.rollback()
-        return False
-    finally:
-        db_sess.close()
+        sort, rows, next_cursor, totals = mistakes_request()
+    except mistakes.CursorError as e:
+        return jsonify({'success': False, 'error': str(e)}), 400
+    
+    return jsonify({
+        'success': True,
+        'sort': sort,
+        'mistakes': [mistakes.describe_mistake(catalog, row) for row in rows],
+        'next_cursor': next_cursor,
+        'modules': mistakes.describe_totals(catalog, totals)
+    })
+
+def leaderboard_request():
+    """Таблица рейтинга из параметров kind (all, week, module) и module"""
+    catalog = get_catalog()
+    kind = request.args.get('kind', 'all')
+    module = catalog.get_module(request.args.get('module', type=int)) if kind == 'module' else None
+    if kind == 'week':
+        board = leaderboard.week_board()
+    elif module is not None:
+        board = leaderboard.module_board(module.id)
+    else:
+        kind, board = 'all', leaderboard.ALL
+    
+    db_sess = db_session.get_read_session()
+    me = leaderboard.my_standing(db_sess, board, current_user.id)
+    return {
+        'kind': kind,
+        'module_id': module.id if module else None,
+        'board': board,
+        'top': [standing._asdict() for standing in leaderboard.top(db_sess, board)],
+        'me': me._asdict() if me else None,
+        'students': leaderboard.board_size(db_sess, board),
+    }
+
+@app.route('/leaderboard')
+@login_required
+def leaderboard_page():
+    """Рейтинг учеников: общий, за неделю или по модулю"""
+    return render_template('leaderboard.html', title='Рейтинг',
+                           modules=get_catalog().modules, **leaderboard_request())
+
+@app.route('/api/leaderboard')
+@login_required
+def leaderboard_json():
+    return jsonify(leaderboard_request())
+
+def teacher_report():
+    """Отчет по классу из параметра class (без него - по всем ученикам)"""
+    db_sess = db_session.get_read_session()
+    scope = request.args.get('class', analytics.ALL_STUDENTS).strip()
+    return db_sess, analytics.class_report(db_sess, get_catalog(), scope)
+
+@app.route('/teacher')
+@teacher_required
+def teacher():
+    """Аналитика учителя: самые трудные жесты, точность по урокам и прохождение модулей"""
+    db_sess, report = teacher_report()
+    return render_template('teacher.html', title='Аналитика класса',
+                           report=report, classes=analytics.class_names(db_sess))
+
+@app.route('/api/teacher/analytics')
+@teacher_required
+def teacher_analytics():
+    db_sess, report = teacher_report()
+    report['classes'] = analytics.class_names(db_sess)
+    return jsonify(report)
+
+@app.route('/teacher/export/<name>')
+@teacher_required
+def teacher_export(name):
+    """Выгрузка progress, lessons или mistakes потоком: ?format=csv|ndjson&gzip=1&class="""
+    fmt = request.args.get('format', 'csv')
+    compress = request.args.get('gzip') == '1'
+    try:
+        chunks = export.stream(name, fmt, get_catalog(), request.args.get('class', '').strip(), compress)
+    except export.ExportError as e:
+        return jsonify({'success': False, 'error': str(e)}), 400
+    
+    # Без Content-Length ответ уходит кусками (chunked) по мере чтения строк
+    response = Response(chunks, mimetype='application/gzip' if compress else export.MIMETYPES[fmt])
+    response.headers['Content-Disposition'] = f'attachment; filename={export.filename(name, fmt, compress)}'
+    response.headers['Cache-Control'] = 'no-store'
+    return response
+
+def store_answers(user_id, answers, catalog):
+    """Применяет пачку ответов в одной транзакции и возвращает число учтенных.
+
+    При отложенной записи ответы только надежно пишутся в журнал, и тогда
+    возвращается None - сколько из них окажутся повторами, станет известно позже.
+    """
+    if app.config['ANSWER_WRITE_BEHIND']:
+        answer_log.append(user_id, answers)
+        return None
+
+    # Конфликты ключей и счетчиков разрешает сам upsert, повторять не нужно
+    return db_session.transaction(apply_answers, user_id, answers, catalog)
 
 @app.route('/save_answer', methods=['POST'])
 @login_required
+@admitted
 def save_answer():
     """Сохраняет ответ пользователя и ошибки если есть"""
     try:
-        data = request.get_json()
+        data = request.get_json(silent=True)
         if not data:
             return jsonify({'success': False, 'error': 'Нет данных'}), 400
-            
-        lesson_id = data.get('lesson_id')
-        gesture_id = data.get('gesture_id')
-        is_correct = data.get('is_correct')
-        selected_answer = data.get('selected_answer')  # Добавь это поле в JavaScript
-        
-        db_sess = db_session.create_session()
-        
-        # Получаем урок
-        lesson = db_sess.query(Lesson).filter(Lesson.id == lesson_id).first()
-        if not lesson:
-            db_sess.close()
-            return jsonify({'success': False, 'error': 'Урок не найден'}), 404
-        
-        # Получаем жест
-        gesture = db_sess.query(Gesture).filter(Gesture.id == gesture_id).first()
-        
-        # Если ответ неправильный - сохраняем ошибку
-        if not is_correct and gesture and selected_answer:
-            save_mistake(current_user.id, gesture_id, lesson_id, selected_answer)
-        
-        # Сохраняем или обновляем запись об уроке
-        user_lesson = db_sess.query(UserLesson).filter(
-            UserLesson.user_id == current_user.id,
-            UserLesson.lesson_id == lesson_id
-        ).first()
-        
-        if not user_lesson:
-            user_lesson = UserLesson(
-                user_id=current_user.id,
-                lesson_id=lesson_id,
-                total_answers=1,
-                correct_answers=1 if is_correct else 0
-            )
-            db_sess.add(user_lesson)
-        else:
-            user_lesson.total_answers += 1
-            if is_correct:
-                user_lesson.correct_answers += 1
         
-        # Обновляем прогресс пользователя
-        user_progress = db_sess.query(UserProgress).filter(
-            UserProgress.user_id == current_user.id,
-            UserProgress.module_id == lesson.module_id
-        ).first()
-        
-        if user_progress:
-            user_progress.total_questions += 1
-            if is_correct:
-                user_progress.correct_answers += 1
-            
-            # Пересчитываем процент завершения
-            total_lessons_in_module = db_sess.query(Lesson).filter(
-                Lesson.module_id == lesson.module_id
-            ).count()
-            
-            if total_lessons_in_module > 0:
-                # Подсчитываем, сколько уроков в модуле пройдено
-                completed_lessons = db_sess.query(UserLesson).join(Lesson).filter(
-                    UserLesson.user_id == current_user.id,
-                    UserLesson.completed_at.isnot(None),
-                    Lesson.module_id == lesson.module_id
-                ).count()
-                
-                user_progress.completion_percentage = min(
-                    100.0,
-                    (completed_lessons / total_lessons_in_module) * 100
-                )
-            
-            db_sess.commit()
+        catalog = get_catalog()
+        try:
+            answer = parse_answer(data, catalog, require_key=False)
+        except AnswerError as e:
+            return jsonify({'success': False, 'error': str(e)}), 404
         
-        db_sess.close()
+        store_answers(current_user.id, [answer], catalog)
         return jsonify({'success': True})
         
     except Exception as e:
-        print(f"Ошибка при сохранении ответа: {e}")
+        log.exception("Ошибка при сохранении ответа")
+        return jsonify({'success': False, 'error': str(e)}), 500
+
+@app.route('/save_answers', methods=['POST'])
+@login_required
+@admitted
+def save_answers():
+    """Сохраняет пачку ответов. Повторно присланные ответы (тот же key) не учитываются"""
+    data = request.get_json(silent=True)
+    items = data.get('answers') if isinstance(data, dict) else None
+    if not isinstance(items, list) or not items:
+        return jsonify({'success': False, 'error': 'Нет данных'}), 400
+    if len(items) > MAX_BATCH_SIZE:
+        return jsonify({'success': False, 'error': f'Не больше {MAX_BATCH_SIZE} ответов за раз'}), 413
+    
+    # Некорректные ответы отклоняются по одному, остальные сохраняются
+    catalog = get_catalog()
+    answers, rejected = parse_answers(items, catalog)
+    
+    applied = 0
+    if answers:
+        try:
+            applied = store_answers(current_user.id, answers, catalog)
+        except Exception as e:
+            log.exception("Ошибка при сохранении ответов")
+            return jsonify({'success': False, 'error': str(e)}), 500
+    
+    result = {'success': True, 'keys': [answer['key'] for answer in answers], 'rejected': rejected}
+    if applied is None:
+        result['queued'] = len(answers)
+    else:
+        result['applied'] = applied
+        result['duplicates'] = len(answers) - applied
+    return jsonify(result)
+
+def offline_entries(db_sess, catalog):
+    """Адреса для кэша service worker: страницы, открытые уроки и их видео"""
+    shell = app.config['SHELL_REVISION']
+    state = page_etag((shell, catalog.version, read_state_version(db_sess, current_user.id)))
+    entries = [
+        offline.Entry(url_for('lessons'), 'shell', state),
+        offline.Entry(url_for('progress'), 'shell', state),
+    ]
+    videos = {}
+    for lesson in offline.unlocked_lessons(db_sess, current_user.id, catalog):
+        gestures = catalog.lesson_gestures(lesson.id)
+        if lesson.lesson_type == 'repeat_old':
+            gestures = [catalog.get_gesture(gesture_id) for gesture_id in pick_lesson_set(db_sess, lesson, catalog)]
+        payload = build_lesson_payload(
+            catalog, lesson, video_url=video_url, finish_url=url_for('finish_lesson', lesson_id=lesson.id),
+            gestures=gestures
+        )
+        revision = payload_etag(payload)
+        entries.append(offline.Entry(url_for('lesson', lesson_id=lesson.id), 'shell', page_etag((shell, revision))))
+        entries.append(offline.Entry(url_for('lesson_payload', lesson_id=lesson.id), 'lesson', revision))
+        for gesture in gestures:
+            asset = video_manifest.get(gesture.video_filename)
+            if asset is not None:
+                videos[asset.url_name] = offline.Entry(
+                    url_for('video_asset', url_name=asset.url_name), 'video', asset.digest
+                )
+    return entries + list(videos.values())
+
+@app.route('/api/offline/manifest')
+@login_required
+def offline_manifest():
+    """Манифест предзагрузки; с ?since=<версия> - только разница с ней"""
+    entries = offline_entries(db_session.get_read_session(), get_catalog())
+    response = jsonify(offline.manifest_response(entries, offline_manifests, request.args.get('since')))
+    response.cache_control.private = True
+    response.cache_control.no_cache = True
+    return response
+
+@app.route('/api/offline/sync', methods=['POST'])
+@login_required
+@admitted
+def offline_sync():
+    """Ответы и уроки, накопленные без сети, и разница манифеста после них"""
+    catalog = get_catalog()
+    data = request.get_json(silent=True)
+    try:
+        answers, rejected_keys, lesson_ids = offline.parse_sync(data, catalog)
+    except offline.SyncError as e:
+        return jsonify({'success': False, 'error': str(e)}), 400
+    
+    result = {'success': True, 'keys': [answer['key'] for answer in answers], 'rejected_keys': rejected_keys}
+    completed, rejected = [], []
+    try:
+        if answers:
+            applied = store_answers(current_user.id, answers, catalog)
+            result.update({'queued': len(answers)} if applied is None else {'applied': applied})
+        if lesson_ids:
+            completed, rejected = db_session.transaction(
+                offline.apply_completions, current_user.id, lesson_ids, catalog
+            )
+    except Exception as e:
+        log.exception("Ошибка при синхронизации")
         return jsonify({'success': False, 'error': str(e)}), 500
+    
+    result['completed'] = completed
+    result['rejected'] = rejected
+    # Снимок сессии чтения мог открыться еще до записи (например, в load_user), читаем заново
+    entries = offline_entries(db_session.get_read_session(fresh=True), catalog)
+    result['manifest'] = offline.manifest_response(entries, offline_manifests, data.get('manifest_version'))
+    return jsonify(result)
+
+@app.route('/sw.js')
+def service_worker():
+    """Service worker офлайн-режима; отдается от корня, чтобы управлять всем сайтом"""
+    response = make_response(render_template('sw.js'))
+    response.mimetype = 'application/javascript'
+    response.cache_control.no_cache = True
+    return response
 
 @app.route('/logout')
 @login_required
 def logout():
+    identity.invalidate_identity(current_user.id)
     logout_user()
     return redirect("/")
 
+@app.cli.command('import-roster')
+@click.argument('path', type=click.Path(exists=True, dir_okay=False))
+@click.option('--batch-size', default=BATCH_SIZE, show_default=True, help='Учеников в одной транзакции')
+@click.option('--workers', type=int, default=None, help='Процессов для хэширования паролей (по умолчанию - по числу ядер)')
+@click.option('--defer-progress', is_flag=True, help='Не создавать пустой прогресс по модулям заранее')
+@click.option('--restart', is_flag=True, help='Начать сначала, не продолжая прерванный импорт')
+def import_roster_command(path, batch_size, workers, defer_progress, restart):
+    """Массовый импорт учеников из CSV или JSON (см. data/roster.py)"""
+    try:
+        report = import_roster(path, batch_size, workers, defer_progress, resume=not restart)
+    except RosterError as e:
+        raise click.ClickException(str(e))
+    click.echo(report.summary())
+
+@app.cli.command('prune-receipts')
+@click.option('--days', default=RECEIPT_TTL_DAYS, show_default=True, help='Удалить ключи старше стольких дней')
+def prune_receipts_command(days):
+    """Удаляет старые ключи идемпотентности ответов (при отложенной записи - еще и раз в час сам)"""
+    pruned = 0
+    while True:
+        deleted = db_session.transaction(prune_receipts, days)
+        pruned += deleted
+        if deleted < PRUNE_BATCH_SIZE:
+            break
+    click.echo(f'Удалено ключей: {pruned}')
+
+@app.cli.group('curriculum')
+def curriculum_cli():
+    """Учебный контент из манифеста (см. data/curriculum.py)"""
+
+@curriculum_cli.command('import')
+@click.argument('path', type=click.Path(exists=True, dir_okay=False))
+@click.option('--prune', is_flag=True, help='Удалить модули, уроки и жесты, которых нет в манифесте')
+@click.option('--force', is_flag=True, help='С --prune удалить и данные учеников по удаляемым записям')
+@click.option('--dry-run', is_flag=True, help='Только показать изменения')
+def curriculum_import(path, prune, force, dry_run):
+    """Применяет к базе изменения из манифеста"""
+    try:
+        plan, version = db_session.transaction(
+            curriculum.import_manifest, curriculum.load_manifest(path), app.config['VIDEO_DIR'], prune, dry_run,
+            force
+        )
+    except curriculum.ManifestError as e:
+        raise click.ClickException(str(e))
+    click.echo(curriculum.describe_plan(plan))
+    if version is None:
+        click.echo('База не изменена')
+    else:
+        click.echo(f'Версия контента: {version}')
+
+@curriculum_cli.command('export')
+@click.argument('path', type=click.Path(dir_okay=False, writable=True))
+def curriculum_export(path):
+    """Сохраняет текущий контент базы в манифест"""
+    db_sess = db_session.create_read_session()
+    try:
+        manifest = curriculum.export_manifest(db_sess)
+    finally:
+        db_sess.close()
+    with open(path, 'w', encoding='utf-8') as f:
+        json.dump(manifest, f, ensure_ascii=False, indent=2)
+        f.write('\n')
+    click.echo(f'Модулей: {len(manifest["modules"])}, жестов: {len(manifest["gestures"])}')
+
+@app.cli.command('export')
+@click.argument('name', type=click.Choice(sorted(export.DATASETS)))
+@click.argument('output', type=click.File('wb'), default='-')
+@click.option('--format', 'fmt', type=click.Choice(export.FORMATS), default='csv', show_default=True)
+@click.option('--gzip', 'compress', is_flag=True, help='Сжать выгрузку gzip')
+@click.option('--class', 'class_name', default=None, help='Только ученики этого класса')
+def export_command(name, output, fmt, compress, class_name):
+    """Выгрузка данных учеников в файл или stdout (см. data/export.py)"""
+    for chunk in export.stream(name, fmt, get_catalog(), class_name, compress):
+        output.write(chunk)
+
 if __name__ == '__main__':
     app.run(host='0.0.0.0')
\ No newline at end of file
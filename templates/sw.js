@@ -0,0 +1,240 @@
+// Service worker офлайн-режима (см. data/offline.py).
+//
+// Держит в кэше то, что перечислено в манифесте ученика: страницы, JSON
+// открытых уроков и видео их жестов. Манифест обновляется разницей с уже
+// скачанной версией. Видео отдаются из кэша, в том числе кусками по Range
+// (ответ 206). Без сети страницы и уроки берутся из кэша, а урок,
+// завершенный без сети, откладывается в очередь и уходит на сервер через
+// /api/offline/sync при следующем обновлении. При перегрузке сервер сам
+// перенаправляет завершение урока на список уроков, который его повторит.
+// Ответы копит и досылает сама страница урока (очередь в localStorage,
+// /save_answers).
+const CACHE = 'offline-v1';
+// Служебные записи в том же кэше
+const STATE_KEY = '/__offline/state';  // {version, entries: {адрес: ревизия}}
+const QUEUE_KEY = '/__offline/completions';  // id уроков, еще не отправленных на сервер
+const MANIFEST_URL = '{{ url_for("offline_manifest") }}';
+const SYNC_URL = '{{ url_for("offline_sync") }}';
+const LESSONS_URL = '{{ url_for("lessons") }}';
+const LOGOUT_URL = '{{ url_for("logout") }}';
+// Манифест без очереди проверяем не чаще раза в минуту
+const REFRESH_INTERVAL = 60000;
+
+let lastRefresh = 0;
+let refreshInProgress = null;
+
+async function readJson(key, fallback) {
+    const cache = await caches.open(CACHE);
+    const response = await cache.match(key);
+    return response ? response.json() : fallback;
+}
+
+async function writeJson(key, value) {
+    const cache = await caches.open(CACHE);
+    await cache.put(key, new Response(JSON.stringify(value), {headers: {'Content-Type': 'application/json'}}));
+}
+
+async function applyManifest(manifest) {
+    // Скачивает новые и изменившиеся адреса и удаляет лишние
+    const cache = await caches.open(CACHE);
+    const state = await readJson(STATE_KEY, {version: null, entries: {}});
+    const entries = manifest.full ? {} : state.entries;
+    let removed = manifest.remove;
+    if (manifest.full) {
+        const listed = new Set(manifest.entries.map(entry => entry.url));
+        removed = Object.keys(state.entries).filter(url => !listed.has(url));
+    }
+    for (const url of removed) {
+        delete entries[url];
+        await cache.delete(url);
+    }
+    for (const entry of manifest.entries) {
+        if (state.entries[entry.url] === entry.revision && await cache.match(entry.url)) {
+            entries[entry.url] = entry.revision;
+            continue;
+        }
+        // Видео по хэшу содержимого не меняются, остальное проверяем у сервера
+        const response = await fetch(entry.url, {
+            credentials: 'same-origin',
+            cache: entry.kind === 'video' ? 'default' : 'no-cache'
+        });
+        if (response.ok && !response.redirected) {
+            await cache.put(entry.url, response);
+            entries[entry.url] = entry.revision;
+        }
+    }
+    await writeJson(STATE_KEY, {version: manifest.version, entries: entries});
+}
+
+async function refresh(force) {
+    const state = await readJson(STATE_KEY, {version: null, entries: {}});
+    const completions = await readJson(QUEUE_KEY, []);
+    if (!force && !completions.length && Date.now() - lastRefresh < REFRESH_INTERVAL) {
+        return;
+    }
+    let manifest;
+    if (completions.length) {
+        const response = await fetch(SYNC_URL, {
+            method: 'POST',
+            credentials: 'same-origin',
+            headers: {'Content-Type': 'application/json'},
+            body: JSON.stringify({completions: completions, manifest_version: state.version})
+        });
+        if (!response.ok) {
+            return;
+        }
+        const data = await response.json();
+        // Пока шел запрос, в очередь могли добавиться новые уроки - они остаются
+        const queue = await readJson(QUEUE_KEY, []);
+        await writeJson(QUEUE_KEY, queue.slice(completions.length));
+        manifest = data.manifest;
+    } else {
+        const query = state.version ? '?since=' + encodeURIComponent(state.version) : '';
+        const response = await fetch(MANIFEST_URL + query, {credentials: 'same-origin', cache: 'no-cache'});
+        if (!response.ok || response.redirected) {
+            return;
+        }
+        manifest = await response.json();
+    }
+    lastRefresh = Date.now();
+    await applyManifest(manifest);
+}
+
+function scheduleRefresh(force) {
+    // Одно обновление за раз; ошибки сети просто ждут следующей попытки
+    if (!refreshInProgress) {
+        refreshInProgress = refresh(force).catch(error => {
+            console.warn('Офлайн-кэш не обновлен:', error);
+        }).finally(() => {
+            refreshInProgress = null;
+        });
+    }
+    return refreshInProgress;
+}
+
+async function fromCache(request) {
+    // Адреса по хэшу содержимого: из кэша, а без него - из сети
+    const cached = await caches.match(request.url);
+    if (!cached) {
+        return fetch(request);
+    }
+    const range = request.headers.get('Range');
+    return range ? sliceCached(request, cached, range) : cached;
+}
+
+async function sliceCached(request, cached, range) {
+    // Плеер просит видео кусками (Range), а в кэше файл целиком: отдаем кусок как 206.
+    // Несколько диапазонов сразу браузеры для видео не просят - такое уходит в сеть
+    const match = /^bytes=(\d*)-(\d*)$/.exec(range.trim());
+    if (!match || (!match[1] && !match[2])) {
+        return fetch(request).catch(() => cached);
+    }
+    const body = await cached.blob();
+    const size = body.size;
+    let start = Number(match[1]);
+    let end = match[2] ? Math.min(Number(match[2]), size - 1) : size - 1;
+    if (!match[1]) {
+        // bytes=-N - последние N байт
+        start = Math.max(0, size - Number(match[2]));
+        end = size - 1;
+    }
+    if (start >= size || start > end) {
+        return new Response(null, {status: 416, headers: {'Content-Range': `bytes */${size}`}});
+    }
+    const headers = new Headers(cached.headers);
+    headers.set('Content-Range', `bytes ${start}-${end}/${size}`);
+    headers.set('Content-Length', String(end - start + 1));
+    return new Response(body.slice(start, end + 1), {status: 206, statusText: 'Partial Content', headers: headers});
+}
+
+async function networkFirst(request) {
+    try {
+        return await fetch(request);
+    } catch (error) {
+        // Любой вопрос урока открывается страницей урока: вопросы она берет из JSON урока
+        const cached = await caches.match(request.url) || await caches.match(request.url, {ignoreSearch: true});
+        if (cached) {
+            return cached;
+        }
+        throw error;
+    }
+}
+
+async function runtimeCache(request) {
+    // Стили и скрипты с CDN: сеть, а без нее - последняя скачанная копия
+    const cache = await caches.open(CACHE);
+    try {
+        const response = await fetch(request);
+        if (response.ok) {
+            await cache.put(request, response.clone());
+        }
+        return response;
+    } catch (error) {
+        const cached = await cache.match(request);
+        if (cached) {
+            return cached;
+        }
+        throw error;
+    }
+}
+
+async function finishLesson(request, lessonId) {
+    try {
+        return await fetch(request);
+    } catch (error) {
+        // Нет сети - урок уйдет позже вместе с очередью
+    }
+    const queue = await readJson(QUEUE_KEY, []);
+    if (!queue.includes(lessonId)) {
+        queue.push(lessonId);
+        await writeJson(QUEUE_KEY, queue);
+    }
+    return Response.redirect(LESSONS_URL, 303);
+}
+
+async function logout(request) {
+    // Личные страницы не должны пережить выход из аккаунта
+    await caches.delete(CACHE);
+    lastRefresh = 0;
+    return fetch(request);
+}
+
+self.addEventListener('install', event => {
+    self.skipWaiting();
+    event.waitUntil(scheduleRefresh(true));
+});
+
+self.addEventListener('activate', event => {
+    event.waitUntil(self.clients.claim());
+});
+
+// Страницы просят обновиться при загрузке и при появлении сети
+self.addEventListener('message', event => {
+    if (event.data === 'refresh' || event.data === 'online') {
+        event.waitUntil(scheduleRefresh(event.data === 'online'));
+    }
+});
+
+self.addEventListener('fetch', event => {
+    const request = event.request;
+    const url = new URL(request.url);
+    if (request.method !== 'GET') {
+        return;
+    }
+    if (url.origin !== self.location.origin) {
+        if (['style', 'script', 'font'].includes(request.destination)) {
+            event.respondWith(runtimeCache(request));
+        }
+        return;
+    }
+    const finish = url.pathname.match(/^\/finish_lesson\/(\d+)$/);
+    if (finish && request.mode === 'navigate') {
+        event.respondWith(finishLesson(request, Number(finish[1])));
+    } else if (url.pathname === LOGOUT_URL) {
+        event.respondWith(logout(request));
+    } else if (url.pathname.startsWith('/videos/')) {
+        event.respondWith(fromCache(request));
+    } else if (request.mode === 'navigate' || url.pathname.startsWith('/api/lesson/')) {
+        event.respondWith(networkFirst(request));
+    }
+});
@@ -0,0 +1,136 @@
+"""Журнал отложенной записи ответов: проигрывание сегментов и плохие записи.
+
+Запуск: python -m pytest tests
+"""
+import json
+import os
+
+import pytest
+
+from benchmarks import dataset
+from data import db_session
+from data.answer_log import DEAD_LETTER_FILE, AnswerLog
+from data.answers import AnswerError, apply_answers, parse_answer
+from data.catalog import get_catalog
+from data.user_lesson import UserLesson
+
+USER_ID = 1
+
+
+@pytest.fixture(scope='module')
+def catalog(tmp_path_factory):
+    path = str(tmp_path_factory.mktemp('db') / 'test.db')
+    dataset.generate(path, users=3, modules=2, lessons_per_module=2, gestures=10, progress=0.0)
+    db_session.global_init(path)
+    return get_catalog()
+
+
+def course(catalog):
+    return [lesson for module in catalog.modules for lesson in catalog.module_lessons(module.id)]
+
+
+def answer(catalog, key, lesson_index=0, **fields):
+    lesson = course(catalog)[lesson_index]
+    data = {'key': key, 'lesson_id': lesson.id, 'gesture_id': lesson.gesture_ids[0], 'is_correct': True}
+    data.update(fields)
+    return data
+
+
+def lesson_totals(lesson_id):
+    db_sess = db_session.create_read_session()
+    try:
+        row = db_sess.query(UserLesson).filter_by(user_id=USER_ID, lesson_id=lesson_id).first()
+        return row.total_answers if row else 0
+    finally:
+        db_sess.close()
+
+
+def write_segment(directory, name, records):
+    with open(os.path.join(directory, name), 'w', encoding='utf-8') as fh:
+        for record in records:
+            fh.write(json.dumps(record) + '\n')
+        fh.write('{"user_id": 1, "answ')  #оборванная строка после падения
+
+
+def read_dead_letters(directory):
+    path = os.path.join(directory, DEAD_LETTER_FILE)
+    if not os.path.exists(path):
+        return []
+    with open(path, encoding='utf-8') as fh:
+        return [json.loads(line)['record'] for line in fh]
+
+
+def test_parse_answer_rejects_unknown_gesture(catalog):
+    for gesture_id in ([1], {'id': 1}, '1', True, None, 10 ** 9):
+        with pytest.raises(AnswerError):
+            parse_answer(answer(catalog, 'k', gesture_id=gesture_id), catalog)
+
+
+def test_apply_answers_skips_removed_lessons(catalog):
+    lesson = course(catalog)[0]
+    before = lesson_totals(lesson.id)
+    stale = dict(parse_answer(answer(catalog, 'stale-1'), catalog), lesson_id=10 ** 9)
+    fresh = parse_answer(answer(catalog, 'stale-2'), catalog)
+    assert db_session.transaction(apply_answers, USER_ID, [stale, fresh], catalog) == 1
+    assert lesson_totals(lesson.id) == before + 1
+
+
+def test_recover_replays_segments_once(catalog, tmp_path):
+    lesson = course(catalog)[1]
+    before = lesson_totals(lesson.id)
+    records = [
+        {'user_id': USER_ID, 'answer': parse_answer(answer(catalog, f'replay-{n}', 1), catalog)}
+        for n in range(3)
+    ]
+    write_segment(tmp_path, 'answers-1-1.log', records)
+    # Тот же сегмент еще раз, как после падения посреди сброса: ключи не дают учесть ответы дважды
+    write_segment(tmp_path, 'answers-1-2.log', records)
+
+    answer_log = AnswerLog(str(tmp_path), fsync=False)
+    assert answer_log.recover() == 6
+    assert lesson_totals(lesson.id) == before + 3
+    assert not list(tmp_path.glob('answers-*.log'))
+
+
+def test_poisoned_record_goes_to_dead_letter(catalog, tmp_path):
+    lesson = course(catalog)[2]
+    before = lesson_totals(lesson.id)
+    good = parse_answer(answer(catalog, 'poison-good', 2), catalog)
+    # Запись в обход parse_answer, как в журналах до проверки gesture_id
+    bad = dict(good, key='poison-bad', gesture_id=[1], is_correct=False, selected_answer='x')
+
+    answer_log = AnswerLog(str(tmp_path), flush_interval=60, fsync=False)
+    answer_log.start()
+    try:
+        answer_log.append(USER_ID, [good, bad])
+        assert answer_log.flush() == 2
+        assert answer_log.pending_for_user(USER_ID) == []
+        assert [record['answer']['key'] for record in read_dead_letters(tmp_path)] == ['poison-bad']
+        assert lesson_totals(lesson.id) == before + 1
+
+        # Следующие ответы сбрасываются как обычно
+        answer_log.append(USER_ID, [parse_answer(answer(catalog, 'poison-after', 2), catalog)])
+        assert answer_log.flush() == 1
+        assert lesson_totals(lesson.id) == before + 2
+    finally:
+        answer_log.stop()
+
+
+def test_recover_poisoned_segment_does_not_raise(catalog, tmp_path):
+    lesson = course(catalog)[3]
+    before = lesson_totals(lesson.id)
+    good = parse_answer(answer(catalog, 'recover-good', 3), catalog)
+    bad = dict(good, key='recover-bad', gesture_id=[1], is_correct=False, selected_answer='x')
+    write_segment(tmp_path, 'answers-1-1.log', [
+        {'user_id': USER_ID, 'answer': good},
+        {'user_id': USER_ID, 'answer': bad},
+        'не запись',
+    ])
+
+    answer_log = AnswerLog(str(tmp_path), flush_interval=60, fsync=False)
+    answer_log.start()
+    answer_log.stop()
+    assert lesson_totals(lesson.id) == before + 1
+    assert [record['answer']['key'] for record in read_dead_letters(tmp_path)[:1]] == ['recover-bad']
+    assert len(read_dead_letters(tmp_path)) == 2
+    assert not list(tmp_path.glob('answers-*.log'))